@@ -0,0 +1,301 @@
+# TODO: license
+from array import array
+import heapq
+import itertools
+import operator
+
+from columns import RecordColumns
+from search import SearchIndex
+from sourceindex import SourceFileIndex
+from topk import merge_top_k
+
+# Ranges of records ending within this many records of the start are found
+# by merging the hottest records of each TU, rather than by building the
+# whole sorted list of records (which is only done once someone looks
+# further).
+MAX_TOP_K = 10000
+
+def record_sort_key(record):
+    if not record.count:
+        return 0
+    return -record.count.value
+
+class Function:
+    """Aggregate data about the records within one function"""
+    def __init__(self, name, sourcefile, hotness, tu, peak_location,
+                 peak_location_hotness):
+        self.name = name
+        self.sourcefile = sourcefile
+        self.hotness = hotness
+        self.tu = tu
+        self.peak_location = peak_location
+        # The hotness of the record at peak_location, which can be less than
+        # self.hotness if the hottest record has no location:
+        self.peak_location_hotness = peak_location_hotness
+
+    def merge(self, other):
+        """
+        Update this Function with the data from other, for the same function
+        in a later TranslationUnit.
+        """
+        if not self.sourcefile:
+            self.sourcefile = other.sourcefile
+        if self.hotness < other.hotness:
+            self.hotness = other.hotness
+        if other.peak_location:
+            if (not self.peak_location
+                or self.peak_location_hotness < other.peak_location_hotness):
+                self.peak_location = other.peak_location
+                self.peak_location_hotness = other.peak_location_hotness
+
+    def copy(self):
+        return Function(self.name, self.sourcefile, self.hotness, self.tu,
+                        self.peak_location, self.peak_location_hotness)
+
+class TUSummary:
+    """
+    Aggregate data about the records within one TranslationUnit,
+    computed once when it is loaded.
+    """
+    def __init__(self, tu):
+        self.tu = tu
+        self.filename = tu.filename
+        self.size = tu.size
+        columns = RecordColumns([tu])
+        self.num_toplevel_records = len(tu.records)
+        self.num_all_records = len(columns)
+
+        # Mapping of passname to [passname, num top-level records,
+        # num overall records]
+        self.passes = {}
+        toplevel_by_pass = columns.count_records_by_pass(toplevel_only=True)
+        for passname, n in columns.count_records_by_pass().items():
+            self.passes[passname] = [passname, toplevel_by_pass[passname], n]
+
+        # Mapping of source file to [sourcefile, num top-level records,
+        # num overall records]
+        self.sourcefiles = {}
+        toplevel_by_file = columns.count_records_by_file(toplevel_only=True)
+        for sourcefile, n in columns.count_records_by_file().items():
+            self.sourcefiles[sourcefile] = [sourcefile,
+                                            toplevel_by_file[sourcefile], n]
+
+        # Mapping of name to Function
+        self.functions = {}
+        for record, value in zip(columns.records, columns.count_value):
+            funcname = record.function
+            if not funcname:
+                continue
+            loc = record.location
+            f = self.functions.get(funcname)
+            if not f:
+                self.functions[funcname] = Function(
+                    funcname, loc.file if loc else None, value, tu.filename,
+                    loc, value)
+                continue
+            if not f.sourcefile and loc:
+                f.sourcefile = loc.file
+            if f.hotness < value:
+                f.hotness = value
+            if loc and (not f.peak_location
+                        or f.peak_location_hotness < value):
+                f.peak_location = loc
+                f.peak_location_hotness = value
+
+        # All records, sorted by highest-count down to lowest-count, keeping
+        # the records with equal counts in their original order.
+        neg_counts = array('q', map(operator.neg, columns.count_value))
+        order = sorted(range(len(columns)), key=neg_counts.__getitem__)
+        self.sorted_records = list(map(columns.records.__getitem__, order))
+
+    def count_toplevel_records(self):
+        return self.num_toplevel_records
+
+    def count_all_records(self):
+        return self.num_all_records
+
+def combine_counts(dicts):
+    """
+    Combine dicts of name to [name, num top-level records, num overall
+    records] into a sorted list of the same.
+    """
+    combined = {}
+    for d in dicts:
+        for name, counts in d.items():
+            if name not in combined:
+                combined[name] = [name, 0, 0]
+            combined[name][1] += counts[1]
+            combined[name][2] += counts[2]
+    return sorted(combined.values())
+
+class RecordIndex:
+    """
+    Aggregate data about a list of TranslationUnits, built from the
+    TUSummary of each.
+
+    An index is never modified once built; see updated for getting a new
+    one reflecting changes to the TUs.
+    """
+    def __init__(self, tus, summaries=None, sourcefile_index=None):
+        self.tus = tus
+        if summaries is None:
+            summaries = [TUSummary(tu) for tu in tus]
+        self.summaries = summaries
+
+        self.total_size = sum(s.size for s in self.summaries)
+        self.count_top_level = sum(s.num_toplevel_records
+                                   for s in self.summaries)
+        self.count_all = sum(s.num_all_records for s in self.summaries)
+
+        # Lists of [passname, num top-level records, num overall records]
+        # and of [sourcefile, num top-level records, num overall records]
+        self.passes = combine_counts(s.passes for s in self.summaries)
+        self.sourcefiles = combine_counts(s.sourcefiles
+                                          for s in self.summaries)
+
+        # Mapping of name to Function
+        functions = {}
+        for s in self.summaries:
+            for funcname, f in s.functions.items():
+                if funcname not in functions:
+                    functions[funcname] = f.copy()
+                else:
+                    functions[funcname].merge(f)
+        self.functions = sorted(functions.values(),
+                                key=lambda f: f.hotness,
+                                reverse=True)
+
+        # Mapping of source file to line to records
+        if sourcefile_index is None:
+            sourcefile_index = SourceFileIndex(tus)
+        self.sourcefile_index = sourcefile_index
+
+        # The merged list of all records, sorted by highest-count down to
+        # lowest-count, and the mapping of passname to the records from that
+        # pass in the same order; these are only built when needed (see
+        # get_records).
+        self._records = None
+        self._records_by_pass = {}
+        # The SearchIndex over all records, built when first needed (see
+        # get_search_index)
+        self._search_index = None
+
+    def updated(self, tus):
+        """
+        Get a new RecordIndex for tus, leaving this one unchanged.  The
+        summaries and source file index entries of the TranslationUnits
+        shared with this index (the same objects) are reused, so only
+        those of new or replaced TUs are computed.
+        """
+        old_summaries = {id(s.tu): s for s in self.summaries}
+        summaries = [old_summaries.get(id(tu)) or TUSummary(tu)
+                     for tu in tus]
+
+        sourcefile_index = self.sourcefile_index.copy()
+        filenames = set(tu.filename for tu in tus)
+        for tu in self.tus:
+            if tu.filename not in filenames:
+                sourcefile_index.remove_tu(tu.filename)
+        for tu in tus:
+            if id(tu) not in old_summaries:
+                sourcefile_index.update_tu(tu)
+        sourcefile_index.set_order([tu.filename for tu in tus])
+
+        return RecordIndex(tus, summaries, sourcefile_index)
+
+    def get_loader_stats(self):
+        """
+        Get the statistics of the loading of TUs on demand (see
+        TULoader.get_stats), or None if they were all loaded up front.
+        """
+        return None
+
+    def get_search_index(self):
+        """
+        Get the SearchIndex over all of the records, building it if it
+        hasn't been built already, or None if searching isn't supported.
+        """
+        if self._search_index is None:
+            self._search_index = SearchIndex(self.get_records())
+        return self._search_index
+
+    def count_records(self, passname=None):
+        """
+        Get the number of records overall, or from the given pass.
+        """
+        if passname is None:
+            return self.count_all
+        return sum(s.passes[passname][2] for s in self.summaries
+                   if passname in s.passes)
+
+    def iter_per_tu_records(self, passname=None):
+        """
+        Get the sorted records of each TU (or just those from the given
+        pass), as a list of iterables.
+        """
+        if passname is None:
+            return [s.sorted_records for s in self.summaries]
+        return [(record for record in s.sorted_records
+                 if record.pass_ and record.pass_.name == passname)
+                for s in self.summaries if passname in s.passes]
+
+    def get_records(self, passname=None):
+        """
+        Get the list of all records (or just those from the given pass),
+        sorted by highest-count down to lowest-count.  Merging the per-TU
+        lists keeps ties in TU order.
+        """
+        if passname is None:
+            if self._records is None:
+                self._records = merge_top_k(self.iter_per_tu_records(), None,
+                                            record_sort_key)
+            return self._records
+        records = self._records_by_pass.get(passname)
+        if records is None:
+            records = [record for record in self.get_records()
+                       if record.pass_ and record.pass_.name == passname]
+            self._records_by_pass[passname] = records
+        return records
+
+    def iter_records(self, passname=None, start=0):
+        """
+        Iterate over all records (or just those from the given pass) in the
+        order of get_records, from position start onwards, without building
+        the whole list if it hasn't been built already.
+        """
+        if passname is None and self._records is not None:
+            records = self._records
+        elif passname is not None and passname in self._records_by_pass:
+            records = self._records_by_pass[passname]
+        else:
+            records = heapq.merge(*self.iter_per_tu_records(passname),
+                                  key=record_sort_key)
+        return itertools.islice(records, start, None)
+
+    def iter_matches(self, query, offset):
+        """
+        Generate (position, record) pairs for the records matching a
+        RecordQuery; see RecordQuery.iter_matches.
+        """
+        return query.filter_records(self.iter_records(query.passname, offset),
+                                    offset)
+
+    def get_hottest(self, k, passname=None):
+        """
+        Get the first k records in the order of get_records, merging just
+        the hottest records of each TU if the whole list hasn't been built.
+        """
+        if passname is None and self._records is not None:
+            return self._records[:k]
+        if passname is not None and passname in self._records_by_pass:
+            return self._records_by_pass[passname][:k]
+        return merge_top_k(self.iter_per_tu_records(passname), k,
+                           record_sort_key)
+
+    def get_range(self, start, end, passname=None):
+        """
+        Get the records from start up to end in the order of get_records.
+        """
+        if end <= MAX_TOP_K:
+            return self.get_hottest(end, passname)[start:]
+        return self.get_records(passname)[start:end]
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+# TODO: license
+"""
+Benchmarks, run against a synthetic build tree of optimization records.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from columns import RecordColumns
+from sourceindex import SourceFileIndex
+from utils import find_records, log
+
+PASSES = [
+    # (name, num, optgroups, type)
+    ('einline', 29, ['inline'], 'simple_ipa'),
+    ('inline', 70, ['inline'], 'ipa'),
+    ('cunrolli', 96, ['loop'], 'gimple'),
+    ('vect', 160, ['loop', 'vec'], 'gimple'),
+    ('slp', 172, ['vec'], 'gimple'),
+]
+
+MESSAGES = [
+    ('vect', 'success', ['loop vectorized using ', '16', ' byte vectors']),
+    ('vect', 'failure', ['couldn\'t vectorize loop']),
+    ('vect', 'failure', ['not vectorized: unsupported data-type ',
+                         {'expr': 'double'}]),
+    ('slp', 'success', ['basic block vectorized']),
+    ('einline', 'success', ['Inlining ', {'symtab_node': 'foo/1'},
+                            ' into ', {'symtab_node': 'bar/2'}, '.']),
+    ('inline', 'failure', ['not inlinable: ', {'symtab_node': 'bar/2'},
+                           ' -> ', {'symtab_node': 'foo/1'},
+                           ', function body not available']),
+    ('cunrolli', 'success', ['loop with ', '3', ' iterations completely'
+                             ' unrolled']),
+]
+
+def make_synthetic_tu(rng, tu_idx, src_file, num_records, num_lines):
+    """
+    Generate the JSON object for a synthetic TU, in the format emitted by
+    GCC's -fsave-optimization-record.
+    """
+    metadata = {'format': '1',
+                'generator': {'name': 'GNU C17',
+                              'pkgversion': '(GCC) ',
+                              'version': '9.0.0 20180601 (experimental)',
+                              'target': 'x86_64-pc-linux-gnu'}}
+    passes = []
+    pass_ids = {}
+    for i, (name, num, optgroups, type_) in enumerate(PASSES):
+        id_ = '0x%x' % (0x1000 + i)
+        pass_ids[name] = id_
+        passes.append({'id': id_, 'name': name, 'num': num,
+                       'optgroups': optgroups, 'type': type_})
+
+    def make_location():
+        return {'file': src_file,
+                'line': rng.randint(1, num_lines),
+                'column': rng.randint(1, 20)}
+
+    def make_record(function, depth):
+        passname, kind, message = rng.choice(MESSAGES)
+        record = {'kind': kind,
+                  'pass': pass_ids[passname],
+                  'function': function,
+                  'impl_location': {'file': '../../src/gcc/tree-vect-loop.c',
+                                    'line': rng.randint(1, 8000),
+                                    'function': 'vect_transform_loop'},
+                  'message': [item if isinstance(item, str)
+                              else dict(item, location=make_location())
+                              for item in message],
+                  'count': {'quality': rng.choice(['precise', 'guessed']),
+                            'value': rng.randint(0, 1 << 30)},
+                  'location': make_location(),
+                  'inlining_chain': [{'fndecl': function}]}
+        if depth < 2 and rng.random() < 0.2:
+            record['kind'] = 'scope'
+            record['children'] = [make_record(function, depth + 1)
+                                  for i in range(rng.randint(1, 4))]
+        return record
+
+    functions = ['fn_%i_%i' % (tu_idx, i) for i in range(20)]
+    records = [make_record(rng.choice(functions), 0)
+               for i in range(num_records)]
+    return [metadata, passes, records]
+
+def make_synthetic_build(build_dir, num_tus, records_per_tu, seed=0):
+    """
+    Populate build_dir with num_tus source files, each with a
+    .opt-record.json.gz file containing records_per_tu top-level records.
+    """
+    rng = random.Random(seed)
+    num_lines = 200
+    for tu_idx in range(num_tus):
+        subdir = os.path.join(build_dir, 'dir%i' % (tu_idx % 10))
+        os.makedirs(subdir, exist_ok=True)
+        src_file = os.path.join('dir%i' % (tu_idx % 10), 'tu%i.c' % tu_idx)
+        with open(os.path.join(build_dir, src_file), 'w') as f:
+            for line in range(num_lines):
+                f.write('int fn_%i_%i (int i) { return i * %i; }\n'
+                        % (tu_idx, line, line))
+        json_obj = make_synthetic_tu(rng, tu_idx, src_file, records_per_tu,
+                                     num_lines)
+        filename = os.path.join(build_dir, '%s.opt-record.json.gz' % src_file)
+        with gzip.open(filename, 'wt') as f:
+            json.dump(json_obj, f)
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def bench_load(build_dir, args):
+    """
+    Compare serial and parallel loading of the records in build_dir.
+    """
+    tus, serial_time = timed(find_records, build_dir)
+    num_records = sum(tu.count_all_records() for tu in tus)
+    del tus
+    tus, parallel_time = timed(find_records, build_dir, args.jobs)
+    del tus
+    log('load: %i records' % num_records)
+    log(' serial:           %8.3fs' % serial_time)
+    log(' parallel (%3i jobs): %8.3fs (%.2fx)'
+        % (args.jobs, parallel_time, serial_time / parallel_time))
+
+def bench_cache(build_dir, args):
+    """
+    Compare loading the records in build_dir with a cold and a warm
+    RecordCache.
+    """
+    cache_dir = tempfile.mkdtemp()
+    try:
+        tus, uncached_time = timed(find_records, build_dir)
+        del tus
+        tus, cold_time = timed(find_records, build_dir, None, cache_dir)
+        del tus
+        tus, warm_time = timed(find_records, build_dir, None, cache_dir)
+        del tus
+    finally:
+        shutil.rmtree(cache_dir)
+    log('cache:')
+    log(' no cache:   %8.3fs' % uncached_time)
+    log(' cold cache: %8.3fs' % cold_time)
+    log(' warm cache: %8.3fs (%.2fx)' % (warm_time, uncached_time / warm_time))
+
+def bench_memory(build_dir, args):
+    """
+    Report the memory used by the loaded records in build_dir.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tus = find_records(build_dir)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    num_records = sum(tu.count_all_records() for tu in tus)
+    json_size = sum(tu.size for tu in tus)
+    log('memory: %i records' % num_records)
+    log(' decompressed JSON: %10i bytes (%6.1f bytes/record)'
+        % (json_size, json_size / num_records))
+    log(' loaded model:      %10i bytes (%6.1f bytes/record)'
+        % (used, used / num_records))
+
+def bench_render(build_dir, args):
+    """
+    Report the rate at which the static report writes the rows of
+    index.html and of the per-source-file pages, excluding the time spent
+    loading records and highlighting source files.
+    """
+    import static
+    from highlight import Highlighter
+
+    tus = find_records(build_dir)
+    static.filter_records(tus)
+    highest_count = RecordColumns(tus).highest_count(toplevel_only=True)
+    sourcefile_index = SourceFileIndex(tus)
+    src_files = sourcefile_index.get_sourcefiles()
+    highlighter = Highlighter(max_entries=len(src_files))
+    num_source_rows = 0
+    for src_file in src_files:
+        with open(os.path.join(build_dir, src_file)) as f:
+            code = f.read()
+        num_source_rows += (len(highlighter.get_html_lines(src_file, code))
+                            + len(sourcefile_index.get_records(src_file)))
+    num_index_rows = sum(tu.count_all_records() for tu in tus)
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        _, index_time = timed(static.make_index_html, out_dir, tus,
+                              highest_count)
+        _, source_time = timed(static.make_per_source_file_html, build_dir,
+                               out_dir, sourcefile_index, highest_count,
+                               highlighter)
+    finally:
+        shutil.rmtree(out_dir)
+    log('render:')
+    log(' index.html:        %8i rows in %8.3fs (%10.0f rows/s)'
+        % (num_index_rows, index_time, num_index_rows / index_time))
+    log(' source file pages: %8i rows in %8.3fs (%10.0f rows/s)'
+        % (num_source_rows, source_time, num_source_rows / source_time))
+
+BENCHMARKS = {'cache': bench_cache,
+              'load': bench_load,
+              'memory': bench_memory,
+              'render': bench_render}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark opt-viewer on'
+                                     ' a synthetic build tree.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--num-tus', dest='num_tus', type=int, default=200)
+    parser.add_argument('--records-per-tu', dest='records_per_tu', type=int,
+                        default=500)
+    parser.add_argument('--jobs', dest='jobs', type=int,
+                        default=os.cpu_count())
+    parser.add_argument('--build-dir', dest='build_dir', type=str,
+                        help=('Directory for the synthetic build tree'
+                              ' (reused if it already exists)'))
+    args = parser.parse_args()
+
+    if args.build_dir:
+        build_dir = args.build_dir
+        if not os.path.exists(build_dir):
+            make_synthetic_build(build_dir, args.num_tus, args.records_per_tu)
+        BENCHMARKS[args.benchmark](build_dir, args)
+    else:
+        build_dir = tempfile.mkdtemp()
+        try:
+            make_synthetic_build(build_dir, args.num_tus, args.records_per_tu)
+            BENCHMARKS[args.benchmark](build_dir, args)
+        finally:
+            shutil.rmtree(build_dir)
+
+if __name__ == '__main__':
+    main()
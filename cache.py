@@ -0,0 +1,74 @@
+# TODO: license
+import hashlib
+import marshal
+import os
+import tempfile
+
+from optrecord import COMPACT_FORMAT_VERSION
+
+# Version number for the layout of the cache files themselves; bump this
+# whenever it changes.
+CACHE_FORMAT_VERSION = 1
+
+def write_atomically(path, data):
+    """
+    Write bytes to path via a temporary file, so that readers never see a
+    partially-written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+class RecordCache:
+    """
+    On-disk cache of parsed TranslationUnits.
+
+    Each .opt-record.json.gz file has an entry holding its TranslationUnit
+    in marshalled compact form (see TranslationUnit.to_compact), preceded
+    by a key built from the file's path, mtime and size, and the format
+    versions.  An entry is only used if its key matches the current state
+    of the file.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, filename):
+        st = os.stat(filename)
+        return (CACHE_FORMAT_VERSION, COMPACT_FORMAT_VERSION,
+                os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+
+    def get_entry_path(self, filename):
+        digest = hashlib.sha1(os.path.abspath(filename).encode('utf-8'))
+        return os.path.join(self.cache_dir, digest.hexdigest() + '.marshal')
+
+    def load(self, filename):
+        """
+        Get the compact form of the TranslationUnit for filename, or None
+        if there isn't a valid entry for it.
+        """
+        key = self.get_key(filename)
+        try:
+            with open(self.get_entry_path(filename), 'rb') as f:
+                # Check the key before reading the (much larger) body.
+                if marshal.load(f) != key:
+                    return None
+                # (marshal.load on a file does many small reads, which is
+                # far slower than reading it all in one go)
+                return marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, filename, key, compact):
+        """
+        Store the compact form of the TranslationUnit for filename, where
+        key is the result of get_key from before filename was read.
+        """
+        # (so that concurrent readers never see a partially-written entry)
+        write_atomically(self.get_entry_path(filename),
+                         marshal.dumps(key) + marshal.dumps(compact))
@@ -0,0 +1,200 @@
+# TODO: license
+import hashlib
+
+from optrecord import Expr, Stmt, SymtabNode
+from utils import get_effective_result
+
+# What replaces each kind of non-string message item within a template
+PLACEHOLDERS = {Expr: '<expr>',
+                Stmt: '<stmt>',
+                SymtabNode: '<symtab_node>'}
+
+def get_message_template(record):
+    """
+    Get the message of record with its expressions, statements and symbol
+    table nodes replaced by placeholders, so that e.g. every "missed: not
+    inlinable: X/Y, function body not available" has the same template.
+    """
+    return ''.join([item if isinstance(item, str)
+                    else PLACEHOLDERS[type(item)]
+                    for item in record.message])
+
+def get_template_key(passname, template):
+    """
+    Get the key for the cluster of records with the given pass and
+    template: a 64-bit hash, which is cheaper to hold and compare than the
+    template itself, and the same in every process (unlike hash()).
+    """
+    data = ('%s\0%s' % (passname or '', template)).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'little')
+
+class MessageCluster:
+    """
+    Aggregate data about the records from one pass with the same message
+    template.
+    """
+    def __init__(self, passname, template):
+        self.passname = passname
+        self.template = template
+        self.count = 0
+        # The sum of the execution counts of the records
+        self.hotness = 0
+        self.num_successes = 0
+        self.num_failures = 0
+        # Mapping of function name to [number of records, hotness]
+        self.functions = {}
+
+    @property
+    def success_ratio(self):
+        """
+        The fraction of the records with a result that succeeded, or None
+        if none have one.
+        """
+        total = self.num_successes + self.num_failures
+        if not total:
+            return None
+        return self.num_successes / total
+
+    def get_hottest_functions(self, k):
+        """
+        Get the k hottest functions, as a list of
+        [name, number of records, hotness].
+        """
+        return sorted(([name] + counts
+                       for name, counts in self.functions.items()),
+                      key=lambda f: -f[2])[:k]
+
+    def to_compact(self):
+        return (self.passname, self.template, self.count, self.hotness,
+                self.num_successes, self.num_failures,
+                tuple((name, n, hotness)
+                      for name, (n, hotness) in self.functions.items()))
+
+    @staticmethod
+    def from_compact(compact):
+        (passname, template, count, hotness, num_successes, num_failures,
+         functions) = compact
+        cluster = MessageCluster(passname, template)
+        cluster.count = count
+        cluster.hotness = hotness
+        cluster.num_successes = num_successes
+        cluster.num_failures = num_failures
+        cluster.functions = {name: [n, hotness]
+                             for name, n, hotness in functions}
+        return cluster
+
+    def merge(self, other):
+        """
+        Update this cluster with the data from other, for the same pass and
+        template.
+        """
+        self.count += other.count
+        self.hotness += other.hotness
+        self.num_successes += other.num_successes
+        self.num_failures += other.num_failures
+        for name, (n, hotness) in other.functions.items():
+            counts = self.functions.get(name)
+            if counts is None:
+                self.functions[name] = [n, hotness]
+            else:
+                counts[0] += n
+                counts[1] += hotness
+
+# The ways of sorting clusters, as a mapping of name to (sort key,
+# whether the highest values come first)
+CLUSTER_SORT_KEYS = {
+    'hotness': (lambda c: c.hotness, True),
+    'count': (lambda c: c.count, True),
+    'functions': (lambda c: len(c.functions), True),
+    'success_ratio': (lambda c: (c.success_ratio is not None,
+                                 c.success_ratio or 0.0), True),
+    'pass': (lambda c: c.passname or '', False),
+    'template': (lambda c: c.template, False),
+}
+
+class MessageClusters:
+    """
+    The records of some TranslationUnits, grouped by pass and message
+    template into MessageClusters.
+
+    Records are added in a single pass over them (see add_records), with
+    only the clusters themselves being held; the clusters of separately
+    processed TUs can be combined via to_compact and merge_compact.
+    """
+    def __init__(self):
+        # Mapping of get_template_key to MessageCluster
+        self.clusters = {}
+        # Mapping of (passname, template) to MessageCluster, so that each
+        # key is only hashed once
+        self._by_template = {}
+
+    def get_cluster(self, passname, template):
+        key = get_template_key(passname, template)
+        cluster = self.clusters.get(key)
+        if cluster is None:
+            cluster = self.clusters[key] = MessageCluster(passname, template)
+        self._by_template[(passname, template)] = cluster
+        return cluster
+
+    def add_records(self, records):
+        by_template = self._by_template
+        for record in records:
+            passname = record.pass_.name if record.pass_ else None
+            template = get_message_template(record)
+            cluster = by_template.get((passname, template))
+            if cluster is None:
+                cluster = self.get_cluster(passname, template)
+            value = record.count.value if record.count else 0
+            cluster.count += 1
+            cluster.hotness += value
+            result = get_effective_result(record)
+            if result == 'success':
+                cluster.num_successes += 1
+            elif result == 'failure':
+                cluster.num_failures += 1
+            if record.function is not None:
+                counts = cluster.functions.get(record.function)
+                if counts is None:
+                    cluster.functions[record.function] = [1, value]
+                else:
+                    counts[0] += 1
+                    counts[1] += value
+
+    @staticmethod
+    def from_tus(tus):
+        clusters = MessageClusters()
+        for tu in tus:
+            clusters.add_records(tu.iter_all_records())
+        return clusters
+
+    def to_compact(self):
+        return tuple((key, cluster.to_compact())
+                     for key, cluster in self.clusters.items())
+
+    def merge_compact(self, compact):
+        """
+        Add the clusters from the to_compact form of another
+        MessageClusters.
+        """
+        for key, cluster_compact in compact:
+            cluster = MessageCluster.from_compact(cluster_compact)
+            if key not in self.clusters:
+                self.clusters[key] = cluster
+            else:
+                self.clusters[key].merge(cluster)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def get_sorted(self, sort='hotness'):
+        """
+        Get the list of clusters, sorted by one of CLUSTER_SORT_KEYS (and
+        then by hotness).
+        """
+        key, reverse = CLUSTER_SORT_KEYS[sort]
+        clusters = sorted(self.clusters.values(), key=lambda c: -c.hotness)
+        # (the sort is stable, so ties stay hottest first)
+        if reverse:
+            return sorted(clusters, key=key, reverse=True)
+        return sorted(clusters, key=key)
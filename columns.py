@@ -0,0 +1,199 @@
+# TODO: license
+from array import array
+from collections import Counter
+from itertools import compress
+import operator
+
+class StringTable:
+    """A list of distinct strings, with a mapping back to their indices"""
+    def __init__(self):
+        self.strings = []
+        self.index_by_string = {}
+
+    def get_index(self, s):
+        """
+        Get the index of s, adding it if necessary.  None has index -1.
+        """
+        if s is None:
+            return -1
+        idx = self.index_by_string.get(s)
+        if idx is None:
+            idx = self.index_by_string[s] = len(self.strings)
+            self.strings.append(s)
+        return idx
+
+    def get_string(self, idx):
+        if idx == -1:
+            return None
+        return self.strings[idx]
+
+    def __len__(self):
+        return len(self.strings)
+
+PRECISE_QUALITIES = ('precise', 'adjusted')
+
+class RecordColumns:
+    """
+    Struct-of-arrays representation of all of the records within a list
+    of TranslationUnits, for whole-build analytics.
+
+    Row i describes self.records[i]; the records are in the order of
+    TranslationUnit.iter_all_records, TU by TU.  Each column is a typed
+    array; strings are held as indices into StringTables, with -1 for None.
+    Records without a count have a count_value of 0 and a count_quality of
+    -1; records without a location have file, line and column of -1.
+    """
+    def __init__(self, tus):
+        self.tus = tus
+        self.kinds = StringTable()
+        self.passes = StringTable()
+        self.functions = StringTable()
+        self.files = StringTable()
+        self.qualities = StringTable()
+
+        self.records = []
+        self.tu_idx = array('i')
+        self.kind = array('b')
+        self.pass_id = array('i')
+        self.function_id = array('i')
+        self.file_id = array('i')
+        self.line = array('i')
+        self.column = array('i')
+        self.count_value = array('q')
+        self.count_quality = array('b')
+        self.depth = array('i')
+        self.parent = array('i')
+
+        for tu_idx, tu in enumerate(tus):
+            # The row of the latest record at each depth, and so of the
+            # parent of the next record one level deeper (as the records
+            # are visited in pre-order)
+            rows_by_depth = []
+            for record, depth, parent in tu.walk():
+                del rows_by_depth[depth:]
+                rows_by_depth.append(len(self.records))
+                self._add_record(record, tu_idx,
+                                 rows_by_depth[-2] if depth else -1)
+
+    def _add_record(self, record, tu_idx, parent):
+        self.records.append(record)
+        self.tu_idx.append(tu_idx)
+        self.kind.append(self.kinds.get_index(record.kind))
+        if record.pass_:
+            self.pass_id.append(self.passes.get_index(record.pass_.name))
+        else:
+            self.pass_id.append(-1)
+        self.function_id.append(self.functions.get_index(record.function))
+        loc = record.location
+        if loc:
+            self.file_id.append(self.files.get_index(loc.file))
+            self.line.append(loc.line)
+            self.column.append(loc.column)
+        else:
+            self.file_id.append(-1)
+            self.line.append(-1)
+            self.column.append(-1)
+        count = record.count
+        if count:
+            self.count_value.append(count.value)
+            self.count_quality.append(self.qualities.get_index(count.quality))
+        else:
+            self.count_value.append(0)
+            self.count_quality.append(-1)
+        self.depth.append(record.depth)
+        self.parent.append(parent)
+
+    def __len__(self):
+        return len(self.records)
+
+    def toplevel_mask(self):
+        """Get an iterator of bools: is each record top-level?"""
+        return map(operator.not_, self.depth)
+
+    def precise_mask(self):
+        """Get an iterator of bools: does each record have a precise count?"""
+        precise_ids = set(self.qualities.get_index(q)
+                          for q in PRECISE_QUALITIES
+                          if q in self.qualities.index_by_string)
+        return map(precise_ids.__contains__, self.count_quality)
+
+    def get_mask(self, toplevel_only=False, precise_only=False):
+        """
+        Get an iterator of bools for which records meet the given criteria,
+        or None if there aren't any criteria.
+        """
+        masks = []
+        if toplevel_only:
+            masks.append(self.toplevel_mask())
+        if precise_only:
+            masks.append(self.precise_mask())
+        if not masks:
+            return None
+        if len(masks) == 1:
+            return masks[0]
+        return map(operator.and_, *masks)
+
+    def select(self, column, toplevel_only=False, precise_only=False):
+        """
+        Get an iterator over the values of column for the records that
+        meet the given criteria.
+        """
+        mask = self.get_mask(toplevel_only, precise_only)
+        if mask is None:
+            return iter(column)
+        return compress(column, mask)
+
+    def count_records_by_pass(self, toplevel_only=False):
+        """
+        Get a Counter of pass name to the number of records from that pass,
+        excluding records without a pass.
+        """
+        counts = Counter(self.select(self.pass_id, toplevel_only))
+        counts.pop(-1, None)
+        return Counter({self.passes.get_string(pass_id): n
+                        for pass_id, n in counts.items()})
+
+    def count_records_by_file(self, toplevel_only=False):
+        """
+        Get a Counter of source file to the number of records located within
+        that file, excluding records without a location.
+        """
+        counts = Counter(self.select(self.file_id, toplevel_only))
+        counts.pop(-1, None)
+        return Counter({self.files.get_string(file_id): n
+                        for file_id, n in counts.items()})
+
+    def have_any_precise_counts(self, toplevel_only=False):
+        return any(self.get_mask(toplevel_only, True))
+
+    def non_precise_mask(self):
+        """
+        Get an iterator of bools: does each record have a count that isn't
+        precise?
+        """
+        has_count = map((-1).__ne__, self.count_quality)
+        return map(operator.gt, has_count, self.precise_mask())
+
+    def count_non_precise_counts(self, toplevel_only=False):
+        """
+        Get the number of records that have a count, but not a precise one.
+        """
+        return sum(self.select(self.non_precise_mask(), toplevel_only))
+
+    def highest_count(self, toplevel_only=False, precise_only=False):
+        return max(self.select(self.count_value, toplevel_only, precise_only),
+                   default=0)
+
+    def max_count_by_function(self):
+        """
+        Get a dict of function name to the highest count of any record
+        within that function, excluding records without a function.
+        """
+        highest = {}
+        get = highest.get
+        for function_id, value in zip(self.function_id, self.count_value):
+            if value > get(function_id, -1):
+                highest[function_id] = value
+        highest.pop(-1, None)
+        return {self.functions.get_string(function_id): value
+                for function_id, value in highest.items()}
@@ -0,0 +1,661 @@
+# TODO: license
+import copy
+import os
+import sqlite3
+import threading
+import urllib.request
+
+from aggregates import Function, TUSummary
+from optrecord import (COMPACT_FORMAT_VERSION, Item, Location, Record,
+                       TranslationUnit)
+from sourceindex import SourceFileIndex, group_by_line
+from utils import gc_disabled, iter_tus, log
+
+# Version number for the schema; bump this whenever it changes.
+DB_FORMAT_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value);
+
+CREATE TABLE tus (id INTEGER PRIMARY KEY, filename TEXT NOT NULL,
+                  size INTEGER, format TEXT, generator_name TEXT,
+                  generator_pkgversion TEXT, generator_version TEXT,
+                  generator_target TEXT, num_toplevel_records INTEGER,
+                  num_records INTEGER);
+
+CREATE TABLE pass_names (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+
+-- The pass tree of each TU; pass_key is the compiler's id for the pass
+CREATE TABLE passes (id INTEGER PRIMARY KEY, tu_id INTEGER NOT NULL,
+                     parent_id INTEGER, pass_key TEXT, name_id INTEGER,
+                     num INTEGER, type TEXT, optgroups TEXT);
+
+CREATE TABLE locations (id INTEGER PRIMARY KEY, file TEXT NOT NULL,
+                        line INTEGER, column INTEGER,
+                        UNIQUE (file, line, column));
+
+CREATE TABLE impl_locations (id INTEGER PRIMARY KEY, file TEXT NOT NULL,
+                             line INTEGER, function TEXT,
+                             UNIQUE (file, line, function));
+
+CREATE TABLE counts (id INTEGER PRIMARY KEY, quality TEXT NOT NULL,
+                     value INTEGER, UNIQUE (quality, value));
+
+-- Records of all depths; the records of each TU have consecutive ids and
+-- seqs in pre-order, so the descendants of a record are the
+-- num_descendants records following it.  count_value is that of the count
+-- (or 0), for sorting; rank is the position in hotness order overall, and
+-- pass_rank that among the records from the same pass.
+CREATE TABLE records (id INTEGER PRIMARY KEY, tu_id INTEGER NOT NULL,
+                      seq INTEGER NOT NULL, parent_id INTEGER,
+                      depth INTEGER NOT NULL, num_descendants INTEGER NOT NULL,
+                      kind TEXT NOT NULL, pass_id INTEGER,
+                      pass_name_id INTEGER, function TEXT,
+                      impl_location_id INTEGER, location_id INTEGER,
+                      count_id INTEGER, count_value INTEGER NOT NULL,
+                      has_inlining_chain INTEGER NOT NULL,
+                      rank INTEGER, pass_rank INTEGER);
+
+-- The items of each record's message: item_kind is NULL for plain text,
+-- or an index into optrecord.ITEM_CLASSES
+CREATE TABLE messages (record_id INTEGER NOT NULL, seq INTEGER NOT NULL,
+                       item_kind INTEGER, text TEXT, location_id INTEGER,
+                       PRIMARY KEY (record_id, seq)) WITHOUT ROWID;
+
+CREATE TABLE inlining_chains (record_id INTEGER NOT NULL,
+                              seq INTEGER NOT NULL, fndecl TEXT,
+                              site_location_id INTEGER,
+                              PRIMARY KEY (record_id, seq)) WITHOUT ROWID;
+
+-- Per-TU counts of records by pass and by source file, as in TUSummary
+CREATE TABLE tu_passes (tu_id INTEGER NOT NULL, name TEXT NOT NULL,
+                        num_toplevel_records INTEGER, num_records INTEGER);
+CREATE TABLE tu_sourcefiles (tu_id INTEGER NOT NULL, file TEXT NOT NULL,
+                             num_toplevel_records INTEGER,
+                             num_records INTEGER);
+
+-- As in RecordIndex.functions; position is the order of first appearance
+CREATE TABLE functions (position INTEGER PRIMARY KEY, name TEXT NOT NULL,
+                        sourcefile TEXT, hotness INTEGER, tu TEXT,
+                        peak_location_id INTEGER,
+                        peak_location_hotness INTEGER);
+'''
+
+# Created once the records have been ranked
+INDEXES = '''
+CREATE INDEX records_rank ON records (rank);
+CREATE INDEX records_pass ON records (pass_name_id, pass_rank);
+CREATE INDEX records_function ON records (function, rank);
+CREATE INDEX records_location ON records (location_id);
+CREATE INDEX records_count ON records (count_value);
+CREATE INDEX passes_tu ON passes (tu_id);
+'''
+
+RANK_RECORDS = '''
+UPDATE records SET rank = ranked.rank, pass_rank = ranked.pass_rank
+FROM (SELECT id,
+             ROW_NUMBER() OVER (ORDER BY count_value DESC, tu_id, seq) - 1
+               AS rank,
+             ROW_NUMBER() OVER (PARTITION BY pass_name_id
+                                ORDER BY count_value DESC, tu_id, seq) - 1
+               AS pass_rank
+      FROM records) AS ranked
+WHERE records.id = ranked.id
+'''
+
+# The number of TUs written within each transaction when ingesting
+TUS_PER_TRANSACTION = 16
+
+############################################################################
+# Ingest
+
+class Ingester:
+    """
+    Writes TranslationUnits into a new database, assigning all ids here
+    (so that each TU's rows can be written in a few executemany calls).
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.num_tus = 0
+        self.num_records = 0
+        self.num_passes = 0
+        # Mappings of value to id for the deduplicated tables
+        self.location_ids = {}
+        self.impl_location_ids = {}
+        self.count_ids = {}
+        self.pass_name_ids = {}
+        # The functions, merged as in RecordIndex, in order of appearance
+        self.functions = {}
+
+    def get_id(self, ids, table, columns, key):
+        """
+        Get the id for key within the deduplicated table, adding it if it's
+        new.
+        """
+        result = ids.get(key)
+        if result is None:
+            result = ids[key] = len(ids) + 1
+            self.conn.execute('INSERT INTO %s (id, %s) VALUES (?%s)'
+                              % (table, columns, ', ?' * len(key)),
+                              (result,) + key)
+        return result
+
+    def get_location_id(self, loc):
+        if loc is None:
+            return None
+        return self.get_id(self.location_ids, 'locations',
+                           'file, line, column', loc.to_compact())
+
+    def get_impl_location_id(self, impl_loc):
+        if impl_loc is None:
+            return None
+        return self.get_id(self.impl_location_ids, 'impl_locations',
+                           'file, line, function', impl_loc.to_compact())
+
+    def get_count_id(self, count):
+        if count is None:
+            return None
+        return self.get_id(self.count_ids, 'counts', 'quality, value',
+                           count.to_compact())
+
+    def get_pass_name_id(self, name):
+        return self.get_id(self.pass_name_ids, 'pass_names', 'name', (name,))
+
+    def add_passes(self, tu_id, passes, parent_id, pass_ids):
+        for p in passes:
+            self.num_passes += 1
+            pass_id = pass_ids[p.id_] = self.num_passes
+            self.conn.execute('INSERT INTO passes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (pass_id, tu_id, parent_id, p.id_,
+                               self.get_pass_name_id(p.name), p.num, p.type,
+                               ','.join(sorted(p.optgroups))))
+            self.add_passes(tu_id, p.children, pass_id, pass_ids)
+
+    def add_tu(self, tu):
+        self.num_tus += 1
+        tu_id = self.num_tus
+        summary = TUSummary(tu)
+        g = tu.generator
+        self.conn.execute('INSERT INTO tus VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (tu_id, tu.filename, tu.size, tu.format, g.name,
+                           g.pkgversion, g.version, g.target,
+                           summary.num_toplevel_records,
+                           summary.num_all_records))
+        self.conn.executemany('INSERT INTO tu_passes VALUES (?, ?, ?, ?)',
+                              [(tu_id,) + tuple(counts)
+                               for counts in summary.passes.values()])
+        self.conn.executemany('INSERT INTO tu_sourcefiles VALUES (?, ?, ?, ?)',
+                              [(tu_id,) + tuple(counts)
+                               for counts in summary.sourcefiles.values()])
+        for funcname, f in summary.functions.items():
+            if funcname not in self.functions:
+                self.functions[funcname] = f.copy()
+            else:
+                self.functions[funcname].merge(f)
+
+        # Mapping of the compiler's pass id to the id of its row
+        pass_ids = {}
+        self.add_passes(tu_id, tu.passes, None, pass_ids)
+
+        records = []
+        messages = []
+        inlining_chains = []
+        # Mapping of id(record) to the index of its row within records
+        rows_by_record = {}
+        first_id = self.num_records + 1
+        for seq, (record, depth, parent) in enumerate(tu.walk()):
+            record_id = first_id + seq
+            rows_by_record[id(record)] = seq
+            pass_ = record.pass_
+            count = record.count
+            records.append([record_id, tu_id, seq,
+                            (first_id + rows_by_record[id(parent)]
+                             if parent is not None else None),
+                            depth, 0, record.kind,
+                            pass_ids[pass_.id_] if pass_ else None,
+                            (self.get_pass_name_id(pass_.name)
+                             if pass_ else None),
+                            record.function,
+                            self.get_impl_location_id(record.impl_location),
+                            self.get_location_id(record.location),
+                            self.get_count_id(count),
+                            count.value if count else 0,
+                            record.inlining_chain is not None])
+            for i, item in enumerate(record.message):
+                if isinstance(item, str):
+                    messages.append((record_id, i, None, item, None))
+                else:
+                    item_kind, text, _ = Item.to_compact(item)
+                    messages.append((record_id, i, item_kind, text,
+                                     self.get_location_id(item.location)))
+            for i, node in enumerate(record.inlining_chain or ()):
+                inlining_chains.append((record_id, i, node.fndecl,
+                                        self.get_location_id(node.site)))
+        self.num_records += len(records)
+
+        # Count the descendants, visiting children before their parents
+        for row in reversed(records):
+            if row[3] is not None:
+                records[row[3] - first_id][5] += 1 + row[5]
+
+        self.conn.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?,'
+                              ' ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)',
+                              records)
+        self.conn.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)',
+                              messages)
+        self.conn.executemany('INSERT INTO inlining_chains'
+                              ' VALUES (?, ?, ?, ?)', inlining_chains)
+
+    def finish(self):
+        """
+        Write the functions, rank the records and create the indexes.
+        """
+        self.conn.executemany(
+            'INSERT INTO functions VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(position, f.name, f.sourcefile, f.hotness, f.tu,
+              self.get_location_id(f.peak_location), f.peak_location_hotness)
+             for position, f in enumerate(self.functions.values())])
+        self.conn.execute(RANK_RECORDS)
+        # (executescript would commit the current transaction)
+        for statement in INDEXES.split(';'):
+            self.conn.execute(statement)
+
+def ingest(filenames, db_path, jobs=None, cache_dir=None):
+    """
+    Load the given .opt-record.json.gz files into a new database at
+    db_path, replacing any existing one once complete.
+    """
+    log('ingest: %i files into %r' % (len(filenames), db_path))
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    conn = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        # (the database is only renamed into place once complete, so
+        # there's no need for a journal)
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.executescript(SCHEMA)
+        conn.execute("INSERT INTO meta VALUES ('version', ?)",
+                     (DB_FORMAT_VERSION,))
+        ingester = Ingester(conn)
+        with gc_disabled():
+            conn.execute('BEGIN')
+            for tu in iter_tus(filenames, jobs, cache_dir):
+                ingester.add_tu(tu)
+                if ingester.num_tus % TUS_PER_TRANSACTION == 0:
+                    conn.execute('COMMIT')
+                    conn.execute('BEGIN')
+            ingester.finish()
+            conn.execute('COMMIT')
+        log(' %i TUs, %i records' % (ingester.num_tus, ingester.num_records))
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+
+############################################################################
+# Queries
+
+class DatabaseTU:
+    """The summary of a TranslationUnit within a database"""
+    def __init__(self, id_, filename, size, num_toplevel_records,
+                 num_all_records):
+        self.id_ = id_
+        self.filename = filename
+        self.size = size
+        self.num_toplevel_records = num_toplevel_records
+        self.num_all_records = num_all_records
+
+    def __repr__(self):
+        return 'DatabaseTU(%r)' % self.filename
+
+    def count_toplevel_records(self):
+        return self.num_toplevel_records
+
+    def count_all_records(self):
+        return self.num_all_records
+
+# The columns of a record (and of its descendants) needed to rebuild it
+RECORD_COLUMNS = '''
+SELECT r.id, r.depth, r.kind, p.pass_key, r.function,
+       i.file, i.line, i.function, c.quality, c.value,
+       l.file, l.line, l.column, r.has_inlining_chain
+FROM records r
+LEFT JOIN passes p ON p.id = r.pass_id
+LEFT JOIN impl_locations i ON i.id = r.impl_location_id
+LEFT JOIN counts c ON c.id = r.count_id
+LEFT JOIN locations l ON l.id = r.location_id
+'''
+
+# The columns of the rows selecting top-level records to rebuild
+ROOT_COLUMNS = 'r.id, r.tu_id, r.num_descendants'
+
+def get_location_compact(file_, line, column):
+    if file_ is None:
+        return None
+    return (file_, line, column)
+
+class DatabaseIndex:
+    """
+    The equivalent of a RecordIndex for a database written by ingest,
+    with the records being selected (in hotness order, with any filtering)
+    by indexed queries, and only rebuilt as needed.
+
+    Each thread has its own connection.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        conn = self.get_connection()
+
+        version = conn.execute("SELECT value FROM meta"
+                               " WHERE key = 'version'").fetchone()
+        if version is None or version[0] != DB_FORMAT_VERSION:
+            raise ValueError('%r has an unsupported format; re-run ingest'
+                             % db_path)
+
+        self.summaries = [DatabaseTU(*row) for row in conn.execute(
+            'SELECT id, filename, size, num_toplevel_records, num_records'
+            ' FROM tus ORDER BY id')]
+        self.tus = self.summaries
+        self.total_size = sum(s.size for s in self.summaries)
+        self.count_top_level = sum(s.num_toplevel_records
+                                   for s in self.summaries)
+        self.count_all = sum(s.num_all_records for s in self.summaries)
+
+        self.passes = [list(row) for row in conn.execute(
+            'SELECT name, SUM(num_toplevel_records), SUM(num_records)'
+            ' FROM tu_passes GROUP BY name ORDER BY name')]
+        self.sourcefiles = [list(row) for row in conn.execute(
+            'SELECT file, SUM(num_toplevel_records), SUM(num_records)'
+            ' FROM tu_sourcefiles GROUP BY file ORDER BY file')]
+        self.pass_name_ids = dict(conn.execute(
+            'SELECT name, id FROM pass_names'))
+
+        self.functions = []
+        for (name, sourcefile, hotness, tu, file_, line, column,
+             peak_location_hotness) in conn.execute(
+                 'SELECT f.name, f.sourcefile, f.hotness, f.tu,'
+                 ' l.file, l.line, l.column, f.peak_location_hotness'
+                 ' FROM functions f'
+                 ' LEFT JOIN locations l ON l.id = f.peak_location_id'
+                 ' ORDER BY f.hotness DESC, f.position'):
+            peak_location = self.get_location(
+                get_location_compact(file_, line, column))
+            self.functions.append(Function(name, sourcefile, hotness, tu,
+                                           peak_location,
+                                           peak_location_hotness))
+
+        self.sourcefile_index = DatabaseSourceFileIndex(self)
+
+        # Mapping of tu id to a TranslationUnit holding just its passes,
+        # for rebuilding its records
+        self._tus_by_id = {}
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(
+                'file:%s?mode=ro'
+                % urllib.request.pathname2url(os.path.abspath(self.db_path)),
+                uri=True)
+        return conn
+
+    def get_location(self, compact):
+        if compact is None:
+            return None
+        # (a TranslationUnit isn't needed just for sharing Locations)
+        loc = Location.__new__(Location)
+        loc.file, loc.line, loc.column = compact
+        return loc
+
+    def get_loader_stats(self):
+        return None
+
+    def get_search_index(self):
+        # (indexing the messages would mean loading every record)
+        return None
+
+    def get_tu(self, tu_id):
+        """
+        Get a TranslationUnit with the metadata and passes (but not the
+        records) of the TU with the given id.
+        """
+        with self.lock:
+            tu = self._tus_by_id.get(tu_id)
+        if tu is not None:
+            return tu
+        conn = self.get_connection()
+        (filename, size, format_, name, pkgversion, version,
+         target) = conn.execute(
+             'SELECT filename, size, format, generator_name,'
+             ' generator_pkgversion, generator_version, generator_target'
+             ' FROM tus WHERE id = ?', (tu_id,)).fetchone()
+        # Rebuild the compact form of the pass tree
+        passes = {}
+        roots = []
+        for (pass_id, parent_id, pass_key, pass_name, num, type_,
+             optgroups) in conn.execute(
+                 'SELECT p.id, p.parent_id, p.pass_key, n.name, p.num,'
+                 ' p.type, p.optgroups FROM passes p'
+                 ' JOIN pass_names n ON n.id = p.name_id'
+                 ' WHERE p.tu_id = ? ORDER BY p.id', (tu_id,)):
+            passes[pass_id] = (pass_key, pass_name, num,
+                               tuple(optgroups.split(',')) if optgroups else (),
+                               type_, [])
+            if parent_id is None:
+                roots.append(passes[pass_id])
+            else:
+                passes[parent_id][5].append(passes[pass_id])
+        tu = TranslationUnit.from_compact(
+            (COMPACT_FORMAT_VERSION, filename, size, format_,
+             (name, pkgversion, version, target), roots, ()))
+        with self.lock:
+            self._tus_by_id[tu_id] = tu
+        return tu
+
+    def load_records(self, roots):
+        """
+        Rebuild the records (with their descendants) for a list of rows of
+        ROOT_COLUMNS, returning a list of (tu, record) pairs.
+        """
+        conn = self.get_connection()
+        result = []
+        # Mapping of tu_id to a copy of the TU with its own shared_objects
+        # (see TranslationUnit.__init__), as the TUs from get_tu are shared
+        # between threads, and would otherwise keep the objects of every
+        # record ever loaded
+        builders = {}
+        for record_id, tu_id, num_descendants in roots:
+            last_id = record_id + num_descendants
+            messages = {}
+            for (msg_record_id, item_kind, text, file_, line,
+                 column) in conn.execute(
+                     'SELECT m.record_id, m.item_kind, m.text,'
+                     ' l.file, l.line, l.column FROM messages m'
+                     ' LEFT JOIN locations l ON l.id = m.location_id'
+                     ' WHERE m.record_id BETWEEN ? AND ?'
+                     ' ORDER BY m.record_id, m.seq', (record_id, last_id)):
+                if msg_record_id not in messages:
+                    messages[msg_record_id] = []
+                if item_kind is None:
+                    messages[msg_record_id].append(text)
+                else:
+                    messages[msg_record_id].append(
+                        (item_kind, text,
+                         get_location_compact(file_, line, column)))
+            chains = {}
+            for (chain_record_id, fndecl, file_, line,
+                 column) in conn.execute(
+                     'SELECT c.record_id, c.fndecl, l.file, l.line, l.column'
+                     ' FROM inlining_chains c'
+                     ' LEFT JOIN locations l ON l.id = c.site_location_id'
+                     ' WHERE c.record_id BETWEEN ? AND ?'
+                     ' ORDER BY c.record_id, c.seq', (record_id, last_id)):
+                if chain_record_id not in chains:
+                    chains[chain_record_id] = []
+                chains[chain_record_id].append(
+                    (fndecl, get_location_compact(file_, line, column)))
+
+            # Rebuild the compact form of the record, the rows being in
+            # pre-order
+            stack = []
+            root = root_depth = None
+            for (row_id, depth, kind, pass_key, function, impl_file,
+                 impl_line, impl_function, quality, value, file_, line,
+                 column, has_inlining_chain) in conn.execute(
+                     RECORD_COLUMNS + ' WHERE r.id BETWEEN ? AND ?'
+                     ' ORDER BY r.id', (record_id, last_id)):
+                compact = (kind, pass_key, function,
+                           ((impl_file, impl_line, impl_function)
+                            if impl_file is not None else None),
+                           messages.get(row_id, ()),
+                           (quality, value) if quality is not None else None,
+                           get_location_compact(file_, line, column),
+                           (chains.get(row_id, ())
+                            if has_inlining_chain else None),
+                           [])
+                if root is None:
+                    root, root_depth = compact, depth
+                else:
+                    del stack[depth - root_depth:]
+                    stack[-1][8].append(compact)
+                stack.append(compact)
+            tu = self.get_tu(tu_id)
+            builder = builders.get(tu_id)
+            if builder is None:
+                builder = builders[tu_id] = copy.copy(tu)
+                builder.shared_objects = {}
+            result.append((tu, Record.from_compact(root, builder,
+                                                   root_depth)))
+        return result
+
+    def select_records(self, where, params, order_by, limit=None):
+        """
+        Get the list of records for the rows of the records table matching
+        where, in order.
+        """
+        sql = ('SELECT %s FROM records r WHERE %s ORDER BY %s'
+               % (ROOT_COLUMNS, where, order_by))
+        if limit is not None:
+            sql += ' LIMIT %i' % limit
+        rows = self.get_connection().execute(sql, params).fetchall()
+        return [record for tu, record in self.load_records(rows)]
+
+    def get_rank_criteria(self, passname):
+        """
+        Get (where, params, rank column) for selecting the records from
+        the given pass (if any) by rank.
+        """
+        if passname is None:
+            return '1', (), 'r.rank'
+        return ('r.pass_name_id = ?', (self.pass_name_ids.get(passname),),
+                'r.pass_rank')
+
+    def count_records(self, passname=None):
+        if passname is None:
+            return self.count_all
+        return sum(p[2] for p in self.passes if p[0] == passname)
+
+    def get_range(self, start, end, passname=None):
+        where, params, rank = self.get_rank_criteria(passname)
+        return self.select_records('%s AND %s >= ? AND %s < ?'
+                                   % (where, rank, rank),
+                                   params + (start, end), rank)
+
+    def get_hottest(self, k, passname=None):
+        return self.get_range(0, k, passname)
+
+    def get_records(self, passname=None):
+        return list(self.iter_records(passname))
+
+    def iter_records(self, passname=None, start=0):
+        return (record for pos, record
+                in self.iter_ranked(*self.get_rank_criteria(passname), start))
+
+    def iter_ranked(self, where, params, rank, start, block_size=1000):
+        """
+        Generate (rank, record) for the records matching where, from rank
+        start onwards, selecting them a block at a time.
+        """
+        while True:
+            rows = self.get_connection().execute(
+                'SELECT %s, %s FROM records r WHERE %s AND %s >= ?'
+                ' ORDER BY %s LIMIT %i'
+                % (rank, ROOT_COLUMNS, where, rank, rank, block_size),
+                params + (start,)).fetchall()
+            if not rows:
+                return
+            records = self.load_records([row[1:] for row in rows])
+            for row, (tu, record) in zip(rows, records):
+                yield row[0], record
+            start = rows[-1][0] + 1
+
+    def iter_matches(self, query, offset):
+        """
+        Generate (position, record) for the records matching a RecordQuery,
+        with all of its criteria applied within the query.
+        """
+        where, params, rank = self.get_rank_criteria(query.passname)
+        clauses = [where]
+        if query.function is not None:
+            clauses.append('r.function = ?')
+            params += (query.function,)
+        if query.sourcefile is not None:
+            clauses.append('r.location_id IN'
+                           ' (SELECT id FROM locations WHERE file = ?)')
+            params += (query.sourcefile,)
+        if query.kind is not None:
+            clauses.append('r.kind = ?')
+            params += (query.kind,)
+        if query.min_count is not None:
+            clauses.append('r.count_id IS NOT NULL AND r.count_value >= ?')
+            params += (query.min_count,)
+        return self.iter_ranked(' AND '.join(clauses), params, rank, offset)
+
+class DatabaseSourceFileIndex(SourceFileIndex):
+    """
+    SourceFileIndex for a DatabaseIndex, selecting the records located in a
+    source file when it is looked up.
+    """
+    def __init__(self, index):
+        SourceFileIndex.__init__(self)
+        self.index = index
+
+    def get_sourcefiles(self):
+        return [sf[0] for sf in self.index.sourcefiles]
+
+    def iter_contributions(self, src_file, toplevel_only=False):
+        rows = self.index.get_connection().execute(
+            'SELECT %s FROM records r'
+            ' JOIN locations l ON l.id = r.location_id'
+            ' WHERE l.file = ?%s ORDER BY r.id'
+            % (ROOT_COLUMNS, ' AND r.depth = 0' if toplevel_only else ''),
+            (src_file,)).fetchall()
+        records = []
+        last_tu = None
+        for tu, record in self.index.load_records(rows):
+            if tu is not last_tu and records:
+                yield last_tu, group_by_line(records)
+                records = []
+            last_tu = tu
+            records.append(record)
+        if records:
+            yield last_tu, group_by_line(records)
+
+    def get_records_by_line(self, src_file, toplevel_only=False):
+        result = {}
+        for tu, by_line in self.iter_contributions(src_file, toplevel_only):
+            for line, records in by_line.items():
+                if line not in result:
+                    result[line] = []
+                result[line] += records
+        return result
+
+    def get_records(self, src_file, toplevel_only=False):
+        return [(tu, record)
+                for tu, by_line in self.iter_contributions(src_file,
+                                                           toplevel_only)
+                for records in by_line.values()
+                for record in records]
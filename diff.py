@@ -0,0 +1,163 @@
+# TODO: license
+from collections import deque
+import re
+
+from utils import gc_disabled, get_effective_result, get_message_text
+
+# Runs of digits within messages, which are replaced when matching records,
+# as they vary between builds without the optimization itself changing
+# (e.g. SSA names and iteration counts)
+DIGITS_RE = re.compile(r'\d+')
+
+def normalize_message(text):
+    return DIGITS_RE.sub('N', ' '.join(text.split()))
+
+def get_location_key(record):
+    """
+    Get the key identifying the place that a record is about: its pass,
+    function and source line (columns tend to shift between compiler
+    versions).
+    """
+    loc = record.location
+    return (record.pass_.name if record.pass_ else None,
+            record.function,
+            (loc.file, loc.line) if loc else None)
+
+def get_record_key(record):
+    """
+    Get the key for matching a record with the same record in another
+    build, with the same result.
+    """
+    return get_location_key(record) + (
+        normalize_message(get_message_text(record)),
+        get_effective_result(record))
+
+def get_count_value(record):
+    if record is None or not record.count:
+        return 0
+    return record.count.value
+
+# The opposite of each result, for finding flips
+FLIPPED_RESULT = {'success': 'failure',
+                  'failure': 'success'}
+
+class RecordChange:
+    """
+    A difference between two builds: a record that was added or removed,
+    or whose result flipped between success and failure (with old and new
+    both set).
+    """
+    def __init__(self, kind, old, new):
+        self.kind = kind
+        self.old = old
+        self.new = new
+        self.hotness = max(get_count_value(old), get_count_value(new))
+
+    @property
+    def record(self):
+        """The record from the new build, if any, or else the old one"""
+        return self.new or self.old
+
+class RecordDiff:
+    """
+    The differences between the top-level records of two lists of
+    TranslationUnits.
+
+    Records are first matched by get_record_key; those left over are then
+    matched by get_location_key where one is a success and the other a
+    failure, giving the flips.  Both steps are hash joins, so this takes
+    time linear in the number of records (apart from sorting the changes).
+    Where several records share a key, they are matched in order, with any
+    surplus being added or removed.
+
+    If record_filter is set, only the records for which it returns true are
+    compared.
+    """
+    KINDS = ('flipped', 'removed', 'added')
+
+    def __init__(self, old_tus, new_tus, record_filter=None):
+        # The top-level records of each TU
+        old_lists = [tu.records for tu in old_tus]
+        new_lists = [tu.records for tu in new_tus]
+        if record_filter:
+            old_lists = [list(filter(record_filter, records))
+                         for records in old_lists]
+            new_lists = [list(filter(record_filter, records))
+                         for records in new_lists]
+        # (this creates many objects, but no reference cycles)
+        with gc_disabled():
+            changes = self._match(old_lists, new_lists)
+
+        # All of the changes, hottest first
+        self.changes = sorted(changes, key=lambda c: -c.hotness)
+        self.changes_by_kind = {kind: [c for c in self.changes
+                                       if c.kind == kind]
+                                for kind in self.KINDS}
+
+    def _match(self, old_lists, new_lists):
+        """
+        Match up the records (given as a list of records per TU), setting
+        self.num_unchanged and returning the list of RecordChanges.
+        """
+        # Mapping of key to the queue of old records with that key
+        old_by_key = {}
+        for records in old_lists:
+            for record in records:
+                key = get_record_key(record)
+                if key not in old_by_key:
+                    old_by_key[key] = deque()
+                old_by_key[key].append(record)
+
+        # The ids of the old records matched so far
+        matched = set()
+        new_unmatched = []
+        for records in new_lists:
+            for record in records:
+                old_records = old_by_key.get(get_record_key(record))
+                if old_records:
+                    matched.add(id(old_records.popleft()))
+                else:
+                    new_unmatched.append(record)
+        self.num_unchanged = len(matched)
+
+        # Mapping of (location key, result) to the queue of unmatched old
+        # records with those
+        old_by_location = {}
+        for records in old_lists:
+            for record in records:
+                if id(record) in matched:
+                    continue
+                result = get_effective_result(record)
+                if result in FLIPPED_RESULT:
+                    key = (get_location_key(record), result)
+                    if key not in old_by_location:
+                        old_by_location[key] = deque()
+                    old_by_location[key].append(record)
+
+        changes = []
+        for record in new_unmatched:
+            result = get_effective_result(record)
+            old_records = None
+            if result in FLIPPED_RESULT:
+                old_records = old_by_location.get(
+                    (get_location_key(record), FLIPPED_RESULT[result]))
+            if old_records:
+                old = old_records.popleft()
+                matched.add(id(old))
+                changes.append(RecordChange('flipped', old, record))
+            else:
+                changes.append(RecordChange('added', None, record))
+        for records in old_lists:
+            changes += [RecordChange('removed', record, None)
+                        for record in records
+                        if id(record) not in matched]
+        return changes
+
+    def get_changes(self, kind=None):
+        """
+        Get the list of changes (or just those of the given kind), hottest
+        first.
+        """
+        if kind is None:
+            return self.changes
+        return self.changes_by_kind.get(kind, [])
@@ -0,0 +1,232 @@
+# TODO: license
+import csv
+import gzip
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from utils import gc_disabled, get_message_text, iter_tus, log
+
+# The tables written, as a mapping of name to a tuple of (column name,
+# type), where the types are the names of pyarrow's type factories.
+# Records refer to their TU, parent record and pass by id; their inlining
+# chains are in a table of their own, with one row per node.
+TABLES = {
+    'tus': (('tu_id', 'int32'),
+            ('filename', 'string'),
+            ('size', 'int64'),
+            ('format', 'string'),
+            ('generator_name', 'string'),
+            ('generator_pkgversion', 'string'),
+            ('generator_version', 'string'),
+            ('generator_target', 'string'),
+            ('num_records', 'int64')),
+    'passes': (('pass_id', 'int64'),
+               ('tu_id', 'int32'),
+               ('parent_pass_id', 'int64'),
+               ('name', 'string'),
+               ('num', 'int32'),
+               ('type', 'string'),
+               ('optgroups', 'string')),
+    'records': (('record_id', 'int64'),
+                ('tu_id', 'int32'),
+                ('parent_id', 'int64'),
+                ('depth', 'int32'),
+                ('num_children', 'int32'),
+                ('kind', 'string'),
+                ('pass_id', 'int64'),
+                ('pass_name', 'string'),
+                ('function', 'string'),
+                ('message', 'string'),
+                ('file', 'string'),
+                ('line', 'int32'),
+                ('column', 'int32'),
+                ('count_value', 'int64'),
+                ('count_quality', 'string'),
+                ('impl_file', 'string'),
+                ('impl_line', 'int32'),
+                ('impl_function', 'string')),
+    'inlining_chains': (('record_id', 'int64'),
+                        ('position', 'int32'),
+                        ('fndecl', 'string'),
+                        ('site_file', 'string'),
+                        ('site_line', 'int32'),
+                        ('site_column', 'int32')),
+}
+
+# The number of rows of each table written at a time (as one Parquet row
+# group, or one chunk of CSV); only this many rows of each are held
+BATCH_SIZE = 1 << 16
+
+FORMATS = ('parquet', 'csv')
+
+def get_default_format():
+    return 'parquet' if pyarrow else 'csv'
+
+class ParquetTableWriter:
+    """Writes the rows of a table to a Parquet file, a batch at a time"""
+    SUFFIX = '.parquet'
+
+    def __init__(self, path, columns):
+        self.schema = pyarrow.schema([pyarrow.field(name,
+                                                    getattr(pyarrow, type_)())
+                                      for name, type_ in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_rows(self, rows):
+        arrays = [pyarrow.array(values, type=field.type)
+                  for values, field in zip(zip(*rows), self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays,
+                                                          schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+class CsvTableWriter:
+    """
+    Writes the rows of a table to a gzipped CSV file, with a header row,
+    for when pyarrow isn't available; nulls are written as empty fields.
+    """
+    SUFFIX = '.csv.gz'
+
+    def __init__(self, path, columns):
+        self.f = gzip.open(path, 'wt', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow([name for name, type_ in columns])
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.f.close()
+
+WRITERS = {'parquet': ParquetTableWriter,
+           'csv': CsvTableWriter}
+
+class Exporter:
+    """
+    Flattens TranslationUnits into the rows of TABLES, writing each table
+    a batch of BATCH_SIZE rows at a time, with ids assigned in the order
+    the TUs are added.
+    """
+    def __init__(self, out_dir, format_):
+        self.out_dir = out_dir
+        writer_class = WRITERS[format_]
+        # Mapping of table name to [writer, final path, pending rows]
+        self.tables = {}
+        for name, columns in TABLES.items():
+            path = os.path.join(out_dir, name + writer_class.SUFFIX)
+            # (each file is only renamed into place once complete)
+            self.tables[name] = [writer_class(path + '.tmp', columns), path,
+                                 []]
+        self.num_tus = 0
+        self.num_passes = 0
+        self.num_records = 0
+
+    def add_rows(self, name, rows):
+        table = self.tables[name]
+        table[2] += rows
+        while len(table[2]) >= BATCH_SIZE:
+            table[0].write_rows(table[2][:BATCH_SIZE])
+            del table[2][:BATCH_SIZE]
+
+    def add_passes(self, tu_id, passes, parent_id, pass_ids, rows):
+        for p in passes:
+            pass_id = self.num_passes
+            self.num_passes += 1
+            pass_ids[p.id_] = pass_id
+            rows.append((pass_id, tu_id, parent_id, p.name, p.num, p.type,
+                         ','.join(sorted(p.optgroups))))
+            self.add_passes(tu_id, p.children, pass_id, pass_ids, rows)
+
+    def add_tu(self, tu):
+        tu_id = self.num_tus
+        self.num_tus += 1
+
+        # Mapping of the compiler's pass id to pass_id
+        pass_ids = {}
+        passes = []
+        self.add_passes(tu_id, tu.passes, None, pass_ids, passes)
+        self.add_rows('passes', passes)
+
+        records = []
+        inlining_chains = []
+        # Mapping of id(record) to its record_id
+        record_ids = {}
+        for record, depth, parent in tu.walk():
+            record_id = self.num_records + len(records)
+            record_ids[id(record)] = record_id
+            pass_ = record.pass_
+            loc = record.location
+            count = record.count
+            impl_loc = record.impl_location
+            parent_id = record_ids[id(parent)] if parent is not None else None
+            records.append((record_id, tu_id, parent_id,
+                            depth, len(record.children), record.kind,
+                            pass_ids[pass_.id_] if pass_ else None,
+                            pass_.name if pass_ else None,
+                            record.function, get_message_text(record),
+                            loc.file if loc else None,
+                            loc.line if loc else None,
+                            loc.column if loc else None,
+                            count.value if count else None,
+                            count.quality if count else None,
+                            impl_loc.file if impl_loc else None,
+                            impl_loc.line if impl_loc else None,
+                            impl_loc.function if impl_loc else None))
+            for position, node in enumerate(record.inlining_chain or ()):
+                site = node.site
+                inlining_chains.append((record_id, position, node.fndecl,
+                                        site.file if site else None,
+                                        site.line if site else None,
+                                        site.column if site else None))
+        self.num_records += len(records)
+        self.add_rows('records', records)
+        self.add_rows('inlining_chains', inlining_chains)
+
+        g = tu.generator
+        self.add_rows('tus', [(tu_id, tu.filename, tu.size, tu.format,
+                               g.name, g.pkgversion, g.version, g.target,
+                               len(records))])
+
+    def finish(self):
+        for writer, path, rows in self.tables.values():
+            if rows:
+                writer.write_rows(rows)
+            writer.close()
+            os.replace(path + '.tmp', path)
+
+    def abort(self):
+        for writer, path, rows in self.tables.values():
+            writer.close()
+            os.unlink(path + '.tmp')
+
+def export(filenames, out_dir, format_=None, jobs=None, cache_dir=None):
+    """
+    Flatten the records within the given .opt-record.json.gz files into
+    the tables of TABLES, written to out_dir as Parquet (the default, if
+    pyarrow is available) or as gzipped CSV, loading one TU at a time.
+    """
+    if format_ is None:
+        format_ = get_default_format()
+    if format_ == 'parquet' and not pyarrow:
+        raise ValueError('writing Parquet requires pyarrow')
+    log('export: %i files into %r as %s' % (len(filenames), out_dir,
+                                            format_))
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    exporter = Exporter(out_dir, format_)
+    try:
+        with gc_disabled():
+            for tu in iter_tus(filenames, jobs, cache_dir):
+                exporter.add_tu(tu)
+    except BaseException:
+        exporter.abort()
+        raise
+    exporter.finish()
+    log(' %i TUs, %i passes, %i records'
+        % (exporter.num_tus, exporter.num_passes, exporter.num_records))
@@ -0,0 +1,114 @@
+# TODO: license
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import pygments
+import pygments.formatters
+import pygments.lexers
+import pygments.util
+
+from cache import write_atomically
+
+def get_lexer(filename, code):
+    """
+    Get a pygments lexer for filename, using its extension if possible,
+    and only falling back to (much slower) guessing from the content of
+    the file if that fails.
+    """
+    try:
+        return pygments.lexers.get_lexer_for_filename(filename)
+    except pygments.util.ClassNotFound:
+        pass
+    try:
+        return pygments.lexers.guess_lexer(code)
+    except pygments.util.ClassNotFound:
+        return pygments.lexers.TextLexer()
+
+def highlight_lines(filename, code, formatter):
+    """
+    Use pygments to convert code to HTML, returning a list of lines of HTML.
+    """
+    lexer = get_lexer(filename, code)
+    code_as_html = pygments.highlight(code, lexer, formatter)
+
+    EXPECTED_START = '<div class="highlight"><pre>'
+    assert code_as_html.startswith(EXPECTED_START)
+    code_as_html = code_as_html[len(EXPECTED_START):-1]
+
+    EXPECTED_END = '</pre></div>'
+    assert code_as_html.endswith(EXPECTED_END)
+    code_as_html = code_as_html[0:-len(EXPECTED_END)]
+
+    return code_as_html.splitlines()
+
+class Highlighter:
+    """
+    Cache of the highlighted HTML lines for source files, keyed by a hash
+    of their content (and extension, which determines the lexer).
+
+    The most recently used max_entries files are held in memory; if
+    cache_dir is set, every file is also cached on disk there.
+    """
+    def __init__(self, cache_dir=None, max_entries=64):
+        self.formatter = pygments.formatters.HtmlFormatter()
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_style_defs(self):
+        return self.formatter.get_style_defs()
+
+    def get_key(self, filename, code):
+        h = hashlib.sha256()
+        # Changes to pygments can change the HTML
+        h.update(pygments.__version__.encode('utf-8') + b'\0')
+        h.update(os.path.splitext(filename)[1].encode('utf-8') + b'\0')
+        h.update(code.encode('utf-8'))
+        return h.hexdigest()
+
+    def get_html_lines(self, filename, code):
+        """
+        Get the list of lines of HTML for code, the content of filename.
+        """
+        key = self.get_key(filename, code)
+        with self.lock:
+            lines = self.entries.get(key)
+            if lines is not None:
+                self.entries.move_to_end(key)
+                return lines
+
+        lines = self.load_from_disk(key)
+        if lines is None:
+            lines = highlight_lines(filename, code, self.formatter)
+            self.store_to_disk(key, lines)
+
+        with self.lock:
+            self.entries[key] = lines
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return lines
+
+    def get_disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def load_from_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.get_disk_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store_to_disk(self, key, lines):
+        if not self.cache_dir:
+            return
+        # (so that concurrent readers never see a partially-written entry)
+        write_atomically(self.get_disk_path(key),
+                         json.dumps(lines).encode('utf-8'))
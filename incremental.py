@@ -0,0 +1,116 @@
+# TODO: license
+import hashlib
+import json
+import marshal
+import os
+
+import pygments
+
+from cache import write_atomically
+
+# Version number for the layout of the manifest and of the per-TU
+# aggregates; bump this whenever either of them, or the HTML they hold,
+# changes.
+STATE_FORMAT_VERSION = 2
+
+# Subdirectory of the output directory holding the state
+STATE_DIRNAME = '.opt-viewer-state'
+
+def get_record_file_key(filename):
+    """
+    Get a key for the current state of a .opt-record.json.gz file.
+    """
+    st = os.stat(filename)
+    return [st.st_mtime_ns, st.st_size]
+
+def hash_file(filename):
+    """
+    Get the SHA-256 of the content of filename, or None if it can't be read.
+    """
+    h = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    except OSError:
+        return None
+    return h.hexdigest()
+
+class ReportState:
+    """
+    The state of an incrementally-generated static report, kept within
+    its output directory.
+
+    The manifest records, for each input .opt-record.json.gz file, its key
+    and the source files its records are located in, and for each source
+    file, the hash of its content, the input files contributing records to
+    it and its output page.  Alongside it, each input file has a cached
+    aggregate (in marshalled form) holding everything that the global pages
+    need from it, so that they can be rebuilt without reloading it.
+    """
+    def __init__(self, out_dir):
+        self.state_dir = os.path.join(out_dir, STATE_DIRNAME)
+        self.manifest_path = os.path.join(self.state_dir, 'manifest.json')
+        self.highest_count = None
+        self.index_page_size = None
+        self.index_limit = None
+        # Mapping of input filename to {'key': ..., 'sourcefiles': [...]}
+        self.tus = {}
+        # Mapping of source file to {'hash': ..., 'tus': [...], 'page': ...}
+        self.sourcefiles = {}
+
+    def load(self):
+        """
+        Load the manifest, leaving this state empty if there isn't a usable
+        one (so that everything is regenerated).
+        """
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (manifest.get('version') != STATE_FORMAT_VERSION
+            or manifest.get('pygments') != pygments.__version__):
+            return
+        self.highest_count = manifest['highest_count']
+        self.index_page_size = manifest.get('index_page_size')
+        self.index_limit = manifest.get('index_limit')
+        self.tus = manifest['tus']
+        self.sourcefiles = manifest['sourcefiles']
+
+    def save(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        manifest = {'version': STATE_FORMAT_VERSION,
+                    'pygments': pygments.__version__,
+                    'highest_count': self.highest_count,
+                    'index_page_size': self.index_page_size,
+                    'index_limit': self.index_limit,
+                    'tus': self.tus,
+                    'sourcefiles': self.sourcefiles}
+        write_atomically(self.manifest_path,
+                         json.dumps(manifest, indent=1,
+                                    sort_keys=True).encode('utf-8'))
+
+    def get_aggregate_path(self, filename):
+        digest = hashlib.sha1(filename.encode('utf-8'))
+        return os.path.join(self.state_dir, digest.hexdigest() + '.marshal')
+
+    def load_aggregate(self, filename):
+        """
+        Get the cached aggregate for filename, or None if there isn't one.
+        """
+        try:
+            with open(self.get_aggregate_path(filename), 'rb') as f:
+                return marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def store_aggregate(self, filename, aggregate):
+        os.makedirs(self.state_dir, exist_ok=True)
+        write_atomically(self.get_aggregate_path(filename),
+                         marshal.dumps(aggregate))
+
+    def remove_aggregate(self, filename):
+        try:
+            os.unlink(self.get_aggregate_path(filename))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,395 @@
+# TODO: license
+from array import array
+from collections import OrderedDict
+import concurrent.futures
+import heapq
+import itertools
+import marshal
+import os
+import threading
+
+from aggregates import Function, RecordIndex, TUSummary, record_sort_key
+from cache import RecordCache
+from incremental import get_record_file_key
+from optrecord import Location, TranslationUnit
+from sourceindex import SourceFileIndex
+from utils import gc_disabled, load_record_files, load_tu, log
+
+# Version number for the layout of the compact form of TUHeader; bump this
+# whenever it changes.
+HEADER_FORMAT_VERSION = 2
+
+# The number of fully-parsed TranslationUnits kept in memory by default
+DEFAULT_MAX_LOADED_TUS = 16
+
+# Estimate of the memory held by a LoadedTU per byte of its decompressed
+# JSON (TranslationUnit.size); measured at between 1 and 2 for typical files
+MEMORY_PER_JSON_BYTE = 1.5
+
+# The number of records whose TUs are loaded together when iterating over
+# records in hotness order, so that each TU is loaded at most once per block
+RESOLVE_BLOCK_SIZE = 10000
+
+def get_header_compact(summary, file_key):
+    """
+    Get the compact form of the TUHeader for a TUSummary, suitable for the
+    marshal module, where file_key is the get_record_file_key of the file
+    it was loaded from.
+    """
+    pass_names = sorted(summary.passes)
+    pass_ids = {name: i + 1 for i, name in enumerate(pass_names)}
+    # (0 for records without a pass)
+    record_pass_ids = array('I', (pass_ids[record.pass_.name]
+                                  if record.pass_ else 0
+                                  for record in summary.sorted_records))
+    keys = array('q', map(record_sort_key, summary.sorted_records))
+    functions = tuple((f.name, f.sourcefile, f.hotness,
+                       f.peak_location.to_compact()
+                       if f.peak_location else None,
+                       f.peak_location_hotness)
+                      for f in summary.functions.values())
+    return (summary.filename, file_key, summary.size,
+            summary.num_toplevel_records,
+            summary.num_all_records, summary.passes, summary.sourcefiles,
+            functions, tuple(pass_names), keys.tobytes(),
+            record_pass_ids.tobytes())
+
+class TUHeader:
+    """
+    The parts of the TUSummary of a TranslationUnit that can be held
+    without its records: its totals, and the sort key and pass of each of
+    its records in the order of TUSummary.sorted_records, from which the
+    positions within that list of the records needed for a page can be
+    found without loading it.
+
+    The key of the file the header was built from is kept, as the
+    positions are only valid for the records of that version of it.
+    """
+    def __init__(self, compact):
+        (self.filename, self.file_key, self.size, self.num_toplevel_records,
+         self.num_all_records, self.passes, self.sourcefiles, functions,
+         self.pass_names, keys, record_pass_ids) = compact
+        # (for the sharing of identical Locations)
+        self.shared_objects = {}
+        self.functions = {}
+        for (name, sourcefile, hotness, peak_location,
+             peak_location_hotness) in functions:
+            if peak_location is not None:
+                peak_location = Location.from_compact(peak_location, self)
+            self.functions[name] = Function(name, sourcefile, hotness,
+                                            self.filename, peak_location,
+                                            peak_location_hotness)
+        self.shared_objects.clear()
+        self.keys = array('q')
+        self.keys.frombytes(keys)
+        self.record_pass_ids = array('I')
+        self.record_pass_ids.frombytes(record_pass_ids)
+        # Mapping of passname to (keys, positions) of its records
+        self._by_pass = {}
+
+    def __repr__(self):
+        return 'TUHeader(%r)' % self.filename
+
+    def count_toplevel_records(self):
+        return self.num_toplevel_records
+
+    def count_all_records(self):
+        return self.num_all_records
+
+    def get_sorted_keys(self, passname=None):
+        """
+        Get (keys, positions): the sort keys of the records (or just those
+        from the given pass) in order, and their positions within
+        TUSummary.sorted_records.
+        """
+        if passname is None:
+            return self.keys, range(len(self.keys))
+        result = self._by_pass.get(passname)
+        if result is None:
+            pass_id = self.pass_names.index(passname) + 1
+            positions = array('I', (pos for pos, record_pass_id
+                                    in enumerate(self.record_pass_ids)
+                                    if record_pass_id == pass_id))
+            keys = array('q', map(self.keys.__getitem__, positions))
+            result = self._by_pass[passname] = (keys, positions)
+        return result
+
+def get_header_caches(cache_dir):
+    """
+    Get the (RecordCache, header cache) to use for cache_dir, or
+    (None, None).
+    """
+    if not cache_dir:
+        return None, None
+    return (RecordCache(cache_dir),
+            RecordCache(os.path.join(cache_dir,
+                                     'headers-%i' % HEADER_FORMAT_VERSION)))
+
+def load_header(filename, cache, header_cache):
+    """
+    Get the compact form of the TUHeader for filename, parsing it (or
+    loading it from cache) if header_cache doesn't have a valid entry for
+    it, and storing the TranslationUnit into cache for later.
+    """
+    compact = header_cache.load(filename) if header_cache else None
+    if compact is not None:
+        return compact
+    if header_cache:
+        key = header_cache.get_key(filename)
+    file_key = get_record_file_key(filename)
+    with gc_disabled():
+        tu_compact = cache.load(filename) if cache else None
+        if tu_compact is not None:
+            tu = TranslationUnit.from_compact(tu_compact)
+            tu.filename = filename
+        else:
+            log(' reading: %r' % filename)
+            tu = load_tu(filename, cache)
+        compact = get_header_compact(TUSummary(tu), file_key)
+    if header_cache:
+        header_cache.store(filename, key, compact)
+    return compact
+
+def load_compact_header(filename, cache_dir):
+    """
+    Get the TUHeader for filename in marshalled compact form; this is run
+    in the worker processes of load_headers.
+    """
+    return marshal.dumps(load_header(filename,
+                                     *get_header_caches(cache_dir)))
+
+def load_headers(filenames, jobs=None, cache_dir=None):
+    """
+    Get the TUHeader for each of the given .opt-record.json.gz files, in
+    the same order.  Only one TranslationUnit at a time is held in memory
+    (per worker process, if jobs is greater than 1).
+    """
+    log('load_headers: %i files' % len(filenames))
+    cache, header_cache = get_header_caches(cache_dir)
+    compacts = [None] * len(filenames)
+    stale = []
+    for i, filename in enumerate(filenames):
+        if header_cache:
+            compacts[i] = header_cache.load(filename)
+        if compacts[i] is None:
+            stale.append(i)
+    if header_cache:
+        log(' loaded %i headers from cache' % (len(filenames) - len(stale)))
+
+    if jobs is None or jobs <= 1 or len(stale) <= 1:
+        for i in stale:
+            compacts[i] = load_header(filenames[i], cache, header_cache)
+    else:
+        log(' scanning %i files using %i jobs' % (len(stale), jobs))
+        chunksize = max(1, len(stale) // (jobs * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(load_compact_header,
+                                   [filenames[i] for i in stale],
+                                   [cache_dir] * len(stale),
+                                   chunksize=chunksize)
+            for i, data in zip(stale, results):
+                compacts[i] = marshal.loads(data)
+    return [TUHeader(compact) for compact in compacts]
+
+class StaleRecordFileError(Exception):
+    """
+    A record file has changed since its TUHeader was built, so that the
+    header no longer describes its records.
+    """
+    def __init__(self, filename):
+        Exception.__init__(self, '%r has changed since its records were'
+                           ' indexed' % filename)
+        self.filename = filename
+
+class LoadedTU:
+    """
+    A fully-parsed TranslationUnit held by a TULoader, with its TUSummary
+    and (once needed) its SourceFileIndex.
+    """
+    def __init__(self, tu):
+        self.tu = tu
+        self.summary = TUSummary(tu)
+        self._sourcefile_index = None
+        self.num_bytes = int(tu.size * MEMORY_PER_JSON_BYTE)
+
+    def get_sourcefile_index(self):
+        if self._sourcefile_index is None:
+            self._sourcefile_index = SourceFileIndex([self.tu])
+        return self._sourcefile_index
+
+class TULoader:
+    """
+    Loads TranslationUnits on demand (via the RecordCache in cache_dir, if
+    any, and otherwise by reparsing them), keeping the most recently used
+    ones in memory: at most max_entries of them, and at most about
+    max_bytes of memory's worth (always keeping the latest one).  Without
+    either limit, DEFAULT_MAX_LOADED_TUS are kept.
+
+    The counts of hits, misses and evictions are kept, for sizing the
+    limits.
+    """
+    def __init__(self, cache_dir=None, max_entries=None, max_bytes=None):
+        if max_entries is None and max_bytes is None:
+            max_entries = DEFAULT_MAX_LOADED_TUS
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, header):
+        """
+        Get the LoadedTU for the file with the given TUHeader, raising
+        StaleRecordFileError if the file has changed since the header was
+        built.
+        """
+        filename = header.filename
+        with self.lock:
+            loaded = self.entries.get(filename)
+            if loaded is not None:
+                self.entries.move_to_end(filename)
+                self.hits += 1
+                return loaded
+            self.misses += 1
+
+        # (the key is taken before reading, as with RecordCache.get_key)
+        if get_record_file_key(filename) != header.file_key:
+            raise StaleRecordFileError(filename)
+        tu, = load_record_files([filename], None, self.cache_dir)
+        loaded = LoadedTU(tu)
+
+        with self.lock:
+            # (another thread may have loaded it meanwhile)
+            old = self.entries.pop(filename, None)
+            if old is not None:
+                self.num_bytes -= old.num_bytes
+            self.entries[filename] = loaded
+            self.num_bytes += loaded.num_bytes
+            while len(self.entries) > 1 and self.is_over_limits():
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= evicted.num_bytes
+                self.evictions += 1
+        return loaded
+
+    def is_over_limits(self):
+        if self.max_entries is not None and len(self.entries) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.num_bytes > self.max_bytes:
+            return True
+        return False
+
+    def get_stats(self):
+        """
+        Get a dict of the current usage, limits and counters.
+        """
+        with self.lock:
+            return {'num_entries': len(self.entries),
+                    'num_bytes': self.num_bytes,
+                    'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+class LazySourceFileIndex(SourceFileIndex):
+    """
+    SourceFileIndex for a LazyRecordIndex, only loading the TUs
+    contributing records to a source file when it is looked up.
+    """
+    def __init__(self, headers, loader):
+        SourceFileIndex.__init__(self)
+        self.loader = loader
+        # Mapping of source file to the TUHeaders of the TUs with records
+        # located in it, in TU order
+        self.tus_by_file = {}
+        for header in headers:
+            for src_file in header.sourcefiles:
+                if src_file not in self.tus_by_file:
+                    self.tus_by_file[src_file] = []
+                self.tus_by_file[src_file].append(header)
+
+    def get_sourcefiles(self):
+        return list(self.tus_by_file)
+
+    def iter_contributions(self, src_file):
+        for header in self.tus_by_file.get(src_file, ()):
+            index = self.loader.get(header).get_sourcefile_index()
+            yield from index.iter_contributions(src_file)
+
+class LazyRecordIndex(RecordIndex):
+    """
+    RecordIndex built from the TUHeader of each TranslationUnit, loading
+    the TUs themselves via a TULoader only when their records are needed.
+
+    The records in hotness order are found by merging the sort keys held
+    in the headers, and then loading just the TUs holding the records in
+    the requested range.
+    """
+    def __init__(self, headers, loader):
+        RecordIndex.__init__(self, headers, headers,
+                             LazySourceFileIndex(headers, loader))
+        self.loader = loader
+
+    def get_loader_stats(self):
+        return self.loader.get_stats()
+
+    def get_search_index(self):
+        # (indexing the messages would mean loading every TU)
+        return None
+
+    def iter_positions(self, passname=None):
+        """
+        Generate (sort key, TU number, position within the TU's
+        TUSummary.sorted_records) for all of the records (or just those
+        from the given pass) in the order of get_records.
+        """
+        iterables = []
+        for i, header in enumerate(self.summaries):
+            if passname is not None and passname not in header.passes:
+                continue
+            keys, positions = header.get_sorted_keys(passname)
+            iterables.append(zip(keys, itertools.repeat(i), positions))
+        # Comparing the tuples as a whole keeps ties in TU order, and then
+        # in order within each TU.
+        return heapq.merge(*iterables)
+
+    def resolve(self, positions):
+        """
+        Get the list of records for a list of items from iter_positions,
+        loading each of the TUs involved once.
+        """
+        records = [None] * len(positions)
+        by_tu = {}
+        for j, (key, i, pos) in enumerate(positions):
+            if i not in by_tu:
+                by_tu[i] = []
+            by_tu[i].append((j, pos))
+        for i, items in by_tu.items():
+            loaded = self.loader.get(self.summaries[i])
+            sorted_records = loaded.summary.sorted_records
+            for j, pos in items:
+                records[j] = sorted_records[pos]
+        return records
+
+    def get_records(self, passname=None):
+        return list(self.iter_records(passname))
+
+    def iter_records(self, passname=None, start=0):
+        positions = itertools.islice(self.iter_positions(passname), start,
+                                     None)
+        while True:
+            block = list(itertools.islice(positions, RESOLVE_BLOCK_SIZE))
+            if not block:
+                return
+            yield from self.resolve(block)
+
+    def get_hottest(self, k, passname=None):
+        return self.get_range(0, k, passname)
+
+    def get_range(self, start, end, passname=None):
+        return self.resolve(list(itertools.islice(
+            self.iter_positions(passname), start, end)))
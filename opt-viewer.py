@@ -1,24 +1,223 @@
 #!/usr/bin/python3
 # TODO: license
 import argparse
+import os
+import sys
 
 from static import generate_static_report
-from utils import find_records, log
+from utils import find_record_files, find_records, log
+
+def ingest_main(argv):
+    parser = argparse.ArgumentParser(prog='opt-viewer.py ingest',
+                                     description='Load the optimization records within a build directory into an SQLite database, for serving with --db.')
+    parser.add_argument('build_dir', metavar='BUILD_DIR', type=str,
+                        help='The directory in which to look for .json.gz files')
+    parser.add_argument('db_path', metavar='DB_PATH', type=str,
+                        help='The database to (re)create')
+    parser.add_argument('--jobs', dest='jobs', metavar='N', type=int, required=False,
+                        help='The number of worker processes to use when loading records')
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='CACHE_DIR', type=str, required=False,
+                        help='A directory in which to cache parsed records between runs')
+    args = parser.parse_args(argv)
+    from db import ingest
+    ingest(find_record_files(args.build_dir), args.db_path, args.jobs,
+           args.cache_dir)
+
+def search_main(argv):
+    parser = argparse.ArgumentParser(prog='opt-viewer.py search',
+                                     description='Print the optimization records within a build directory whose messages or function names match a query, hottest first.')
+    parser.add_argument('build_dir', metavar='BUILD_DIR', type=str,
+                        help='The directory in which to look for .json.gz files')
+    parser.add_argument('query', metavar='QUERY', type=str,
+                        help='Words that must all match, where "word*" matches any word with that prefix, and "quoted words" must match as a phrase')
+    parser.add_argument('--pass', dest='passname', metavar='PASS', type=str, required=False,
+                        help='Only print records from this pass')
+    parser.add_argument('--kind', dest='kind', metavar='KIND', type=str, required=False,
+                        help='Only print records of this kind')
+    parser.add_argument('--min-count', dest='min_count', metavar='N', type=int, required=False,
+                        help='Only print records with at least this execution count')
+    parser.add_argument('--limit', dest='limit', metavar='N', type=int, default=20,
+                        help='The number of records to print (default: %(default)s)')
+    parser.add_argument('--jobs', dest='jobs', metavar='N', type=int, required=False,
+                        help='The number of worker processes to use when loading records')
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='CACHE_DIR', type=str, required=False,
+                        help='A directory in which to cache parsed records between runs')
+    args = parser.parse_args(argv)
+    import itertools
+    from aggregates import RecordIndex
+    from search import SearchQuery
+    from static import print_as_remark
+    index = RecordIndex(find_records(args.build_dir, args.jobs,
+                                     args.cache_dir))
+    matches = index.get_search_index().search(SearchQuery(args.query),
+                                              args.passname, args.kind,
+                                              args.min_count)
+    for pos, record in itertools.islice(matches, args.limit):
+        print_as_remark(record)
+
+def query_main(argv):
+    parser = argparse.ArgumentParser(prog='opt-viewer.py query',
+                                     description='Print the optimization records within a build directory matching the given criteria, streaming them from the record files.')
+    parser.add_argument('build_dir', metavar='BUILD_DIR', type=str,
+                        help='The directory in which to look for .json.gz files')
+    parser.add_argument('--pass', dest='passname', metavar='PASS', type=str, required=False,
+                        help='Only print records from this pass')
+    parser.add_argument('--kind', dest='kind', metavar='KIND', type=str, required=False,
+                        help='Only print records of this kind (e.g. success, failure or note)')
+    parser.add_argument('--file', dest='file_glob', metavar='GLOB', type=str, required=False,
+                        help='Only print records with a source file matching this glob (e.g. "src/net/*")')
+    parser.add_argument('--function', dest='function_re', metavar='REGEX', type=str, required=False,
+                        help='Only print records with a function name matching this regular expression')
+    parser.add_argument('--min-count', dest='min_count', metavar='N', type=int, required=False,
+                        help='Only print records with at least this execution count')
+    parser.add_argument('--top', dest='top', metavar='K', type=int, required=False,
+                        help='Only print the K hottest records, hottest first (otherwise all are printed, in the order of the record files)')
+    parser.add_argument('--format', dest='format', choices=('remark', 'jsonl', 'csv'), default='remark',
+                        help='How to print the records: as GCC-style remarks (the default), as JSON lines, or as CSV')
+    parser.add_argument('--fields', dest='fields', metavar='FIELDS', type=str, required=False,
+                        help='With --format=jsonl or csv, the comma-separated fields to print (default: kind,pass,function,location,count,message)')
+    parser.add_argument('--jobs', dest='jobs', metavar='N', type=int, required=False,
+                        help='The number of worker processes to use when loading records')
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='CACHE_DIR', type=str, required=False,
+                        help='A directory in which to cache parsed records between runs')
+    args = parser.parse_args(argv)
+    import re
+    from query import get_record_fields
+    from static import print_as_remark
+    from stream import RecordFilter, query_records, write_csv, write_jsonl
+    try:
+        fields = get_record_fields(args.fields)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        record_filter = RecordFilter(args.passname, args.kind, args.file_glob,
+                                     args.function_re, args.min_count)
+    except re.error as e:
+        parser.error('invalid --function: %s' % e)
+    records = query_records(find_record_files(args.build_dir), record_filter,
+                            args.top, args.jobs, args.cache_dir)
+    try:
+        if args.format == 'jsonl':
+            write_jsonl(sys.stdout, records, fields)
+        elif args.format == 'csv':
+            write_csv(sys.stdout, records, fields)
+        else:
+            for record in records:
+                print_as_remark(record)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The output was piped into something that stopped reading (such
+        # as head); stop quietly, without Python complaining again when it
+        # flushes stdout at exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+def export_main(argv):
+    from export import FORMATS, export, get_default_format
+    parser = argparse.ArgumentParser(prog='opt-viewer.py export',
+                                     description='Flatten the optimization records within a build directory into columnar files (tus, passes, records and inlining_chains), for analysis with e.g. pandas or DuckDB.')
+    parser.add_argument('build_dir', metavar='BUILD_DIR', type=str,
+                        help='The directory in which to look for .json.gz files')
+    parser.add_argument('out_dir', metavar='OUTPUT_DIR', type=str,
+                        help='The directory to which to write the files')
+    parser.add_argument('--format', dest='format', choices=FORMATS, default=get_default_format(),
+                        help='Write Parquet files (requires pyarrow) or gzipped CSV files (default: %(default)s)')
+    parser.add_argument('--jobs', dest='jobs', metavar='N', type=int, required=False,
+                        help='The number of worker processes to use when loading records')
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='CACHE_DIR', type=str, required=False,
+                        help='A directory in which to cache parsed records between runs')
+    args = parser.parse_args(argv)
+    try:
+        export(find_record_files(args.build_dir), args.out_dir, args.format,
+               args.jobs, args.cache_dir)
+    except ValueError as e:
+        parser.error(str(e))
+
+# Subcommands, used when the first argument is one of these (rather than
+# a build directory)
+COMMANDS = {'ingest': ingest_main,
+            'search': search_main,
+            'query': query_main,
+            'export': export_main}
+
+if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+    COMMANDS[sys.argv[1]](sys.argv[2:])
+    sys.exit(0)
 
 parser = argparse.ArgumentParser(description="Parse the output of GCC's -fsave-optimization-record.")
 parser.add_argument('build_dir', metavar='BUILD_DIR', type=str,
                     help='The directory in which to look for .json.gz files')
 parser.add_argument('--output-dir', dest='output_dir', metavar='OUTPUT_DIR', type=str, required=False,
                     help='The directory to which to write .html output')
+parser.add_argument('--jobs', dest='jobs', metavar='N', type=int, required=False,
+                    help='The number of worker processes to use when loading records and writing HTML')
+parser.add_argument('--cache-dir', dest='cache_dir', metavar='CACHE_DIR', type=str, required=False,
+                    help='A directory in which to cache parsed records between runs')
+parser.add_argument('--incremental', dest='incremental', action='store_true',
+                    help='Only regenerate the parts of the static report in OUTPUT_DIR affected by changes since the previous run')
+parser.add_argument('--index-page-size', dest='index_page_size', metavar='N', type=int, required=False,
+                    help='Split the static index into pages of N records, with index.html just showing the hottest of them')
+parser.add_argument('--index-limit', dest='index_limit', metavar='K', type=int, required=False,
+                    help='Only show the K hottest records in the static index')
+parser.add_argument('--watch', dest='watch', action='store_true',
+                    help='When serving dynamic HTML, reload record files as they change on disk')
+parser.add_argument('--lazy', dest='lazy', action='store_true',
+                    help='When serving dynamic HTML, start after just scanning the record files, only fully loading them when needed')
+parser.add_argument('--max-loaded-tus', dest='max_loaded_tus', metavar='N', type=int, required=False,
+                    help='With --lazy, the number of fully-loaded record files to keep in memory')
+parser.add_argument('--memory-budget', dest='memory_budget', metavar='MB', type=int, required=False,
+                    help='With --lazy, roughly how many megabytes of fully-loaded records to keep in memory (implies --lazy)')
+parser.add_argument('--diff-against', dest='diff_against', metavar='OTHER_BUILD_DIR', type=str, required=False,
+                    help='Also report the records added, removed or flipped between success and failure since the build in OTHER_BUILD_DIR')
+parser.add_argument('--db', dest='db_path', metavar='DB_PATH', type=str, required=False,
+                    help='When serving dynamic HTML, query the records in DB_PATH (written by the ingest command) rather than loading them')
 args = parser.parse_args()
+if args.memory_budget is not None:
+    args.lazy = True
+if args.lazy and args.watch:
+    parser.error('--watch cannot be combined with --lazy')
+if args.lazy and args.diff_against and not args.output_dir:
+    parser.error('--diff-against cannot be combined with --lazy')
+if args.db_path and (args.lazy or args.watch or args.diff_against):
+    parser.error('--db cannot be combined with --lazy, --watch or'
+                 ' --diff-against')
 
 if args.output_dir:
     # Static HTML
-    generate_static_report(args.build_dir, args.output_dir)
+    generate_static_report(args.build_dir, args.output_dir, args.jobs,
+                           args.cache_dir, args.incremental,
+                           args.index_page_size, args.index_limit,
+                           args.diff_against)
 else:
     # Dynamic HTML
-    tus = find_records(args.build_dir)
+    from aggregates import RecordIndex
+    from highlight import Highlighter
     import server
-    server.app.tus = tus
+    if args.watch:
+        from watcher import RecordWatcher
+        watcher = RecordWatcher(server.app, args.build_dir, args.jobs,
+                                args.cache_dir)
+    if args.db_path:
+        from db import DatabaseIndex
+        server.app.index = DatabaseIndex(args.db_path)
+    elif args.lazy:
+        from lazy import LazyRecordIndex, TULoader, load_headers
+        headers = load_headers(find_record_files(args.build_dir), args.jobs,
+                               args.cache_dir)
+        loader = TULoader(args.cache_dir, args.max_loaded_tus,
+                          args.memory_budget and args.memory_budget << 20)
+        server.app.index = LazyRecordIndex(headers, loader)
+    else:
+        tus = find_records(args.build_dir, args.jobs, args.cache_dir)
+        server.app.index = RecordIndex(tus)
+    if args.watch:
+        watcher.start()
+    if args.diff_against:
+        server.app.diff_base_dir = args.diff_against
+        server.app.diff_base = find_records(args.diff_against, args.jobs,
+                                            args.cache_dir)
     server.app.build_dir = args.build_dir
+    if args.cache_dir:
+        server.app.highlighter = Highlighter(os.path.join(args.cache_dir,
+                                                          'highlight'))
     server.app.run()
@@ -1,21 +1,160 @@
 # TODO: license
+import codecs
 import gzip
 import json
+import re
+import sys
+
+# Version number for the output of the various to_compact methods; bump
+# this whenever their layout changes.
+COMPACT_FORMAT_VERSION = 2
+
+class JsonStream:
+    """
+    Incremental JSON reader for a binary file object, for decoding
+    the elements of a large array one at a time, so that neither the
+    whole document nor the whole decoded object tree need to be held
+    in memory at once.
+    """
+    CHUNK_SIZE = 1 << 16
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f):
+        self.f = f
+        self.utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.size = 0 # number of bytes read so far
+
+    def _read_more(self, size):
+        data = self.f.read(size)
+        self.size += len(data)
+        if not data:
+            self.eof = True
+        # Discard what we've already consumed
+        self.buf = (self.buf[self.pos:]
+                    + self.utf8_decoder.decode(data, final=self.eof))
+        self.pos = 0
+
+    def peek(self):
+        """
+        Skip whitespace, and return the next character, or '' at the end
+        of the file.
+        """
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._read_more(self.CHUNK_SIZE)
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError('expected %r at offset %i; got %r'
+                             % (ch, self.size - len(self.buf) + self.pos,
+                                self.peek()))
+        self.pos += 1
+
+    def decode_value(self):
+        """
+        Decode the next JSON value, reading as much more of the file as
+        is needed.
+        """
+        self.peek()
+        while True:
+            try:
+                obj, end = self.json_decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer might be
+                # continued in the next chunk.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Double the amount of pending text each time, so that a
+            # huge value isn't repeatedly reparsed from the start.
+            self._read_more(max(self.CHUNK_SIZE, len(self.buf) - self.pos))
+
+    def iter_array(self):
+        """
+        Generate the decoded elements of a JSON array, one at a time.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def expect_end(self):
+        if self.peek() != '':
+            raise ValueError('unexpected trailing data at offset %i'
+                             % (self.size - len(self.buf) + self.pos))
 
 class TranslationUnit:
     """Top-level class for containing optimization records"""
     @staticmethod
     def from_filename(filename):
         with gzip.open(filename) as f:
-            content = f.read()
-            size = len(content)
-        s = content.decode('utf-8')
-        root_obj = json.loads(s)
-        return TranslationUnit(filename, root_obj, size)
+            return TranslationUnit.from_stream(filename, JsonStream(f))
+
+    @staticmethod
+    def from_stream(filename, stream):
+        """
+        Build a TranslationUnit from a JsonStream, creating each top-level
+        Record as soon as its JSON has been read, and discarding the JSON.
+        """
+        # Expect a 3-tuple
+        stream.expect('[')
+        metadata = stream.decode_value()
+        stream.expect(',')
+        passes = stream.decode_value()
+        stream.expect(',')
+        tu = TranslationUnit(filename, [metadata, passes, []], None)
+        for obj in stream.iter_array():
+            tu.records.append(Record(obj, tu, 0))
+        stream.expect(']')
+        stream.expect_end()
+        tu.size = stream.size
+        tu.shared_objects.clear()
+        return tu
+
+    @staticmethod
+    def from_compact(compact):
+        """
+        Reconstruct a TranslationUnit from the result of to_compact.
+        """
+        (version, filename, size, format_, generator,
+         passes, records) = compact
+        if version != COMPACT_FORMAT_VERSION:
+            raise ValueError('unrecognized compact format version: %r'
+                             % version)
+        tu = TranslationUnit.__new__(TranslationUnit)
+        tu.filename = filename
+        tu.pass_by_id = {}
+        tu.shared_objects = {}
+        tu.size = size
+        tu.format = format_
+        tu.generator = Generator.from_compact(generator)
+        tu.passes = [Pass.from_compact(obj, tu) for obj in passes]
+        tu.records = [Record.from_compact(obj, tu, 0) for obj in records]
+        tu.shared_objects.clear()
+        return tu
 
     def __init__(self, filename, json_obj, size):
         self.filename = filename
         self.pass_by_id = {}
+        # Identical Location, ImplLocation and Count instances are shared
+        # whilst loading, keyed by (class, *fields).  This is emptied once
+        # loading is complete.
+        self.shared_objects = {}
         self.size = size # decompressed size
 
         # Expect a 3-tuple
@@ -25,22 +164,102 @@ class TranslationUnit:
         self.generator = Generator(metadata['generator'])
         self.passes = [Pass(obj, self) for obj in passes]
         self.records = [Record(obj, self, 0) for obj in records]
+        self.shared_objects.clear()
 
     def __repr__(self):
         return ('TranslationUnit(%r, %r, %r, %r)'
                 % (self.filename, self.generator, self.passes, self.records))
 
+    def to_compact(self, records=None):
+        """
+        Get a representation of this TranslationUnit built purely from
+        tuples, strings, numbers and None, suitable for the marshal module.
+
+        Rebuilding a TranslationUnit from this is much cheaper than
+        reparsing the JSON, or than unpickling the objects.
+
+        If records is set, include those records (along with their
+        children) instead of self.records; they become top-level records
+        of the rebuilt TranslationUnit.
+        """
+        if records is None:
+            records = self.records
+        return (COMPACT_FORMAT_VERSION, self.filename, self.size, self.format,
+                self.generator.to_compact(),
+                tuple(p.to_compact() for p in self.passes),
+                tuple(r.to_compact() for r in records))
+
+    @property
+    def records(self):
+        return self._records
+
+    @records.setter
+    def records(self, records):
+        self._records = records
+        # (recomputed when next needed)
+        self._num_all_records = None
+
     def iter_all_records(self):
-        for r in self.records:
-            yield r
-            for d in r.iter_all_descendants():
-                yield d
+        """
+        Iterate over all of the records, in pre-order.
+        """
+        return iter_preorder(self.records)
+
+    def walk(self, prune=None):
+        """
+        Generate (record, depth, parent) for all of the records, in
+        pre-order; see walk_records.
+        """
+        return walk_records(self.records, prune)
 
     def count_toplevel_records(self):
         return len(self.records)
 
     def count_all_records(self):
-        return len(list(self.iter_all_records()))
+        # The records can't change once loaded, other than by assigning to
+        # self.records, so the count is cached.
+        if self._num_all_records is None:
+            self._num_all_records = sum(1 for r in self.iter_all_records())
+        return self._num_all_records
+
+def iter_preorder(records):
+    """
+    Iterate over records and all of their descendants, in pre-order.
+
+    This uses an explicit stack, rather than nested generators, through
+    which each record would pass once for each level of its depth.
+    """
+    stack = list(reversed(records))
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+        record = pop()
+        yield record
+        if record.children:
+            extend(reversed(record.children))
+
+def walk_records(records, prune=None, parent=None, depth=0):
+    """
+    Generate (record, depth, parent) for records and all of their
+    descendants, in pre-order, where depth is relative to that of records,
+    and parent is None for records themselves (or the given parent).
+
+    If prune is set, it is called on each record; if it returns true, that
+    record and all of its descendants are skipped.
+    """
+    stack = [(record, depth, parent) for record in reversed(records)]
+    pop = stack.pop
+    while stack:
+        item = pop()
+        record = item[0]
+        if prune is not None and prune(record):
+            continue
+        yield item
+        children = record.children
+        if children:
+            child_depth = item[1] + 1
+            stack.extend([(child, child_depth, record)
+                          for child in reversed(children)])
 
 class Generator:
     """Metadata about what created the file"""
@@ -49,6 +268,15 @@ class Generator:
         for field in FIELDS:
             setattr(self, field, json_obj[field])
 
+    @staticmethod
+    def from_compact(compact):
+        g = Generator.__new__(Generator)
+        g.name, g.pkgversion, g.version, g.target = compact
+        return g
+
+    def to_compact(self):
+        return (self.name, self.pkgversion, self.version, self.target)
+
     def __repr__(self):
         return ('Generator(%r, %r, %r, %r)'
                 % (self.name, self.pkgversion, self.version, self.target))
@@ -65,21 +293,77 @@ class Pass:
         self.children = [Pass(child, tu)
                          for child in json_obj.get('children', [])]
 
+    @staticmethod
+    def from_compact(compact, tu):
+        p = Pass.__new__(Pass)
+        p.id_, p.name, p.num, optgroups, p.type, children = compact
+        p.optgroups = set(optgroups)
+        tu.pass_by_id[p.id_] = p
+        p.children = [Pass.from_compact(child, tu) for child in children]
+        return p
+
+    def to_compact(self):
+        return (self.id_, self.name, self.num, tuple(sorted(self.optgroups)),
+                self.type, tuple(child.to_compact() for child in self.children))
+
     def __repr__(self):
         return ('Pass(%r, %r, %r, %r)'
                 % (self.name, self.num, self.optgroups, self.type))
 
-def from_optional_json_field(cls, jsonobj, field):
+def from_optional_json_field(cls, jsonobj, field, tu):
     if field not in jsonobj:
         return None
-    return cls(jsonobj[field])
+    return cls.from_json(jsonobj[field], tu)
+
+def from_optional_compact(cls, compact, tu):
+    if compact is None:
+        return None
+    return cls.from_compact(compact, tu)
+
+def to_optional_compact(obj):
+    if obj is None:
+        return None
+    return obj.to_compact()
+
+def intern_optional(s):
+    if s is None:
+        return None
+    return sys.intern(s)
 
 class ImplLocation:
     """An implementation location (within the compiler itself)"""
+    __slots__ = ('file', 'line', 'function')
+
     def __init__(self, json_obj):
-        self.file = json_obj['file']
+        self.file = sys.intern(json_obj['file'])
         self.line = json_obj['line']
-        self.function = json_obj['function']
+        self.function = sys.intern(json_obj['function'])
+
+    @staticmethod
+    def from_json(json_obj, tu):
+        """
+        Get an ImplLocation for json_obj, shared with any identical
+        ImplLocation within tu.
+        """
+        key = (ImplLocation, json_obj['file'], json_obj['line'],
+               json_obj['function'])
+        loc = tu.shared_objects.get(key)
+        if loc is None:
+            loc = tu.shared_objects[key] = ImplLocation(json_obj)
+        return loc
+
+    @staticmethod
+    def from_compact(compact, tu):
+        key = (ImplLocation,) + compact
+        loc = tu.shared_objects.get(key)
+        if loc is None:
+            loc = ImplLocation.__new__(ImplLocation)
+            loc.file, loc.line, loc.function = compact
+            tu.shared_objects[key] = loc
+        return loc
+
+    def to_compact(self):
+        return (self.file, self.line, self.function)
 
     def __str__(self):
         return '%s:%i: %r' % (self.file, self.line, self.function)
@@ -90,11 +374,39 @@ class ImplLocation:
 
 class Location:
     """A source location"""
+    __slots__ = ('file', 'line', 'column')
+
     def __init__(self, json_obj):
-        self.file = json_obj['file']
+        self.file = sys.intern(json_obj['file'])
         self.line = json_obj['line']
         self.column = json_obj['column']
 
+    @staticmethod
+    def from_json(json_obj, tu):
+        """
+        Get a Location for json_obj, shared with any identical Location
+        within tu.
+        """
+        key = (Location, json_obj['file'], json_obj['line'],
+               json_obj['column'])
+        loc = tu.shared_objects.get(key)
+        if loc is None:
+            loc = tu.shared_objects[key] = Location(json_obj)
+        return loc
+
+    @staticmethod
+    def from_compact(compact, tu):
+        key = (Location,) + compact
+        loc = tu.shared_objects.get(key)
+        if loc is None:
+            loc = Location.__new__(Location)
+            loc.file, loc.line, loc.column = compact
+            tu.shared_objects[key] = loc
+        return loc
+
+    def to_compact(self):
+        return (self.file, self.line, self.column)
+
     def __str__(self):
         return '%s:%i:%i' % (self.file, self.line, self.column)
 
@@ -104,10 +416,36 @@ class Location:
 
 class Count:
     """An execution count"""
+    __slots__ = ('quality', 'value')
+
     def __init__(self, json_obj):
-        self.quality = json_obj['quality']
+        self.quality = sys.intern(json_obj['quality'])
         self.value = int(json_obj['value'])
 
+    @staticmethod
+    def from_json(json_obj, tu):
+        """
+        Get a Count for json_obj, shared with any identical Count within tu.
+        """
+        key = (Count, json_obj['quality'], json_obj['value'])
+        count = tu.shared_objects.get(key)
+        if count is None:
+            count = tu.shared_objects[key] = Count(json_obj)
+        return count
+
+    @staticmethod
+    def from_compact(compact, tu):
+        key = (Count,) + compact
+        count = tu.shared_objects.get(key)
+        if count is None:
+            count = Count.__new__(Count)
+            count.quality, count.value = compact
+            tu.shared_objects[key] = count
+        return count
+
+    def to_compact(self):
+        return (self.quality, self.value)
+
     def __repr__(self):
         return ('Count(%r, %r)'
                 % (self.quality, self.value))
@@ -117,26 +455,79 @@ class Count:
 
 class Record:
     """A optimization record: success/failure/note"""
+    __slots__ = ('kind', 'pass_', 'function', 'impl_location', 'message',
+                 'count', 'location', 'inlining_chain', 'depth', 'children')
+
     def __init__(self, json_obj, tu, depth):
-        self.kind = json_obj['kind']
+        self.kind = sys.intern(json_obj['kind'])
         if 'pass' in json_obj:
             self.pass_ = tu.pass_by_id[json_obj['pass']]
         else:
             self.pass_ = None
-        self.function = json_obj.get('function', None)
+        self.function = intern_optional(json_obj.get('function', None))
         self.impl_location = from_optional_json_field(ImplLocation, json_obj,
-                                                      'impl_location')
-        self.message = [Item.from_json(obj) for obj in json_obj['message']]
-        self.count = from_optional_json_field(Count, json_obj, 'count')
-        self.location = from_optional_json_field(Location, json_obj, 'location')
+                                                      'impl_location', tu)
+        self.message = tuple([Item.from_json(obj, tu)
+                              for obj in json_obj['message']])
+        self.count = from_optional_json_field(Count, json_obj, 'count', tu)
+        self.location = from_optional_json_field(Location, json_obj,
+                                                 'location', tu)
         if 'inlining_chain' in json_obj:
-            self.inlining_chain = [InliningNode(obj)
-                                   for obj in json_obj['inlining_chain']]
+            self.inlining_chain = tuple([InliningNode(obj, tu)
+                                         for obj in json_obj['inlining_chain']])
         else:
             self.inlining_chain = None
         self.depth = depth
-        self.children = [Record(child, tu, depth + 1)
-                         for child in json_obj.get('children', [])]
+        if 'children' in json_obj:
+            self.children = tuple([Record(child, tu, depth + 1)
+                                   for child in json_obj['children']])
+        else:
+            self.children = ()
+
+    @staticmethod
+    def from_compact(compact, tu, depth):
+        (kind, pass_id, function, impl_location, message, count, location,
+         inlining_chain, children) = compact
+        r = Record.__new__(Record)
+        r.kind = kind
+        if pass_id is not None:
+            r.pass_ = tu.pass_by_id[pass_id]
+        else:
+            r.pass_ = None
+        r.function = function
+        r.impl_location = from_optional_compact(ImplLocation, impl_location,
+                                                tu)
+        r.message = tuple([Item.from_compact(obj, tu) for obj in message])
+        r.count = from_optional_compact(Count, count, tu)
+        r.location = from_optional_compact(Location, location, tu)
+        if inlining_chain is not None:
+            r.inlining_chain = tuple([InliningNode.from_compact(obj, tu)
+                                      for obj in inlining_chain])
+        else:
+            r.inlining_chain = None
+        r.depth = depth
+        if children:
+            r.children = tuple([Record.from_compact(child, tu, depth + 1)
+                                for child in children])
+        else:
+            r.children = ()
+        return r
+
+    def to_compact(self):
+        if self.inlining_chain is not None:
+            inlining_chain = tuple(node.to_compact()
+                                   for node in self.inlining_chain)
+        else:
+            inlining_chain = None
+        return (self.kind,
+                self.pass_.id_ if self.pass_ else None,
+                self.function,
+                to_optional_compact(self.impl_location),
+                tuple(Item.to_compact(item) for item in self.message),
+                to_optional_compact(self.count),
+                to_optional_compact(self.location),
+                inlining_chain,
+                tuple(child.to_compact() for child in self.children))
 
     def __repr__(self):
         return ('Record(kind=%r, pass_%r, function=%r, impl_location=%r,'
@@ -147,20 +538,29 @@ class Record:
                    self.children))
 
     def iter_all_descendants(self):
-        for c in self.children:
-            yield c
-            # Recurse:
-            for d in c.iter_all_descendants():
-                yield d
+        return iter_preorder(self.children)
 
     def is_toplevel(self):
         return self.depth == 0
 
 class InliningNode:
     """A node within an inlining chain"""
-    def __init__(self, json_obj):
-        self.fndecl = json_obj['fndecl']
-        self.site = from_optional_json_field(Location, json_obj, 'site')
+    __slots__ = ('fndecl', 'site')
+
+    def __init__(self, json_obj, tu):
+        self.fndecl = sys.intern(json_obj['fndecl'])
+        self.site = from_optional_json_field(Location, json_obj, 'site', tu)
+
+    @staticmethod
+    def from_compact(compact, tu):
+        node = InliningNode.__new__(InliningNode)
+        fndecl, site = compact
+        node.fndecl = fndecl
+        node.site = from_optional_compact(Location, site, tu)
+        return node
+
+    def to_compact(self):
+        return (self.fndecl, to_optional_compact(self.site))
 
     def __repr__(self):
         return ('InliningNode(%r, %r)'
@@ -168,24 +568,48 @@ class InliningNode:
 
 class Item:
     """Base class for non-string items within a message"""
+    __slots__ = ()
+
     @staticmethod
-    def from_json(json_obj):
+    def from_json(json_obj, tu):
         if isinstance(json_obj, str):
-            return json_obj
+            return sys.intern(json_obj)
         if 'expr' in json_obj:
-            return Expr(json_obj)
+            return Expr(json_obj, tu)
         elif 'stmt' in json_obj:
-            return Stmt(json_obj)
+            return Stmt(json_obj, tu)
         elif 'symtab_node' in json_obj:
-            return SymtabNode(json_obj)
+            return SymtabNode(json_obj, tu)
         else:
             raise ValueError('unrecognized item: %r' % json_obj)
 
+    @staticmethod
+    def from_compact(compact, tu):
+        if isinstance(compact, str):
+            return compact
+        kind, text, location = compact
+        item = ITEM_CLASSES[kind].__new__(ITEM_CLASSES[kind])
+        setattr(item, item.TEXT_FIELD, text)
+        item.location = from_optional_compact(Location, location, tu)
+        return item
+
+    @staticmethod
+    def to_compact(item):
+        if isinstance(item, str):
+            return item
+        return (ITEM_CLASSES.index(type(item)),
+                getattr(item, item.TEXT_FIELD),
+                to_optional_compact(item.location))
+
 class Expr(Item):
     """An expression within a message"""
-    def __init__(self, json_obj):
-        self.expr = json_obj['expr']
-        self.location = from_optional_json_field(Location, json_obj, 'location')
+    __slots__ = ('expr', 'location')
+    TEXT_FIELD = 'expr'
+
+    def __init__(self, json_obj, tu):
+        self.expr = sys.intern(json_obj['expr'])
+        self.location = from_optional_json_field(Location, json_obj,
+                                                 'location', tu)
 
     def __str__(self):
         return self.expr
@@ -195,9 +619,13 @@ class Expr(Item):
 
 class Stmt(Item):
     """A statement within a message"""
-    def __init__(self, json_obj):
-        self.stmt = json_obj['stmt']
-        self.location = from_optional_json_field(Location, json_obj, 'location')
+    __slots__ = ('stmt', 'location')
+    TEXT_FIELD = 'stmt'
+
+    def __init__(self, json_obj, tu):
+        self.stmt = sys.intern(json_obj['stmt'])
+        self.location = from_optional_json_field(Location, json_obj,
+                                                 'location', tu)
 
     def __str__(self):
         return self.stmt
@@ -207,9 +635,13 @@ class Stmt(Item):
 
 class SymtabNode(Item):
     """A symbol table node within a message"""
-    def __init__(self, json_obj):
-        self.node = json_obj['symtab_node']
-        self.location = from_optional_json_field(Location, json_obj, 'location')
+    __slots__ = ('node', 'location')
+    TEXT_FIELD = 'node'
+
+    def __init__(self, json_obj, tu):
+        self.node = sys.intern(json_obj['symtab_node'])
+        self.location = from_optional_json_field(Location, json_obj,
+                                                 'location', tu)
 
     def __str__(self):
         return self.node
@@ -217,3 +649,6 @@ class SymtabNode(Item):
     def __repr__(self):
         return 'SymtabNode(%r, %r)' % (self.node, self.location)
 
+
+# The order of this list is part of the compact format.
+ITEM_CLASSES = [Expr, Stmt, SymtabNode]
@@ -0,0 +1,222 @@
+# TODO: license
+import itertools
+
+from utils import get_message_text
+
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 10000
+
+class Page:
+    """
+    Part of a sequence of records ordered by hotness.
+
+    offset is the position within the sequence at which the page starts,
+    and next_cursor the position at which the next page starts (or None);
+    following next_cursor visits each matching record exactly once.  total
+    is the number of matching records, or None if that isn't known without
+    a full scan (for a filtered query).
+    """
+    def __init__(self, records, offset, limit, total, next_cursor):
+        self.records = records
+        self.offset = offset
+        self.limit = limit
+        self.total = total
+        self.next_cursor = next_cursor
+
+    @property
+    def number(self):
+        return self.offset // self.limit + 1
+
+    @property
+    def num_pages(self):
+        return max(1, (self.total + self.limit - 1) // self.limit)
+
+    @property
+    def first(self):
+        """The 1-based index of the first record in this page, or 0"""
+        if not self.records:
+            return 0
+        return self.offset + 1
+
+    @property
+    def last(self):
+        """The 1-based index of the last record in this page, or 0"""
+        if not self.records:
+            return 0
+        return self.offset + len(self.records)
+
+    @property
+    def prev_cursor(self):
+        if self.offset == 0:
+            return None
+        if self.total is None:
+            # We'd need to scan backwards to find the start of the
+            # previous page of matches; just go back to the start.
+            return 0
+        return max(0, min(self.offset, self.total) - self.limit)
+
+def get_page_bounds(page=None, limit=None, cursor=None):
+    """
+    Get the (offset, limit) for a request for the given 1-based page
+    number, or for the page starting at cursor (which takes precedence).
+    Any of the arguments can be None, or out of range.
+    """
+    if limit is None or limit < 1:
+        limit = DEFAULT_PAGE_SIZE
+    limit = min(limit, MAX_PAGE_SIZE)
+    if cursor is not None and cursor >= 0:
+        return cursor, limit
+    if page is not None and page >= 1:
+        return (page - 1) * limit, limit
+    return 0, limit
+
+def get_count_value(record):
+    if not record.count:
+        return 0
+    return record.count.value
+
+class RecordQuery:
+    """
+    Criteria for selecting records from a RecordIndex, shared by the HTML
+    views and the JSON API.  Any of the criteria can be None.
+    """
+    def __init__(self, passname=None, function=None, sourcefile=None,
+                 kind=None, min_count=None):
+        self.passname = passname
+        self.function = function
+        self.sourcefile = sourcefile
+        self.kind = kind
+        self.min_count = min_count
+
+    @staticmethod
+    def from_args(args, **kwargs):
+        """
+        Build a RecordQuery from the query parameters of a request, with
+        kwargs overriding them.
+        """
+        query = RecordQuery(args.get('pass'),
+                            args.get('function'),
+                            args.get('file'),
+                            args.get('kind'),
+                            args.get('min_count', type=int))
+        for name, value in kwargs.items():
+            setattr(query, name, value)
+        return query
+
+    def is_filtered(self):
+        """
+        Are there criteria beyond the pass, so that we need to scan?
+        """
+        return (self.function is not None
+                or self.sourcefile is not None
+                or self.kind is not None
+                or self.min_count is not None)
+
+    def matches(self, record):
+        if self.function is not None and record.function != self.function:
+            return False
+        if self.sourcefile is not None:
+            if not record.location or record.location.file != self.sourcefile:
+                return False
+        if self.kind is not None and record.kind != self.kind:
+            return False
+        if self.min_count is not None and not record.count:
+            return False
+        return True
+
+    def iter_matches(self, index, offset):
+        """
+        Generate (position, record) pairs for the matching records at or
+        after offset within the records (from the pass, if any) in hotness
+        order.
+        """
+        return index.iter_matches(self, offset)
+
+    def filter_records(self, records, offset):
+        """
+        Generate (position, record) pairs for the matching records within
+        records, the records at or after offset in the order of
+        iter_matches.
+        """
+        candidates = zip(itertools.count(offset), records)
+        if self.min_count is not None:
+            # The sequence is ordered by hotness, so we can stop as soon as
+            # we reach a record that's too cold.
+            min_count = self.min_count
+            candidates = itertools.takewhile(
+                lambda pair: get_count_value(pair[1]) >= min_count,
+                candidates)
+        return ((pos, record) for pos, record in candidates
+                if self.matches(record))
+
+    def iter_page(self, index, offset, limit, cursor_out):
+        """
+        Generate the records in the page of at most limit matches starting
+        at offset.  Once exhausted, cursor_out[0] is the next_cursor.
+        """
+        matches = self.iter_matches(index, offset)
+        for pos, record in itertools.islice(matches, limit):
+            yield record
+        cursor_out[0] = next(matches, (None,))[0]
+
+    def get_page(self, index, offset, limit):
+        """
+        Get the Page of at most limit matches starting at offset.
+        """
+        if not self.is_filtered():
+            # Fast path: slice the hotness-ordered records directly
+            total = index.count_records(self.passname)
+            end = offset + limit
+            records = index.get_range(offset, end, self.passname)
+            next_cursor = end if end < total else None
+            return Page(records, offset, limit, total, next_cursor)
+        cursor_out = [None]
+        records = list(self.iter_page(index, offset, limit, cursor_out))
+        return Page(records, offset, limit, None, cursor_out[0])
+
+def location_to_json(loc):
+    if not loc:
+        return None
+    return {'file': loc.file, 'line': loc.line, 'column': loc.column}
+
+RECORD_FIELDS = {
+    'kind': lambda r: r.kind,
+    'pass': lambda r: r.pass_.name if r.pass_ else None,
+    'function': lambda r: r.function,
+    'location': lambda r: location_to_json(r.location),
+    'count': lambda r: ({'quality': r.count.quality, 'value': r.count.value}
+                        if r.count else None),
+    'message': get_message_text,
+    'impl_location': lambda r: ({'file': r.impl_location.file,
+                                 'line': r.impl_location.line,
+                                 'function': r.impl_location.function}
+                                if r.impl_location else None),
+    'inlining_chain': lambda r: ([{'fndecl': node.fndecl,
+                                   'site': location_to_json(node.site)}
+                                  for node in r.inlining_chain]
+                                 if r.inlining_chain is not None else None),
+    'depth': lambda r: r.depth,
+    'num_children': lambda r: len(r.children),
+}
+
+DEFAULT_RECORD_FIELDS = ('kind', 'pass', 'function', 'location', 'count',
+                         'message')
+
+def get_record_fields(fields_arg):
+    """
+    Parse a comma-separated list of field names (or None, for the
+    defaults), raising ValueError for unknown fields.
+    """
+    if not fields_arg:
+        return DEFAULT_RECORD_FIELDS
+    fields = tuple(fields_arg.split(','))
+    for field in fields:
+        if field not in RECORD_FIELDS:
+            raise ValueError('unknown field: %r' % field)
+    return fields
+
+def record_to_json(record, fields):
+    """
+    Get a JSON-compatible dict for record, containing just the given fields.
+    """
+    return {field: RECORD_FIELDS[field](record) for field in fields}
@@ -0,0 +1,159 @@
+# TODO: license
+from array import array
+from bisect import bisect_left
+import heapq
+import re
+
+from query import get_count_value
+from utils import get_message_text
+
+# Messages are split into lowercased runs of letters, digits and
+# underscores, so that e.g. "data-type" is the phrase "data type"
+TOKEN_RE = re.compile(r'\w+')
+
+# Query words, and double-quoted phrases
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+EMPTY_POSTINGS = array('I')
+
+class SearchQuery:
+    """
+    A parsed search query: every term must match a token of the message
+    (or of the function name) of a record, and every phrase must match
+    consecutive tokens.
+
+    Terms are words, or prefixes where a word ends with "*".  A
+    double-quoted phrase, or a word made up of several tokens (such as
+    "data-type"), adds its tokens as terms, and itself as a phrase.
+    """
+    def __init__(self, text):
+        self.text = text
+        # List of (token, is_prefix)
+        self.terms = []
+        # List of lists of tokens
+        self.phrases = []
+        for m in QUERY_RE.finditer(text):
+            if m.group(1) is not None:
+                tokens = tokenize(m.group(1))
+                is_prefix = False
+            else:
+                tokens = tokenize(m.group(2))
+                is_prefix = m.group(2).endswith('*')
+            for i, token in enumerate(tokens):
+                self.terms.append((token, is_prefix and i == len(tokens) - 1))
+            if len(tokens) > 1 and not is_prefix:
+                self.phrases.append(tokens)
+
+def get_phrase_text(tokens):
+    return ' %s ' % ' '.join(tokens)
+
+class SearchIndex:
+    """
+    Inverted index of the tokens within the messages and function names of
+    a list of records, sorted by highest-count down to lowest-count.
+
+    Each record is identified by its position within that list, so the
+    postings for each token (the positions of the records containing it,
+    in ascending order) list the records in hotness order, and results
+    come out already ranked by hotness, with searches only reading as far
+    into the postings as is needed for the results requested.
+    """
+    def __init__(self, records):
+        self.records = records
+        postings = {}
+        # Mapping of text to its distinct tokens, as many records share the
+        # same message
+        tokens_for_text = {}
+        for doc, record in enumerate(records):
+            for text in (get_message_text(record), record.function):
+                if not text:
+                    continue
+                tokens = tokens_for_text.get(text)
+                if tokens is None:
+                    tokens = tokens_for_text[text] = set(tokenize(text))
+                for token in tokens:
+                    docs = postings.get(token)
+                    if docs is None:
+                        docs = postings[token] = array('I')
+                    # (a token in both the message and the function name is
+                    # only listed once)
+                    if not docs or docs[-1] != doc:
+                        docs.append(doc)
+        self.postings = postings
+        # All of the tokens, sorted, for finding those with a given prefix
+        self.tokens = sorted(postings)
+
+    def get_postings(self, token, is_prefix):
+        """
+        Get the sorted positions of the records containing token (or any
+        token starting with it).
+        """
+        if not is_prefix:
+            return self.postings.get(token, EMPTY_POSTINGS)
+        lists = []
+        i = bisect_left(self.tokens, token)
+        while i < len(self.tokens) and self.tokens[i].startswith(token):
+            lists.append(self.postings[self.tokens[i]])
+            i += 1
+        if len(lists) == 1:
+            return lists[0]
+        # Merge the (already sorted) postings, dropping records listed
+        # under several of the tokens
+        merged = array('I')
+        last = None
+        for doc in heapq.merge(*lists):
+            if doc != last:
+                merged.append(doc)
+                last = doc
+        return merged
+
+    def matches_phrases(self, record, phrases):
+        texts = [get_phrase_text(tokenize(get_message_text(record)))]
+        if record.function:
+            texts.append(get_phrase_text(tokenize(record.function)))
+        return all(any(get_phrase_text(phrase) in text for text in texts)
+                   for phrase in phrases)
+
+    def search(self, query, passname=None, kind=None, min_count=None,
+               start=0):
+        """
+        Generate (position, record) for the records matching a SearchQuery
+        (and from the given pass, of the given kind, and with at least
+        min_count, if set), hottest first, from position start onwards.
+        """
+        if not query.terms:
+            return
+        # Walk the shortest postings, looking each position up in the others
+        lists = sorted((self.get_postings(token, is_prefix)
+                        for token, is_prefix in query.terms), key=len)
+        first = lists[0]
+        others = lists[1:]
+        # The position within each of others from which to look
+        lows = [0] * len(others)
+        for i in range(bisect_left(first, start), len(first)):
+            doc = first[i]
+            for j, other in enumerate(others):
+                k = lows[j] = bisect_left(other, doc, lows[j])
+                if k == len(other) or other[k] != doc:
+                    break
+            else:
+                record = self.records[doc]
+                if min_count is not None:
+                    # The records are ordered by hotness, so we can stop as
+                    # soon as we reach one that's too cold.
+                    if get_count_value(record) < min_count:
+                        return
+                    if not record.count:
+                        continue
+                if passname is not None:
+                    if not record.pass_ or record.pass_.name != passname:
+                        continue
+                if kind is not None and record.kind != kind:
+                    continue
+                if query.phrases and not self.matches_phrases(record,
+                                                              query.phrases):
+                    continue
+                yield doc, record
@@ -1,27 +1,37 @@
 # TODO: license
 import html
-import os
-import urllib
+import itertools
+import json
+import urllib.parse
 
-from flask import Flask, render_template, Markup
-import pygments.lexers
-import pygments.styles
-import pygments.formatters
+from flask import (Flask, abort, render_template, request, Markup, Response,
+                   stream_with_context)
+from werkzeug.security import safe_join
 
+from clusters import CLUSTER_SORT_KEYS, MessageClusters
+from diff import RecordDiff
+
+from highlight import Highlighter
+from lazy import StaleRecordFileError
 from optrecord import TranslationUnit, Record, Expr, Stmt, SymtabNode
-from utils import get_effective_result
+from query import (get_page_bounds, get_record_fields, location_to_json,
+                   record_to_json, Page, RecordQuery)
+from search import SearchQuery
+from utils import get_effective_result, is_record_shown
 
 app = Flask(__name__)
 
-def record_sort_key(record):
-    if not record.count:
-        return 0
-    return -record.count.value
+# Replaced by opt-viewer.py with one using the --cache-dir (if any)
+app.highlighter = Highlighter()
 
-def iter_all_records(app):
-    for tu in app.tus:
-        for r in tu.iter_all_records():
-            yield r
+# Set by opt-viewer.py to the directory and TranslationUnits of the build
+# given by --diff-against (if any)
+app.diff_base_dir = None
+app.diff_base = None
+# (index, RecordDiff from app.diff_base to that index)
+app.diff_cache = None
+# (index, MessageClusters of its records)
+app.clusters_cache = None
 
 def get_summary_text(record):
     '''
@@ -105,161 +115,377 @@ def url_from_sourcefile(sourcefile):
 def url_from_pass(passname):
     return '/pass/%s' % passname
 
+def url_for_cursor(cursor):
+    """
+    Get the URL for the current view, but starting at cursor, keeping any
+    other query parameters.
+    """
+    args = request.args.to_dict()
+    args.pop('page', None)
+    args['cursor'] = cursor
+    return '%s?%s' % (request.path, urllib.parse.urlencode(args))
+
 @app.context_processor
 def utility_processor():
     """Expose the various functions to the context of the app's templates."""
     return dict(url_from_location=url_from_location,
                 url_from_sourcefile=url_from_sourcefile,
                 url_from_pass=url_from_pass,
+                url_for_cursor=url_for_cursor,
                 get_color_for_record=get_color_for_record,
                 get_markup_for_record=get_markup_for_record)
 
-class Function:
-    def __init__(self, name, sourcefile, hotness, tu, peak_location):
-        self.name = name
-        self.sourcefile = sourcefile
-        self.hotness = hotness
-        self.tu = tu
-        self.peak_location = peak_location
-
 @app.route("/")
 def index():
-    # Gather all records
-    records = list(iter_all_records(app))
-
-    # Sort by highest-count down to lowest-count
-    records = sorted(records, key=record_sort_key)
-
-    # Mapping of name to Function
-    functions = {}
-    for tu in app.tus:
-        for r in tu.iter_all_records():
-            if r.count:
-                hotness = r.count.value
-            else:
-                hotness = 0
-            funcname = r.function
-            if not funcname:
-                continue
-            if r.location:
-                sourcefile = r.location.file
-            else:
-                sourcefile = None
-            if funcname not in functions:
-                functions[funcname] = Function(funcname, sourcefile,
-                                               hotness, tu.filename, r.location)
-            else:
-                f = functions[funcname]
-                if not f.sourcefile:
-                    f.sourcefile = sourcefile
-                if f.hotness < hotness:
-                    f.hotness = hotness
-                if r.location:
-                    if f.hotness < hotness or not f.peak_location:
-                        f.peak_location = r.location
-
-    # Mapping of passname to [passname ,num top-level records, num overall records]
-    passes = {}
-    for tu in app.tus:
-        for r in tu.iter_all_records():
-            if r.pass_:
-                passname = r.pass_.name
-            else:
-                passname = None
-            if passname not in passes:
-                passes[passname] = [passname, 0, 0]
-            if r.is_toplevel():
-                passes[passname][1] += 1
-            passes[passname][2] += 1
-
+    index = app.index
     return render_template('index.html',
-                           records=records,
-                           functions=sorted(list(functions.values()),
-                                            key=lambda f: f.hotness,
-                                            reverse=True),
-                           tus = app.tus,
-                           total_size = sum([tu.size for tu in app.tus]),
-                           count_top_level = sum([len(tu.records) for tu in app.tus]),
-                           count_all  = sum([tu.count_all_records() for tu in app.tus]),
-                           passes=sorted(passes.values()))
+                           functions=index.functions,
+                           tus=index.summaries,
+                           total_size=index.total_size,
+                           count_top_level=index.count_top_level,
+                           count_all=index.count_all,
+                           passes=index.passes,
+                           diff_base_dir=app.diff_base_dir)
 
 @app.route("/all-tus")
 def all_tus():
-    return "tus: %r" % app.tus
+    return "tus: %r" % app.index.tus
+
+def get_requested_bounds():
+    """
+    Get the (offset, limit) requested via the "page", "limit" and "cursor"
+    query parameters.
+    """
+    return get_page_bounds(request.args.get('page', type=int),
+                           request.args.get('limit', type=int),
+                           request.args.get('cursor', type=int))
 
 @app.route("/pass/<passname>")
 def pass_(passname):
-    # Gather records from the given pass
-    records = [r for r in iter_all_records(app)
-               if r.pass_.name == passname]
-
-    # Sort by highest-count down to lowest-count
-    records = sorted(records, key=record_sort_key)
+    # Records from the given pass, sorted by highest-count down to
+    # lowest-count
+    query = RecordQuery.from_args(request.args, passname=passname)
 
     return render_template('pass.html',
-                           records=records,
+                           page=query.get_page(app.index,
+                                               *get_requested_bounds()),
                            passname=passname)
 
-@app.route("/sourcefile/<sourcefile>")
+@app.route("/sourcefile/<path:sourcefile>")
 def sourcefile(sourcefile):
-    # FIXME: this allows arbitrary reading of files on this machine:
-    with open(os.path.join(app.build_dir, sourcefile)) as f:
-        code = f.read()
-
-    style = pygments.styles.get_style_by_name('default')
-    formatter = pygments.formatters.HtmlFormatter()
-    lexer = pygments.lexers.guess_lexer_for_filename(sourcefile, code)
-
-    # Use pygments to convert it all to HTML:
-    code_as_html = pygments.highlight(code, lexer, formatter)
-
-    if 0:
-        print(code_as_html)
-        print('*' * 76)
-        print(repr(code_as_html))
-        print('*' * 76)
-
-    EXPECTED_START = '<div class="highlight"><pre>'
-    assert code_as_html.startswith(EXPECTED_START)
-    code_as_html = code_as_html[len(EXPECTED_START):-1]
-
-    EXPECTED_END = '</pre></div>'
-    assert code_as_html.endswith(EXPECTED_END)
-    code_as_html = code_as_html[0:-len(EXPECTED_END)]
-
-    html_lines = [Markup(line) for line in code_as_html.splitlines()]
-
-    # Gather top-level records affecting this source file:
-    records = []
-    for tu in app.tus:
-        for r in tu.records:
-            if not r.location:
-                continue
-            if r.location.file != sourcefile:
-                continue
-            records.append(r)
-
-    # Group by line num
-    by_line_num = {}
-    for record in records:
-        line_num = record.location.line
-        if line_num not in by_line_num:
-            by_line_num[line_num] = []
-        by_line_num[line_num].append(record)
+    # (safe_join rejects paths outside of the build directory)
+    path = safe_join(app.build_dir, sourcefile)
+    if path is None:
+        abort(404)
+    try:
+        with open(path) as f:
+            code = f.read()
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        abort(404)
+
+    html_lines = [Markup(line)
+                  for line in app.highlighter.get_html_lines(sourcefile, code)]
+
+    # Top-level records affecting this source file, by line num:
+    by_line_num = app.index.sourcefile_index.get_records_by_line(
+        sourcefile, toplevel_only=True)
 
     return render_template('sourcefile.html',
                            sourcefile=sourcefile,
                            lines=html_lines,
                            records_by_line_num=by_line_num,
-                           css = formatter.get_style_defs())
+                           css = app.highlighter.get_style_defs())
 
 @app.route("/records")
 def records():
-    # Gather all records
-    records = list(iter_all_records(app))
-
-    # Sort by highest-count down to lowest-count
-    records = sorted(records, key=record_sort_key)
+    # All records, sorted by highest-count down to lowest-count
+    query = RecordQuery.from_args(request.args)
 
     return render_template('records.html',
-                           records=records)
+                           page=query.get_page(app.index,
+                                               *get_requested_bounds()))
+
+def get_diff():
+    """
+    Get the RecordDiff from app.diff_base to the current index, computed
+    once per index (which is replaced by the watcher as records change).
+
+    Only the records shown by the static report are compared, so that its
+    diff.html lists the same changes.
+    """
+    if app.diff_base is None:
+        abort(404)
+    index = app.index
+    cached = app.diff_cache
+    if cached is None or cached[0] is not index:
+        cached = app.diff_cache = (index, RecordDiff(app.diff_base,
+                                                     index.tus,
+                                                     is_record_shown))
+    return cached[1]
+
+def get_list_page(items):
+    offset, limit = get_requested_bounds()
+    end = offset + limit
+    return Page(items[offset:end], offset, limit, len(items),
+                end if end < len(items) else None)
+
+@app.route("/diff")
+def diff():
+    # Changes since the --diff-against build, optionally of just one
+    # "kind", hottest first
+    diff = get_diff()
+    kind = request.args.get('kind')
+    return render_template('diff.html',
+                           diff=diff,
+                           kind=kind,
+                           base_dir=app.diff_base_dir,
+                           page=get_list_page(diff.get_changes(kind)))
+
+def get_clusters():
+    """
+    Get the MessageClusters of the records of the current index, computed
+    once per index in a single pass over them.
+    """
+    index = app.index
+    cached = app.clusters_cache
+    if cached is None or cached[0] is not index:
+        clusters = MessageClusters()
+        clusters.add_records(index.iter_records())
+        cached = app.clusters_cache = (index, clusters)
+    return cached[1]
+
+def get_sorted_clusters():
+    """
+    Get the list of clusters, sorted by the "sort" query parameter (by
+    hotness by default).
+    """
+    sort = request.args.get('sort', 'hotness')
+    if sort not in CLUSTER_SORT_KEYS:
+        abort(400)
+    return get_clusters().get_sorted(sort)
+
+@app.route("/clusters")
+def clusters():
+    # Records grouped by pass and message template
+    clusters = get_sorted_clusters()
+    return render_template('clusters.html',
+                           sort=request.args.get('sort', 'hotness'),
+                           page=get_list_page(clusters))
+
+def iter_search_matches(offset):
+    """
+    Generate (position, record) for the records matching the "q" search
+    query, filtered by the "pass", "kind" and "min_count" query
+    parameters, hottest first, from offset onwards.
+    """
+    search_index = app.index.get_search_index()
+    if search_index is None:
+        abort(404)
+    # (the search form submits empty fields for unused filters)
+    return search_index.search(SearchQuery(request.args.get('q', '')),
+                               request.args.get('pass') or None,
+                               request.args.get('kind') or None,
+                               request.args.get('min_count', type=int),
+                               offset)
+
+def iter_search_page(matches, limit, cursor_out):
+    for pos, record in itertools.islice(matches, limit):
+        yield record
+    cursor_out[0] = next(matches, (None,))[0]
+
+@app.route("/search")
+def search():
+    # Records whose messages (or function names) match the "q" query,
+    # hottest first
+    offset, limit = get_requested_bounds()
+    cursor_out = [None]
+    records = list(iter_search_page(iter_search_matches(offset), limit,
+                                     cursor_out))
+    return render_template('search.html',
+                           q=request.args.get('q', ''),
+                           page=Page(records, offset, limit, None,
+                                     cursor_out[0]))
+
+############################################################################
+# JSON API
+
+JSON_SEPARATORS = (',', ':')
+
+def iter_json_list(items, to_json, cursor_out):
+    """
+    Generate the text of a JSON object containing a list of items
+    (converted using to_json), followed by the next_cursor, which is only
+    known once items has been consumed.
+    """
+    items = iter(items)
+    # (getting the first item before anything is generated; see
+    # json_stream_response)
+    first = list(itertools.islice(items, 1))
+    yield '{"items":['
+    for i, item in enumerate(itertools.chain(first, items)):
+        if i:
+            yield ','
+        yield json.dumps(to_json(item), separators=JSON_SEPARATORS)
+    yield '],"next_cursor":%s}' % json.dumps(cursor_out[0])
+
+def json_stream_response(chunks):
+    # (the first chunk is generated here, so that an error from getting the
+    # first of the items is reported as such, rather than as a truncated
+    # response)
+    first = next(chunks)
+    return Response(stream_with_context(itertools.chain([first], chunks)),
+                    mimetype='application/json')
+
+def json_error(message, status=400):
+    return Response(json.dumps({'error': message}), status=status,
+                    mimetype='application/json')
+
+@app.errorhandler(StaleRecordFileError)
+def stale_record_file(e):
+    # With --lazy, a record file was rebuilt after the server started
+    message = '%s; restart the server to reindex the records' % e
+    if request.path.startswith('/api/'):
+        return json_error(message, 409)
+    return html.escape(message), 409
+
+@app.route("/api/records")
+def api_records():
+    """
+    Records in hotness order, filtered by the "pass", "function", "file",
+    "kind" and "min_count" query parameters, paginated via "page", "limit"
+    and "cursor", with the given comma-separated "fields".
+    """
+    try:
+        fields = get_record_fields(request.args.get('fields'))
+    except ValueError as e:
+        return json_error(str(e))
+    query = RecordQuery.from_args(request.args)
+    offset, limit = get_requested_bounds()
+    cursor_out = [None]
+    records = query.iter_page(app.index, offset, limit, cursor_out)
+    return json_stream_response(
+        iter_json_list(records, lambda r: record_to_json(r, fields),
+                       cursor_out))
+
+@app.route("/api/search")
+def api_search():
+    """
+    Records matching the "q" search query in hotness order, filtered by
+    the "pass", "kind" and "min_count" query parameters, paginated via
+    "limit" and "cursor", with the given comma-separated "fields".
+    """
+    try:
+        fields = get_record_fields(request.args.get('fields'))
+    except ValueError as e:
+        return json_error(str(e))
+    offset, limit = get_requested_bounds()
+    cursor_out = [None]
+    records = iter_search_page(iter_search_matches(offset), limit,
+                               cursor_out)
+    return json_stream_response(
+        iter_json_list(records, lambda r: record_to_json(r, fields),
+                       cursor_out))
+
+def api_list(items, to_json):
+    """
+    Paginated JSON response for a list of items.
+    """
+    offset, limit = get_requested_bounds()
+    cursor_out = [offset + limit if offset + limit < len(items) else None]
+    return json_stream_response(
+        iter_json_list(items[offset:offset + limit], to_json, cursor_out))
+
+@app.route("/api/passes")
+def api_passes():
+    return api_list(app.index.passes,
+                    lambda p: {'name': p[0],
+                               'num_toplevel_records': p[1],
+                               'num_records': p[2]})
+
+@app.route("/api/functions")
+def api_functions():
+    """
+    Functions in hotness order, optionally filtered by "file" and
+    "min_count".
+    """
+    functions = app.index.functions
+    sourcefile = request.args.get('file')
+    if sourcefile is not None:
+        functions = [f for f in functions if f.sourcefile == sourcefile]
+    min_count = request.args.get('min_count', type=int)
+    if min_count is not None:
+        functions = list(itertools.takewhile(
+            lambda f: f.hotness >= min_count, functions))
+    return api_list(functions,
+                    lambda f: {'name': f.name,
+                               'hotness': f.hotness,
+                               'sourcefile': f.sourcefile,
+                               'tu': f.tu,
+                               'peak_location': location_to_json(
+                                   f.peak_location)})
+
+@app.route("/api/sourcefiles")
+def api_sourcefiles():
+    return api_list(app.index.sourcefiles,
+                    lambda sf: {'name': sf[0],
+                                'num_toplevel_records': sf[1],
+                                'num_records': sf[2]})
+
+@app.route("/api/diff")
+def api_diff():
+    """
+    Changes since the --diff-against build, hottest first, optionally of
+    just one "kind", with the given comma-separated "fields" of the records
+    before and after.
+    """
+    try:
+        fields = get_record_fields(request.args.get('fields'))
+    except ValueError as e:
+        return json_error(str(e))
+    changes = get_diff().get_changes(request.args.get('kind'))
+    return api_list(changes,
+                    lambda c: {'kind': c.kind,
+                               'hotness': c.hotness,
+                               'old': (record_to_json(c.old, fields)
+                                       if c.old else None),
+                               'new': (record_to_json(c.new, fields)
+                                       if c.new else None)})
+
+# The number of the hottest functions of each cluster listed by
+# /api/clusters
+API_CLUSTER_TOP_FUNCTIONS = 10
+
+@app.route("/api/clusters")
+def api_clusters():
+    """
+    Records grouped by pass and message template, sorted by "sort" (one of
+    hotness, count, functions, success_ratio, pass or template), with the
+    hottest functions of each.
+    """
+    return api_list(get_sorted_clusters(),
+                    lambda c: {'template': c.template,
+                               'pass': c.passname,
+                               'count': c.count,
+                               'hotness': c.hotness,
+                               'num_successes': c.num_successes,
+                               'num_failures': c.num_failures,
+                               'num_functions': len(c.functions),
+                               'functions': [
+                                   {'name': name, 'count': n,
+                                    'hotness': hotness}
+                                   for name, n, hotness
+                                   in c.get_hottest_functions(
+                                       API_CLUSTER_TOP_FUNCTIONS)]})
+
+@app.route("/api/stats")
+def api_stats():
+    """
+    The size of the loaded data, and the statistics of the loading of TUs
+    on demand (with --lazy), for sizing --max-loaded-tus and
+    --memory-budget.
+    """
+    index = app.index
+    return Response(json.dumps({'num_tus': len(index.summaries),
+                                'num_records': index.count_all,
+                                'loader': index.get_loader_stats()}),
+                    mimetype='application/json')
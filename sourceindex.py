@@ -0,0 +1,155 @@
+# TODO: license
+
+def group_by_line(records):
+    """
+    Get a dict mapping line number to the list of those of records located
+    on that line, keeping them in order.  All of the records must have a
+    location.
+    """
+    by_line = {}
+    for record in records:
+        line = record.location.line
+        if line not in by_line:
+            by_line[line] = []
+        by_line[line].append(record)
+    return by_line
+
+def group_by_file_and_line(records):
+    """
+    Get a dict mapping source file to line number to the list of those of
+    records located there, keeping them in order.  Records without a
+    location are skipped.
+    """
+    by_file = {}
+    for record in records:
+        loc = record.location
+        if not loc:
+            continue
+        by_line = by_file.get(loc.file)
+        if by_line is None:
+            by_line = by_file[loc.file] = {}
+        if loc.line not in by_line:
+            by_line[loc.line] = []
+        by_line[loc.line].append(record)
+    return by_file
+
+class SourceFileIndex:
+    """
+    Index of the records (of all depths) within a list of
+    TranslationUnits by source file and line, shared by the server and the
+    static report.
+
+    Looking up a source file only costs in proportion to the number of
+    records located within it, and the TUs contributing them.  Records are
+    kept in the order of the TUs, and in pre-order within each TU.  TUs can
+    be added, replaced or removed in place.
+    """
+    def __init__(self, tus=()):
+        # Mapping of TU filename to its position, keeping the TUs in the
+        # order they were first added
+        self.tu_positions = {}
+        # Mapping of source file to a dict of TU filename to (tu, dict of
+        # line to records from that TU)
+        self.by_file = {}
+        # Mapping of TU filename to the source files it has records in
+        self.files_by_tu = {}
+        for tu in tus:
+            self.update_tu(tu)
+
+    def update_tu(self, tu):
+        """
+        Add the records from tu, replacing those from any earlier
+        TranslationUnit with the same filename (which keeps its position).
+        """
+        self._remove_records(tu.filename)
+        if tu.filename not in self.tu_positions:
+            self.tu_positions[tu.filename] = len(self.tu_positions)
+        by_file = group_by_file_and_line(tu.iter_all_records())
+        for src_file, by_line in by_file.items():
+            if src_file not in self.by_file:
+                self.by_file[src_file] = {}
+            self.by_file[src_file][tu.filename] = (tu, by_line)
+        self.files_by_tu[tu.filename] = list(by_file)
+
+    def remove_tu(self, filename):
+        """
+        Remove the records from the TranslationUnit with the given filename.
+        """
+        self._remove_records(filename)
+        if filename in self.tu_positions:
+            del self.tu_positions[filename]
+
+    def set_order(self, filenames):
+        """
+        Put the TUs into the order of filenames (which must include all of
+        them), e.g. after adding new ones that belong in the middle.
+        """
+        self.tu_positions = {filename: i
+                             for i, filename in enumerate(filenames)}
+
+    def copy(self):
+        """
+        Get a copy of this index, which can be updated without affecting
+        this one.  The per-TU dicts of line to records are shared, as they
+        are never modified once built.
+        """
+        result = SourceFileIndex()
+        result.tu_positions = dict(self.tu_positions)
+        result.by_file = {src_file: dict(contributions)
+                          for src_file, contributions in self.by_file.items()}
+        result.files_by_tu = dict(self.files_by_tu)
+        return result
+
+    def _remove_records(self, filename):
+        for src_file in self.files_by_tu.pop(filename, ()):
+            contributions = self.by_file[src_file]
+            del contributions[filename]
+            if not contributions:
+                del self.by_file[src_file]
+
+    def get_sourcefiles(self):
+        """
+        Get the list of source files that have records located in them.
+        """
+        return list(self.by_file)
+
+    def iter_contributions(self, src_file):
+        """
+        Generate (tu, dict of line to records) for each TranslationUnit with
+        records located in src_file, in the order of the TUs.
+        """
+        contributions = self.by_file.get(src_file, {})
+        for filename in sorted(contributions,
+                               key=self.tu_positions.__getitem__):
+            yield contributions[filename]
+
+    def get_records_by_line(self, src_file, toplevel_only=False):
+        """
+        Get a dict mapping line number to the list of records located on
+        that line of src_file (or just the top-level records).
+        """
+        result = {}
+        for tu, by_line in self.iter_contributions(src_file):
+            for line, records in by_line.items():
+                if toplevel_only:
+                    records = [record for record in records
+                               if record.depth == 0]
+                    if not records:
+                        continue
+                if line not in result:
+                    result[line] = []
+                result[line] += records
+        return result
+
+    def get_records(self, src_file, toplevel_only=False):
+        """
+        Get the list of (tu, record) pairs for the records located in
+        src_file (or just the top-level records), grouped by TU and then by
+        line.
+        """
+        pairs = []
+        for tu, by_line in self.iter_contributions(src_file):
+            for records in by_line.values():
+                pairs += [(tu, record) for record in records
+                          if not toplevel_only or record.depth == 0]
+        return pairs
@@ -2,17 +2,32 @@
 
 import argparse
 from collections import Counter
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
 import html
+import io
+import itertools
+from itertools import compress
+import marshal
+import operator
 import os
 from pprint import pprint
 import sys
 
-import pygments.lexers
-import pygments.styles
-import pygments.formatters
-
-from optrecord import TranslationUnit, Record, Expr, Stmt, SymtabNode
-from utils import find_records, log, get_effective_result
+from clusters import MessageClusters
+from columns import RecordColumns
+from diff import RecordDiff
+from highlight import Highlighter
+from incremental import ReportState, get_record_file_key, hash_file
+from optrecord import (TranslationUnit, Record, Expr, Stmt, SymtabNode,
+                       walk_records)
+from sourceindex import SourceFileIndex, group_by_line
+from topk import merge_top_k, top_k
+from utils import (find_record_files, find_records, load_record_files, log,
+                   get_effective_result, is_record_shown, map_bounded)
 
 def srcfile_to_html(src_file):
     """
@@ -37,21 +52,63 @@ def get_summary_text(record):
             return get_summary_text(record.children[-1])
     return get_html_for_message(record)
 
-def write_td_with_color(f, record, html_text):
-    result = get_effective_result(record)
-    if result == 'success':
-        bgcolor = 'lightgreen'
-    elif result == 'failure':
-        bgcolor = 'lightcoral'
-    else:
-        bgcolor = ''
-    f.write('    <td bgcolor="%s">%s</td>\n' % (bgcolor, html_text))
+############################################################################
+
+# The HTML is built up from fragments, joined together in a ChunkedWriter
+# (or ''.join) rather than being written to the file piece by piece.
+# Fragments which are repeated many times within a report (pass cells,
+# links to locations, escaped names) are cached.
+
+FRAGMENT_CACHE_SIZE = 1 << 16
+
+class ChunkedWriter:
+    """
+    File-like wrapper for writing many small strings to f.
+
+    The strings are gathered into a list, and only written to f, joined
+    together, when flush is called; maybe_flush does so once enough have
+    been gathered, so that the writes to f are in large chunks.
+    """
+    CHUNK_PARTS = 1 << 14
+
+    def __init__(self, f):
+        self.f = f
+        self.parts = []
+        # (bound directly to the list, so that each write is as cheap as
+        # possible)
+        self.write = self.parts.append
 
-def write_td_pass(f, record):
+    def maybe_flush(self):
+        if len(self.parts) >= self.CHUNK_PARTS:
+            self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self.parts))
+        self.parts.clear()
+
+@contextlib.contextmanager
+def open_chunked(filename):
+    """
+    Open filename for writing, as a ChunkedWriter.
+    """
+    with open(filename, "w") as f:
+        w = ChunkedWriter(f)
+        yield w
+        w.flush()
+
+escape = functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)(html.escape)
+
+BGCOLOR_FOR_RESULT = {'success': 'lightgreen',
+                      'failure': 'lightcoral'}
+
+def get_td_with_color(record, html_text):
+    bgcolor = BGCOLOR_FOR_RESULT.get(get_effective_result(record), '')
+    return '    <td bgcolor="%s">%s</td>\n' % (bgcolor, html_text)
+
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def get_pass_html(passname, impl_file, impl_line):
     html_text = ''
     impl_url = None
-    impl_file = record.impl_location.file
-    impl_line = record.impl_location.line
     # FIXME: something of a hack:
     PREFIX = '../../src/'
     if impl_file.startswith(PREFIX):
@@ -62,48 +119,77 @@ def write_td_pass(f, record):
         html_text += '<a href="%s">\n' % impl_url
 
     # FIXME: link to GCC source code
-    if record.pass_:
-        html_text += html.escape(record.pass_.name)
+    if passname is not None:
+        html_text += html.escape(passname)
 
     if impl_url:
         html_text += '</a>'
+    return html_text
 
-    write_td_with_color(f, record, html_text)
+def get_td_pass(record):
+    return get_td_with_color(
+        record,
+        get_pass_html(record.pass_.name if record.pass_ else None,
+                      record.impl_location.file, record.impl_location.line))
 
-def write_td_count(f, record, highest_count):
-    f.write('    <td style="text-align:right">\n')
-    if record.count:
-        if 1:
-            if highest_count == 0:
-                highest_count = 1
-            hotness = 100. * record.count.value / highest_count
-            f.write(html.escape('%.2f' % hotness))
-        else:
-            f.write(html.escape(str(int(record.count.value))))
-        if 0:
-            f.write(html.escape(' (%s)' % record.count.quality))
-    f.write('    </td>\n')
+def get_td_count(record, highest_count):
+    return get_td_hotness(record.count.value if record.count else None,
+                          highest_count)
+
+def get_td_hotness(count_value, highest_count):
+    """
+    Get the Hotness cell for a record with the given count value (or
+    None, for a record without a count).
+    """
+    if count_value is None:
+        return '    <td style="text-align:right">\n    </td>\n'
+    # (formatted numbers never contain characters that need escaping)
+    if 1:
+        if highest_count == 0:
+            highest_count = 1
+        hotness = 100. * count_value / highest_count
+        text = '%.2f' % hotness
+    else:
+        text = str(int(count_value))
+    return '    <td style="text-align:right">\n%s    </td>\n' % text
 
-def write_inlining_chain(f, record):
-    f.write('    <td><ul class="list-group">\n')
+def get_inlining_chain_html(record):
+    parts = ['    <td><ul class="list-group">\n']
     first = True
     if record.inlining_chain:
         for inline in record.inlining_chain:
-            f.write('  <li class="list-group-item">')
+            parts.append('  <li class="list-group-item">')
             if not first:
-                f.write ('inlined from ')
-            f.write('<code>%s</code>' % html.escape(inline.fndecl))
+                parts.append('inlined from ')
+            parts.append('<code>%s</code>' % escape(inline.fndecl))
             site = inline.site
             if site:
-                f.write(' at <a href="%s">%s</a>'
-                        % (url_from_location(site),
-                           html.escape(str(site))))
-            f.write('</li>\n')
+                parts.append(' at ')
+                parts.append(get_location_link(site))
+            parts.append('</li>\n')
             first = False
-    f.write('    </ul></td>\n')
+    parts.append('    </ul></td>\n')
+    return ''.join(parts)
 
 def url_from_location(loc):
-    return '%s#line-%i' % (srcfile_to_html(loc.file), loc.line)
+    return get_url_for_line(loc.file, loc.line)
+
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def get_url_for_line(src_file, line):
+    return '%s#line-%i' % (srcfile_to_html(src_file), line)
+
+def get_location_link(loc):
+    """
+    Get the HTML for a link to loc, showing its text.
+    """
+    return get_location_link_for(loc.file, loc.line, loc.column)
+
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def get_location_link_for(src_file, line, column):
+    # (the text is that of str(Location); only the filename needs escaping)
+    return ('<a href="%s">%s:%i:%i</a>'
+            % (get_url_for_line(src_file, line), escape(src_file), line,
+               column))
 
 def write_html_header(f, title, head_content):
     """
@@ -137,233 +223,353 @@ def write_html_footer(f):
             '  </body>\n'
             '</html>\n')
 
-def make_index_html(out_dir, tus, highest_count):
-    log(' make_index_html')
-
-    # Gather all records
-    records = []
-    for tu in tus:
-        records += tu.iter_all_records()
-
-    # Sort by highest-count down to lowest-count
-    records = sorted(records, key=record_sort_key)
+def get_index_row(record):
+    """
+    Get a (count value, prefix, suffix) triple for the row for record within
+    index.html, where the prefix and suffix are the HTML either side of its
+    Hotness cell (which depends upon the highest count overall).
+    """
+    # Summary
+    prefix = ['  <tr>\n', get_td_with_color(record, get_summary_text(record))]
 
-    filename = os.path.join(out_dir, "index.html")
-    with open(filename, "w") as f:
-        write_html_header(f, 'Optimizations', '')
-        f.write('<table class="table table-striped table-bordered table-sm">\n')
-        f.write('  <tr>\n')
-        f.write('    <th>Summary</th>\n')
-        f.write('    <th>Source Location</th>\n')
-        f.write('    <th>Hotness</th>\n')
-        f.write('    <th>Function / Inlining Chain</th>\n')
-        f.write('    <th>Pass</th>\n')
-        f.write('  </tr>\n')
-        for record in records:
-            f.write('  <tr>\n')
+    # Source Location:
+    prefix.append('    <td>\n')
+    if record.location:
+        prefix.append(get_location_link(record.location))
+    prefix.append('    </td>\n')
 
-            # Summary
-            write_td_with_color(f, record, get_summary_text(record))
+    # (Hotness)
 
-            # Source Location:
-            f.write('    <td>\n')
-            if record.location:
-                loc = record.location
-                f.write('<a href="%s">' % url_from_location (loc))
-                f.write(html.escape(str(loc)))
-                f.write('</a>')
-            f.write('    </td>\n')
+    # Inlining Chain, and Pass:
+    suffix = (get_inlining_chain_html(record) + get_td_pass(record)
+              + '  </tr>\n')
+    return (record.count.value if record.count else None, ''.join(prefix),
+            suffix)
 
-            # Hotness:
-            write_td_count(f, record, highest_count)
+def iter_sorted_index_rows(records, limit=None):
+    """
+    Generate the index rows for records (or just for the hottest limit of
+    them) as (sort key, count value, prefix, suffix), sorted by
+    highest-count down to lowest-count.  Each row is only rendered as it is
+    consumed.
+    """
+    for record in top_k(records, limit, record_sort_key):
+        yield (record_sort_key(record),) + get_index_row(record)
+
+def get_sorted_index_rows(records):
+    return list(iter_sorted_index_rows(records))
+
+# The number of records shown by index.html, when the index is split into
+# pages
+INDEX_TOP_N = 100
+
+# The number of links either side of the current page within the
+# pagination of the index pages
+INDEX_PAGINATION_WINDOW = 5
+
+def index_page_filename(page_num):
+    return 'index-%i.html' % page_num
+
+def write_index_table(f, rows, highest_count):
+    f.write('<table class="table table-striped table-bordered table-sm">\n')
+    f.write('  <tr>\n')
+    f.write('    <th>Summary</th>\n')
+    f.write('    <th>Source Location</th>\n')
+    f.write('    <th>Hotness</th>\n')
+    f.write('    <th>Function / Inlining Chain</th>\n')
+    f.write('    <th>Pass</th>\n')
+    f.write('  </tr>\n')
+    for sort_key, count_value, prefix, suffix in rows:
+        f.write(prefix)
+        f.write(get_td_hotness(count_value, highest_count))
+        f.write(suffix)
+        f.maybe_flush()
+    f.write('</table>\n')
+
+def write_index_pagination(f, num_pages, current=None):
+    """
+    Write links to the first and last of the index pages, and to those
+    near the current one (if any).
+    """
+    if current is None:
+        current = 1
+    page_nums = set(range(max(1, current - INDEX_PAGINATION_WINDOW),
+                          min(num_pages, current + INDEX_PAGINATION_WINDOW)
+                          + 1))
+    page_nums.update((1, num_pages))
+    f.write('<nav><ul class="pagination flex-wrap">\n')
+    last = 0
+    for page_num in sorted(page_nums):
+        if page_num > last + 1:
+            f.write('  <li class="page-item disabled">'
+                    '<span class="page-link">&hellip;</span></li>\n')
+        f.write('  <li class="page-item%s"><a class="page-link" href="%s">%i</a></li>\n'
+                % (' active' if page_num == current else '',
+                   index_page_filename(page_num), page_num))
+        last = page_num
+    f.write('</ul></nav>\n')
+
+def remove_index_pages(out_dir, first_page_num):
+    """
+    Remove any index pages from a previous run, from first_page_num on.
+    """
+    page_num = first_page_num
+    while True:
+        try:
+            os.unlink(os.path.join(out_dir, index_page_filename(page_num)))
+        except FileNotFoundError:
+            return
+        page_num += 1
+
+def write_index_html(out_dir, rows, highest_count, num_rows=None,
+                     page_size=None, num_records=None):
+    """
+    Write index.html, given an iterable of num_rows rows from
+    iter_sorted_index_rows, for the hottest of num_records records
+    (defaulting to num_rows).
 
-            # Inlining Chain:
-            write_inlining_chain(f, record)
+    If page_size is set, split the rows into pages of that size in
+    index-1.html, index-2.html, etc, with index.html showing just the first
+    INDEX_TOP_N of them; only one page of rows is held at a time.
+    """
+    if num_records is None:
+        num_records = num_rows
+    if not page_size:
+        with open_chunked(os.path.join(out_dir, "index.html")) as f:
+            write_html_header(f, 'Optimizations', '')
+            if num_rows is not None and num_rows < num_records:
+                f.write('<p>The hottest %i of %i records.</p>\n'
+                        % (num_rows, num_records))
+            write_index_table(f, rows, highest_count)
+            write_html_footer(f)
+        remove_index_pages(out_dir, 1)
+        return
+
+    num_pages = (num_rows + page_size - 1) // page_size
+    rows = iter(rows)
+    for page_num in range(1, max(num_pages, 1) + 1):
+        page_rows = list(itertools.islice(rows, page_size))
+        if page_num == 1:
+            top_rows = page_rows[:INDEX_TOP_N]
+            with open_chunked(os.path.join(out_dir, "index.html")) as f:
+                write_html_header(f, 'Optimizations', '')
+                if num_rows < num_records:
+                    see_also = 'the hottest %i' % num_rows
+                else:
+                    see_also = 'all of them'
+                f.write('<p>The hottest %i of %i records; see the pages'
+                        ' below for %s.</p>\n'
+                        % (len(top_rows), num_records, see_also))
+                write_index_table(f, top_rows, highest_count)
+                if num_pages:
+                    write_index_pagination(f, num_pages)
+                write_html_footer(f)
+        if not num_pages:
+            break
+        filename = os.path.join(out_dir, index_page_filename(page_num))
+        with open_chunked(filename) as f:
+            write_html_header(f, 'Optimizations (page %i of %i)'
+                              % (page_num, num_pages), '')
+            f.write('<p><a href="index.html">Hottest records</a>; records'
+                    ' %i to %i of %i:</p>\n'
+                    % ((page_num - 1) * page_size + 1,
+                       (page_num - 1) * page_size + len(page_rows),
+                       num_rows))
+            write_index_pagination(f, num_pages, page_num)
+            write_index_table(f, page_rows, highest_count)
+            write_index_pagination(f, num_pages, page_num)
+            write_html_footer(f)
+    remove_index_pages(out_dir, num_pages + 1)
 
-            # Pass:
-            write_td_pass(f, record)
+def make_index_html(out_dir, tus, num_records, highest_count, page_size=None,
+                    limit=None):
+    """
+    Write the index of the num_records records within tus, or of just the
+    hottest limit of them, selected without sorting all of them.
+    """
+    log(' make_index_html')
 
-            f.write('  </tr>\n')
-        f.write('</table>\n')
-        write_html_footer(f)
+    records = itertools.chain.from_iterable(tu.iter_all_records()
+                                            for tu in tus)
+    num_rows = num_records if limit is None else min(limit, num_records)
+    write_index_html(out_dir, iter_sorted_index_rows(records, limit),
+                     highest_count, num_rows, page_size, num_records)
 
 def get_html_for_message(record):
-    html_for_message = ''
+    parts = []
     for item in record.message:
         if isinstance(item, str):
-            html_for_message += html.escape(str(item))
+            parts.append(escape(item))
         else:
             if isinstance(item, Expr):
-                html_for_item = '<code>%s</code>' % html.escape(item.expr)
+                html_for_item = '<code>%s</code>' % escape(item.expr)
             elif isinstance(item, Stmt):
-                html_for_item = '<code>%s</code>' % html.escape(item.stmt)
+                html_for_item = '<code>%s</code>' % escape(item.stmt)
             elif isinstance(item, SymtabNode):
-                html_for_item = '<code>%s</code>' % html.escape(item.node)
+                html_for_item = '<code>%s</code>' % escape(item.node)
             else:
                 raise TypeError('unknown message item: %r' % item)
             if item.location:
                 html_for_item = ('<a href="%s">%s</a>'
                                  % (url_from_location (item.location), html_for_item))
-            html_for_message += html_for_item
+            parts.append(html_for_item)
 
-    if record.children:
-        for child in record.children:
-            for line in get_html_for_message(child).splitlines():
-                html_for_message += '\n  ' + line
-    return html_for_message
+    for child in record.children:
+        for line in get_html_for_message(child).splitlines():
+            parts.append('\n  ')
+            parts.append(line)
+    return ''.join(parts)
 
-def make_per_source_file_html(build_dir, out_dir, tus, highest_count):
-    log(' make_per_source_file_html')
+def get_compact_records(pairs):
+    """
+    Get the compact form of the records within a list of (tu, record)
+    pairs, as a list of compact TranslationUnits holding just those records.
+    """
+    return [tu.to_compact([record for tu, record in group])
+            for tu, group in itertools.groupby(pairs,
+                                               key=operator.itemgetter(0))]
 
-    # Gather all records
+def make_source_file_html_from_compact(build_dir, out_dir, src_file,
+                                       compact_tus, highest_count,
+                                       highlight_cache_dir):
+    """
+    Write the HTML for src_file, given the result of get_compact_records.
+
+    This is run in the worker processes of make_per_source_file_html.
+    """
     records = []
-    for tu in tus:
-        records += tu.iter_all_records()
+    for compact in compact_tus:
+        records += TranslationUnit.from_compact(compact).records
+    # (the records' children were sent along with them, but any that are
+    # located within src_file were also sent in their own right)
+    make_source_file_html(build_dir, out_dir, src_file,
+                          group_by_line(records), highest_count,
+                          Highlighter(highlight_cache_dir))
+
+# The most source files whose pages are submitted to the worker processes
+# at once, so that the records of every file aren't put into compact form
+# up front
+MAX_PENDING_SOURCE_FILES = 64
+
+def make_per_source_file_html(build_dir, out_dir, sourcefile_index,
+                              highest_count, highlighter, executor=None,
+                              src_files=None):
+    """
+    Write the HTML for each source file within sourcefile_index, or just
+    for those in src_files if that is set.
 
-    # Dict of list of record, grouping by source file
-    by_src_file = {}
-    for record in records:
-        if not record.location:
-            continue
-        src_file = record.location.file
-        if src_file not in by_src_file:
-            by_src_file[src_file] = []
-        by_src_file[src_file].append(record)
+    If executor is set, the files are written by its worker processes,
+    each being sent just the records for its file; return an iterator that
+    waits for them to complete (and submits the rest of them).
+    """
+    log(' make_per_source_file_html')
 
-    style = pygments.styles.get_style_by_name('default')
-    formatter = pygments.formatters.HtmlFormatter()
+    if src_files is None:
+        src_files = sourcefile_index.get_sourcefiles()
 
     # Write style.css
     with open(os.path.join(out_dir, "style.css"), "w") as f:
-        f.write(formatter.get_style_defs())
-
-    for src_file in by_src_file:
-        log('  generating HTML for %r' % src_file)
-
-        if 0:
-            print(src_file)
-            print('*' * 76)
-        with open(os.path.join(build_dir, src_file)) as f:
-            code = f.read()
-        if 0:
-            print(code)
-            print('*' * 76)
-
-        lexer = pygments.lexers.guess_lexer_for_filename(src_file, code)
-
-        # Use pygments to convert it all to HTML:
-        code_as_html = pygments.highlight(code, lexer, formatter)
-
-        if 0:
-            print(code_as_html)
-            print('*' * 76)
-            print(repr(code_as_html))
-            print('*' * 76)
-
-        EXPECTED_START = '<div class="highlight"><pre>'
-        assert code_as_html.startswith(EXPECTED_START)
-        code_as_html = code_as_html[len(EXPECTED_START):-1]
-
-        EXPECTED_END = '</pre></div>'
-        assert code_as_html.endswith(EXPECTED_END)
-        code_as_html = code_as_html[0:-len(EXPECTED_END)]
-
-        html_lines = code_as_html.splitlines()
-        if 0:
-            for html_line in html_lines:
-                print(repr(html_line))
-            print('*' * 76)
-
-        # Group by line num
-        by_line_num = {}
-        for record in by_src_file[src_file]:
-            line_num = record.location.line
-            if line_num not in by_line_num:
-                by_line_num[line_num] = []
-            by_line_num[line_num].append(record)
-
-        next_id = 0
-
-        with open(os.path.join(out_dir, srcfile_to_html(src_file)), "w") as f:
-            write_html_header(f, html.escape(src_file),
-                              '<link rel="stylesheet" href="style.css" type="text/css" />\n')
-            f.write('<h1>%s</h1>' % html.escape(src_file))
-            f.write('<table class="table table-striped table-bordered table-sm">\n')
-            f.write('  <tr>\n')
-            f.write('    <th>Line</th>\n')
-            f.write('    <th>Hotness</th>\n')
-            f.write('    <th>Pass</th>\n')
-            f.write('    <th>Source</th>\n')
-            f.write('    <th>Function / Inlining Chain</th>\n')
-            f.write('  </tr>\n')
-            for line_num, html_line in enumerate(html_lines, start=1):
-                # Add row for the source line itself.
-
-                f.write('  <tr>\n')
-
-                # Line:
-                f.write('    <td id="line-%i">%i</td>\n' % (line_num, line_num))
-
-                # Hotness:
-                f.write('    <td></td>\n')
-
-                # Pass:
-                f.write('    <td></td>\n')
-
-                # Source
-                f.write('    <td><div class="highlight"><pre style="margin: 0 0;">')
-                f.write(html_line)
-                f.write('</pre></div></td>\n')
+        f.write(highlighter.get_style_defs())
+
+    if not executor:
+        for src_file in src_files:
+            make_source_file_html(
+                build_dir, out_dir, src_file,
+                sourcefile_index.get_records_by_line(src_file),
+                highest_count, highlighter)
+        return iter([])
+
+    # (the records for each file are only put into compact form as it is
+    # submitted, with at most MAX_PENDING_SOURCE_FILES in flight)
+    return map_bounded(executor, make_source_file_html_from_compact,
+                       ((build_dir, out_dir, src_file,
+                         get_compact_records(
+                             sourcefile_index.get_records(src_file)),
+                         highest_count, highlighter.cache_dir)
+                        for src_file in src_files),
+                       MAX_PENDING_SOURCE_FILES)
+
+SOURCE_LINE_ROW = ('  <tr>\n'
+                   '    <td id="line-%i">%i</td>\n'
+                   '    <td></td>\n'
+                   '    <td></td>\n'
+                   '    <td><div class="highlight"><pre style="margin: 0 0;">%s</pre></div></td>\n'
+                   '    <td></td>\n'
+                   '  </tr>\n')
+
+def make_source_file_html(build_dir, out_dir, src_file, by_line_num,
+                          highest_count, highlighter):
+    """
+    Write the HTML for src_file, showing the records within it, given as a
+    dict of line number to records.
+    """
+    log('  generating HTML for %r' % src_file)
 
-                # Inlining Chain:
-                f.write('    <td></td>\n')
+    with open(os.path.join(build_dir, src_file)) as f:
+        code = f.read()
 
-                f.write('  </tr>\n')
+    html_lines = highlighter.get_html_lines(src_file, code)
 
-                # Add extra rows for any optimization records that apply to
-                # this line.
-                for record in by_line_num.get(line_num, []):
-                    f.write('  <tr>\n')
-
-                    # Line (blank)
-                    f.write('    <td></td>\n')
-
-                    # Hotness
-                    write_td_count(f, record, highest_count)
-
-                    # Pass:
-                    write_td_pass(f, record)
-
-                    # Text
-                    column = record.location.column
-                    html_for_message = get_html_for_message(record)
-                    # Column number is 1-based:
-                    indent = ' ' * (column - 1)
-                    lines = indent + '<span style="color:green;">^</span>'
-                    for line in html_for_message.splitlines():
-                        lines += line + '\n' + indent
-                    f.write('    <td><pre style="margin: 0 0;">')
-                    num_lines = lines.count('\n')
-                    collapsed =  num_lines > 7
-                    if collapsed:
-                        f.write('''<button class="btn btn-primary" type="button" data-toggle="collapse" data-target="#collapse-%i" aria-expanded="false" aria-controls="collapse-%i">
+    next_id = 0
+
+    with open_chunked(os.path.join(out_dir, srcfile_to_html(src_file))) as f:
+        write_html_header(f, html.escape(src_file),
+                          '<link rel="stylesheet" href="style.css" type="text/css" />\n')
+        f.write('<h1>%s</h1>' % html.escape(src_file))
+        f.write('<table class="table table-striped table-bordered table-sm">\n')
+        f.write('  <tr>\n')
+        f.write('    <th>Line</th>\n')
+        f.write('    <th>Hotness</th>\n')
+        f.write('    <th>Pass</th>\n')
+        f.write('    <th>Source</th>\n')
+        f.write('    <th>Function / Inlining Chain</th>\n')
+        f.write('  </tr>\n')
+        for line_num, html_line in enumerate(html_lines, start=1):
+            # Add row for the source line itself, with its Line and Source
+            # (and empty Hotness, Pass and Inlining Chain)
+            f.write(SOURCE_LINE_ROW % (line_num, line_num, html_line))
+
+            # Add extra rows for any optimization records that apply to
+            # this line.
+            for record in by_line_num.get(line_num, ()):
+                # Line (blank), Hotness, Pass:
+                f.write('  <tr>\n'
+                        '    <td></td>\n')
+                f.write(get_td_count(record, highest_count))
+                f.write(get_td_pass(record))
+
+                # Text
+                column = record.location.column
+                html_for_message = get_html_for_message(record)
+                # Column number is 1-based:
+                indent = ' ' * (column - 1)
+                line_end = '\n' + indent
+                lines = ''.join([indent, '<span style="color:green;">^</span>']
+                                + [line + line_end
+                                   for line in html_for_message.splitlines()])
+                f.write('    <td><pre style="margin: 0 0;">')
+                num_lines = lines.count('\n')
+                collapsed =  num_lines > 7
+                if collapsed:
+                    f.write('''<button class="btn btn-primary" type="button" data-toggle="collapse" data-target="#collapse-%i" aria-expanded="false" aria-controls="collapse-%i">
     Toggle messages <span class="badge badge-light">%i</span>
   </button>
                         ''' % (next_id, next_id, num_lines))
-                        f.write('<div class="collapse" id="collapse-%i">' % next_id)
-                        next_id += 1
-                    f.write(lines)
-                    if collapsed:
-                        f.write('</div">')
-                    f.write('</pre></td>\n')
+                    f.write('<div class="collapse" id="collapse-%i">' % next_id)
+                    next_id += 1
+                f.write(lines)
+                if collapsed:
+                    f.write('</div">')
+                f.write('</pre></td>\n')
 
-                    # Inlining Chain:
-                    write_inlining_chain(f, record)
+                # Inlining Chain:
+                f.write(get_inlining_chain_html(record))
 
-                    f.write('  </tr>\n')
+                f.write('  </tr>\n')
+            f.maybe_flush()
 
-            f.write('</table>\n')
-            write_html_footer(f)
+        f.write('</table>\n')
+        write_html_footer(f)
 
 def write_cfg_view(f, view_id, cfg):
     # see http://visjs.org/docs/network/
@@ -415,64 +621,70 @@ def write_cfg_view(f, view_id, cfg):
 </script>
 """)
 
-def have_any_precise_counts(tus):
-    for tu in tus:
-        for record in tu.records:
-            if isinstance(record, Record):
-                if record.count:
-                    if record.count.is_precise():
-                        return True
-
-def filter_non_precise_counts(tus):
-    precise_records = []
-    num_filtered = 0
-    for tu in tus:
-        for record in tu.records:
-            if isinstance(record, Record):
-                if record.count:
-                    if not record.count.is_precise():
-                        num_filtered += 1
-                        continue
-            precise_records.append(record)
+def have_any_precise_counts(columns):
+    return columns.have_any_precise_counts(toplevel_only=True)
+
+def filter_non_precise_counts(columns):
+    """
+    Get the top-level records, other than those with non-precise counts.
+    """
+    # (top-level) > (non-precise), i.e. top-level and not non-precise:
+    mask = map(operator.gt, columns.toplevel_mask(),
+               columns.non_precise_mask())
+    precise_records = list(compress(columns.records, mask))
+    num_filtered = columns.count_non_precise_counts(toplevel_only=True)
     log('  purged %i non-precise records' % num_filtered)
     return precise_records
 
-def analyze_counts(tus):
+def analyze_counts(columns):
     """
     Get the highest count, purging any non-precise counts
     if we have any precise counts.
     """
     log(' analyze_counts')
 
-    if have_any_precise_counts(tus):
-        records = filter_non_precise_counts(tus)
+    if have_any_precise_counts(columns):
+        records = filter_non_precise_counts(columns)
 
-    highest_count = 0
-    for tu in tus:
-        for record in tu.records:
-            if isinstance(record, Record):
-                if record.count:
-                    value = record.count.value
-                    if value > highest_count:
-                        highest_count = value
+    return columns.highest_count(toplevel_only=True)
 
-    return highest_count
+def make_html(build_dir, out_dir, tus, columns, highlighter, executor=None,
+              index_page_size=None, index_limit=None):
+    """
+    Write the HTML report.  If executor is set, the per-source-file HTML
+    is written in its worker processes whilst this process writes the
+    index; return an iterator that waits for them to complete.
 
-def make_html(build_dir, out_dir, tus):
+    If index_page_size is set, the index is split into pages of that many
+    records (see write_index_html); if index_limit is set, it only shows
+    that many of the hottest records.
+    """
     log('make_html')
 
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
-    highest_count = analyze_counts(tus)
+    highest_count = analyze_counts(columns)
     log(' highest_count=%r' % highest_count)
 
-    make_index_html(out_dir, tus, highest_count)
-    make_per_source_file_html(build_dir, out_dir, tus, highest_count)
+    pending = make_per_source_file_html(build_dir, out_dir,
+                                        SourceFileIndex(tus), highest_count,
+                                        highlighter, executor)
+    make_index_html(out_dir, tus, len(columns), highest_count, index_page_size,
+                    index_limit)
+    return pending
 
 ############################################################################
 
 def write_record_to_outline(f, record, level):
+    """
+    Write record and all of its descendants to the outline, starting at the
+    given level.
+    """
+    for r, depth, parent in walk_records([record]):
+        write_outline_entry(f, r, level + depth)
+
+def write_outline_entry(f, record, level):
     f.write('%s ' % ('*' * level))
     if record.location:
         f.write('%s: ' % record.location)
@@ -490,8 +702,13 @@ def write_record_to_outline(f, record, level):
                         % (record.count.quality, record.count.value))
                 + ']')
     f.write('\n')
-    for child in record.children:
-        write_record_to_outline(f, child, level + 1)
+
+def write_tu_outline(f, tu):
+    f.write('* %s\n' % tu.filename)
+    # FIXME: metadata?
+    for record in tu.iter_all_records():
+        write_record_to_outline(f, record, 2)
+    # FIXME: show passes?
 
 def make_outline(build_dir, out_dir, tus):
     log('make_outline')
@@ -501,11 +718,7 @@ def make_outline(build_dir, out_dir, tus):
 
     with open(os.path.join(out_dir, 'outline.txt'), 'w') as f:
         for tu in tus:
-            f.write('* %s\n' % tu.filename)
-            # FIXME: metadata?
-            for record in tu.iter_all_records():
-                write_record_to_outline(f, record, 2)
-            # FIXME: show passes?
+            write_tu_outline(f, tu)
 
 ############################################################################
 
@@ -562,39 +775,52 @@ def print_as_remark(record):
 ############################################################################
 
 def filter_records(tus):
-    def criteria(record):
-        # Hack to filter things a bit:
-        if record.location:
-            src_file = record.location.file
-            if 'pgen.c' in src_file:
-                return False
-        if record.pass_:
-            if record.pass_.name in ('slp', 'fre', 'pre', 'profile',
-                                     'cunroll', 'cunrolli', 'ivcanon'):
-                return False
-        return True
     for tu in tus:
-        tu.records = list(filter(criteria, tu.records))
+        tu.records = list(filter(is_record_shown, tu.records))
 
-def summarize_records(tus):
+def log_pass_counts(num_records_by_pass):
     log('records by pass:')
-    num_records_by_pass = Counter()
-    for tu in tus:
-        for record in tu.iter_all_records():
-            #print(record)
-            if record.pass_:
-                num_records_by_pass[record.pass_.name] += 1
     for pass_,count in num_records_by_pass.most_common():
         log(' %s: %i' % (pass_, count))
 
-def generate_static_report(build_dir, out_dir):
-    tus = find_records(build_dir)
+def summarize_records(columns):
+    log_pass_counts(columns.count_records_by_pass())
 
-    summarize_records(tus)
+def make_highlighter(cache_dir):
+    if cache_dir:
+        return Highlighter(os.path.join(cache_dir, 'highlight'))
+    return Highlighter()
+
+def generate_static_report(build_dir, out_dir, jobs=None, cache_dir=None,
+                           incremental=False, index_page_size=None,
+                           index_limit=None, diff_against=None):
+    """
+    Write the static report for build_dir to out_dir, along with
+    diff.html if diff_against (another build directory) is set.
+    """
+    if incremental:
+        filenames, loaded = generate_incremental_static_report(
+            build_dir, out_dir, jobs, cache_dir, index_page_size, index_limit)
+        if diff_against:
+            # (reusing the TUs that were loaded for the report)
+            more, _ = load_filtered_records([filename for filename in filenames
+                                             if filename not in loaded],
+                                            jobs, cache_dir)
+            loaded.update(more)
+            make_diff_html(out_dir,
+                           load_filtered_tus(diff_against, jobs, cache_dir),
+                           [loaded[filename] for filename in filenames],
+                           diff_against)
+        return
+
+    tus = find_records(build_dir, jobs, cache_dir)
+
+    summarize_records(RecordColumns(tus))
 
     filter_records(tus)
 
-    summarize_records(tus)
+    columns = RecordColumns(tus)
+    summarize_records(columns)
     if 0:
         for tu in tus:
             for record in tu.records:
@@ -603,5 +829,409 @@ def generate_static_report(build_dir, out_dir):
         for tu in tus:
             for record in tu.records:
                 print(record)
-    make_html(build_dir, out_dir, tus)
-    make_outline(build_dir, out_dir, tus)
+    highlighter = make_highlighter(cache_dir)
+    if jobs is not None and jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        with executor:
+            pending = make_html(build_dir, out_dir, tus, columns, highlighter,
+                                executor, index_page_size, index_limit)
+            make_outline(build_dir, out_dir, tus)
+            # Wait for the workers, raising any exception from them
+            for _ in pending:
+                pass
+    else:
+        make_html(build_dir, out_dir, tus, columns, highlighter,
+                  index_page_size=index_page_size, index_limit=index_limit)
+        make_outline(build_dir, out_dir, tus)
+    make_clusters_html(out_dir, MessageClusters.from_tus(tus))
+    if diff_against:
+        make_diff_html(out_dir,
+                       load_filtered_tus(diff_against, jobs, cache_dir), tus,
+                       diff_against)
+
+############################################################################
+
+# The number of changes of each kind listed within diff.html
+DIFF_TOP_N = 1000
+
+DIFF_HEADINGS = {'flipped': 'Flipped between success and failure',
+                 'removed': 'Removed',
+                 'added': 'Added'}
+
+def get_td_summary(record):
+    if record is None:
+        return '    <td></td>\n'
+    return get_td_with_color(record, get_summary_text(record))
+
+def get_diff_row(change):
+    record = change.record
+    parts = ['  <tr>\n', get_td_summary(change.old),
+             get_td_summary(change.new), '    <td>\n']
+    if record.location:
+        parts.append(get_location_link(record.location))
+    parts.append('    </td>\n')
+    parts.append('    <td style="text-align:right">\n%i    </td>\n'
+                 % change.hotness)
+    parts.append(get_inlining_chain_html(record))
+    parts.append(get_td_pass(record))
+    parts.append('  </tr>\n')
+    return ''.join(parts)
+
+def write_diff_table(f, changes):
+    f.write('<table class="table table-striped table-bordered table-sm">\n')
+    f.write('  <tr>\n')
+    f.write('    <th>Before</th>\n')
+    f.write('    <th>After</th>\n')
+    f.write('    <th>Source Location</th>\n')
+    f.write('    <th>Hotness</th>\n')
+    f.write('    <th>Function / Inlining Chain</th>\n')
+    f.write('    <th>Pass</th>\n')
+    f.write('  </tr>\n')
+    for change in changes:
+        f.write(get_diff_row(change))
+        f.maybe_flush()
+    f.write('</table>\n')
+
+def make_diff_html(out_dir, old_tus, new_tus, old_build_dir):
+    """
+    Write diff.html, listing the hottest of the changes to the top-level
+    records between old_tus (from old_build_dir) and new_tus.
+    """
+    log('make_diff_html')
+    diff = RecordDiff(old_tus, new_tus)
+    log(' %i unchanged, %s'
+        % (diff.num_unchanged,
+           ', '.join('%i %s' % (len(diff.get_changes(kind)), kind)
+                     for kind in diff.KINDS)))
+
+    with open_chunked(os.path.join(out_dir, 'diff.html')) as f:
+        write_html_header(f, 'Optimization changes', '')
+        f.write('<p>Changes since %s (%i records unchanged).</p>\n'
+                % (escape(old_build_dir), diff.num_unchanged))
+        for kind in diff.KINDS:
+            changes = diff.get_changes(kind)
+            f.write('<h2>%s (%i)</h2>\n' % (DIFF_HEADINGS[kind],
+                                            len(changes)))
+            if len(changes) > DIFF_TOP_N:
+                f.write('<p>The hottest %i.</p>\n' % DIFF_TOP_N)
+            write_diff_table(f, changes[:DIFF_TOP_N])
+        write_html_footer(f)
+
+# The number of clusters listed within clusters.html
+CLUSTERS_TOP_N = 1000
+
+# The number of functions listed for each cluster
+CLUSTER_TOP_FUNCTIONS = 3
+
+# Sorts the table of clusters when one of its headings is clicked, by the
+# data-sort attributes of the cells (numbers descending, text ascending)
+SORTABLE_TABLE_SCRIPT = '''\
+<script>
+function sortTable(th) {
+  var table = th.closest('table');
+  var col = Array.prototype.indexOf.call(th.parentNode.children, th);
+  var numeric = th.dataset.numeric !== undefined;
+  var rows = Array.prototype.slice.call(table.rows, 1);
+  rows.sort(function(a, b) {
+    var x = a.cells[col].dataset.sort, y = b.cells[col].dataset.sort;
+    if (numeric)
+      return parseFloat(y) - parseFloat(x);
+    return x < y ? -1 : x > y ? 1 : 0;
+  });
+  rows.forEach(function(row) { table.tBodies[0].appendChild(row); });
+}
+</script>
+'''
+
+CLUSTER_HEADINGS = (('Template', False),
+                    ('Pass', False),
+                    ('Records', True),
+                    ('Hotness', True),
+                    ('Success ratio', True),
+                    ('Functions', True))
+
+def get_success_ratio_text(ratio):
+    if ratio is None:
+        return ''
+    return '%.1f%%' % (100. * ratio)
+
+def get_cluster_row(cluster):
+    ratio = cluster.success_ratio
+    functions = ', '.join(
+        '%s (%i)' % (escape(name), n)
+        for name, n, hotness
+        in cluster.get_hottest_functions(CLUSTER_TOP_FUNCTIONS))
+    return ('  <tr>\n'
+            '    <td data-sort="%s">%s</td>\n'
+            '    <td data-sort="%s">%s</td>\n'
+            '    <td data-sort="%i" style="text-align:right">%i</td>\n'
+            '    <td data-sort="%i" style="text-align:right">%i</td>\n'
+            '    <td data-sort="%f" style="text-align:right">%s</td>\n'
+            '    <td data-sort="%i">%i: %s</td>\n'
+            '  </tr>\n'
+            % (escape(cluster.template), escape(cluster.template),
+               escape(cluster.passname or ''), escape(cluster.passname or ''),
+               cluster.count, cluster.count,
+               cluster.hotness, cluster.hotness,
+               -1 if ratio is None else ratio,
+               get_success_ratio_text(ratio),
+               len(cluster.functions), len(cluster.functions), functions))
+
+def make_clusters_html(out_dir, clusters):
+    """
+    Write clusters.html, listing the hottest of the MessageClusters, in a
+    table that can be sorted by each column.
+    """
+    log('make_clusters_html: %i clusters' % len(clusters))
+    with open_chunked(os.path.join(out_dir, 'clusters.html')) as f:
+        write_html_header(f, 'Message templates', SORTABLE_TABLE_SCRIPT)
+        f.write('<p>Records grouped by pass and message, with expressions,'
+                ' statements and symbol table nodes replaced by'
+                ' placeholders; click a heading to sort by it.</p>\n')
+        if len(clusters) > CLUSTERS_TOP_N:
+            f.write('<p>The hottest %i of %i templates.</p>\n'
+                    % (CLUSTERS_TOP_N, len(clusters)))
+        f.write('<table class="table table-striped table-bordered'
+                ' table-sm">\n')
+        f.write('  <tr>\n')
+        for heading, numeric in CLUSTER_HEADINGS:
+            f.write('    <th onclick="sortTable(this)"%s>%s</th>\n'
+                    % (' data-numeric' if numeric else '', heading))
+        f.write('  </tr>\n')
+        for cluster in clusters.get_sorted()[:CLUSTERS_TOP_N]:
+            f.write(get_cluster_row(cluster))
+            f.maybe_flush()
+        f.write('</table>\n')
+        write_html_footer(f)
+
+def load_filtered_tus(build_dir, jobs, cache_dir):
+    tus = find_records(build_dir, jobs, cache_dir)
+    filter_records(tus)
+    return tus
+
+############################################################################
+
+def get_record_digest_data(record):
+    """
+    Get everything about record (and its children) that affects its HTML,
+    in a form suitable for the marshal module.
+
+    This is its compact form, but with the name of its pass rather than the
+    id, which is an address within the compiler, and so varies between
+    otherwise identical builds.
+    """
+    (kind, pass_id, function, impl_location, message, count, location,
+     inlining_chain, children) = record.to_compact()
+    return (kind, record.pass_.name if record.pass_ else None, function,
+            impl_location, message, count, location, inlining_chain,
+            tuple(get_record_digest_data(child) for child in record.children))
+
+def get_records_digest(records):
+    h = hashlib.sha1()
+    for record in records:
+        h.update(marshal.dumps(get_record_digest_data(record)))
+    return h.hexdigest()
+
+def get_tu_aggregate(tu, passes_unfiltered):
+    """
+    Get everything that the global pages need from tu (after
+    filter_records), for caching by ReportState, as a tuple of:
+      - the highest count of its top-level records
+      - dicts of passname to number of records, before and after filtering
+      - a tuple of (source file, digest of its records within the file)
+      - its rows for index.html, as from get_sorted_index_rows
+      - its part of outline.txt
+      - its MessageClusters, in compact form
+    """
+    columns = RecordColumns([tu])
+    sourcefile_index = SourceFileIndex([tu])
+    sourcefiles = tuple((src_file,
+                         get_records_digest(
+                             record for _, record
+                             in sourcefile_index.get_records(src_file)))
+                        for src_file in sourcefile_index.get_sourcefiles())
+    outline = io.StringIO()
+    write_tu_outline(outline, tu)
+    return (columns.highest_count(toplevel_only=True),
+            passes_unfiltered,
+            dict(columns.count_records_by_pass()),
+            sourcefiles,
+            tuple(get_sorted_index_rows(tu.iter_all_records())),
+            outline.getvalue(),
+            MessageClusters.from_tus([tu]).to_compact())
+
+def load_filtered_records(filenames, jobs, cache_dir):
+    """
+    Load the given .opt-record.json.gz files, returning a dict of filename
+    to (filtered) TranslationUnit and a dict of filename to the number of
+    records per pass before filtering.
+    """
+    tus = load_record_files(filenames, jobs, cache_dir)
+    passes_unfiltered = {tu.filename: dict(RecordColumns([tu])
+                                           .count_records_by_pass())
+                         for tu in tus}
+    filter_records(tus)
+    return {tu.filename: tu for tu in tus}, passes_unfiltered
+
+def combine_counters(dicts):
+    combined = Counter()
+    for d in dicts:
+        combined.update(d)
+    return combined
+
+def generate_incremental_static_report(build_dir, out_dir, jobs=None,
+                                       cache_dir=None, index_page_size=None,
+                                       index_limit=None):
+    """
+    Update the static report in out_dir, only regenerating the pages
+    whose contributing records or source text have changed since the
+    previous run, as recorded by the ReportState there.
+
+    The global pages are rebuilt from the cached aggregate of each
+    unchanged TU; TUs are only loaded if they have changed, or contribute
+    records to a per-source-file page that needs regenerating.
+
+    Return the sorted list of record files, and a dict of filename to
+    (filtered) TranslationUnit for those that were loaded.
+    """
+    log('generate_incremental_static_report')
+
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    state = ReportState(out_dir)
+    state.load()
+
+    filenames = find_record_files(build_dir)
+    keys = {}
+    aggregates = {}
+    changed = []
+    for filename in filenames:
+        keys[filename] = get_record_file_key(filename)
+        entry = state.tus.get(filename)
+        aggregate = None
+        if entry and entry['key'] == keys[filename]:
+            aggregate = state.load_aggregate(filename)
+        if aggregate is None:
+            changed.append(filename)
+        else:
+            aggregates[filename] = aggregate
+    removed = [filename for filename in state.tus if filename not in keys]
+    log(' %i of %i record files changed, %i removed'
+        % (len(changed), len(filenames), len(removed)))
+
+    loaded, passes_unfiltered = load_filtered_records(changed, jobs,
+                                                      cache_dir)
+    for filename in changed:
+        aggregates[filename] = get_tu_aggregate(loaded[filename],
+                                                passes_unfiltered[filename])
+        state.store_aggregate(filename, aggregates[filename])
+    for filename in removed:
+        state.remove_aggregate(filename)
+
+    log_pass_counts(combine_counters(aggregates[filename][1]
+                                     for filename in filenames))
+    log_pass_counts(combine_counters(aggregates[filename][2]
+                                     for filename in filenames))
+    highest_count = max((aggregates[filename][0] for filename in filenames),
+                        default=0)
+    log(' highest_count=%r' % highest_count)
+
+    # Mapping of source file to [filename, digest] for each of the record
+    # files contributing records to it, in order
+    contributors = {}
+    for filename in filenames:
+        for src_file, digest in aggregates[filename][3]:
+            if src_file not in contributors:
+                contributors[src_file] = []
+            contributors[src_file].append([filename, digest])
+
+    dirty = []
+    sourcefiles = {}
+    for src_file, tus_for_file in contributors.items():
+        page = srcfile_to_html(src_file)
+        sourcefiles[src_file] = {'hash': hash_file(os.path.join(build_dir,
+                                                                src_file)),
+                                 'tus': tus_for_file,
+                                 'page': page}
+        old = state.sourcefiles.get(src_file)
+        if (old != sourcefiles[src_file]
+            or highest_count != state.highest_count
+            or not os.path.exists(os.path.join(out_dir, page))):
+            dirty.append(src_file)
+    for src_file, old in state.sourcefiles.items():
+        if src_file not in sourcefiles:
+            log(' removing %r' % old['page'])
+            try:
+                os.unlink(os.path.join(out_dir, old['page']))
+            except FileNotFoundError:
+                pass
+    log(' %i of %i source file pages to regenerate'
+        % (len(dirty), len(contributors)))
+
+    # Load the other TUs needed to regenerate the dirty pages
+    needed = set(filename for src_file in dirty
+                 for filename, digest in contributors[src_file])
+    more, _ = load_filtered_records([filename for filename in filenames
+                                     if filename in needed
+                                     and filename not in loaded],
+                                    jobs, cache_dir)
+    loaded.update(more)
+    tus = [loaded[filename] for filename in filenames if filename in loaded]
+
+    rebuild_global_pages = (changed or removed
+                            or highest_count != state.highest_count
+                            or index_page_size != state.index_page_size
+                            or index_limit != state.index_limit
+                            or not os.path.exists(os.path.join(out_dir,
+                                                               'index.html')))
+
+    highlighter = make_highlighter(cache_dir)
+    executor = None
+    if jobs is not None and jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    try:
+        pending = make_per_source_file_html(build_dir, out_dir,
+                                            SourceFileIndex(tus),
+                                            highest_count, highlighter,
+                                            executor, dirty)
+        if rebuild_global_pages:
+            log(' make_index_html')
+            # Merging the per-TU lists keeps ties in TU order, as in
+            # make_index_html
+            rows = [aggregates[filename][4] for filename in filenames]
+            num_records = sum(map(len, rows))
+            if index_limit is None:
+                rows = heapq.merge(*rows, key=operator.itemgetter(0))
+                num_rows = num_records
+            else:
+                rows = merge_top_k(rows, index_limit,
+                                   operator.itemgetter(0))
+                num_rows = len(rows)
+            write_index_html(out_dir, rows, highest_count, num_rows,
+                             index_page_size, num_records)
+            log('make_outline')
+            with open(os.path.join(out_dir, 'outline.txt'), 'w') as f:
+                for filename in filenames:
+                    f.write(aggregates[filename][5])
+            clusters = MessageClusters()
+            for filename in filenames:
+                clusters.merge_compact(aggregates[filename][6])
+            make_clusters_html(out_dir, clusters)
+        # Wait for any workers, raising any exception from them
+        for _ in pending:
+            pass
+    finally:
+        if executor:
+            executor.shutdown()
+
+    state.highest_count = highest_count
+    state.index_page_size = index_page_size
+    state.index_limit = index_limit
+    state.tus = {filename: {'key': keys[filename],
+                            'sourcefiles': [src_file for src_file, digest
+                                            in aggregates[filename][3]]}
+                 for filename in filenames}
+    state.sourcefiles = sourcefiles
+    state.save()
+    return filenames, loaded
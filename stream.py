@@ -0,0 +1,166 @@
+# TODO: license
+import csv
+import fnmatch
+import json
+import marshal
+import re
+
+from aggregates import record_sort_key
+from cache import RecordCache
+from optrecord import TranslationUnit
+from query import RECORD_FIELDS, record_to_json
+from topk import merge_top_k, top_k
+from utils import gc_disabled, iter_pool_map, load_cached_tu
+
+class RecordFilter:
+    """
+    Criteria for selecting records whilst streaming them from record
+    files: the pass, the kind, a glob for the source file, a regular
+    expression to search for within the function name, and the minimum
+    count.  Any of them can be None.
+    """
+    def __init__(self, passname=None, kind=None, file_glob=None,
+                 function_re=None, min_count=None):
+        self.passname = passname
+        self.kind = kind
+        self.file_glob = file_glob
+        self.function_re = function_re
+        self.min_count = min_count
+        # (compiled once, rather than on every fnmatch call)
+        self._file_re = (re.compile(fnmatch.translate(file_glob))
+                         if file_glob is not None else None)
+        self._function_re = (re.compile(function_re)
+                             if function_re is not None else None)
+
+    def matches(self, record):
+        if self.passname is not None:
+            if not record.pass_ or record.pass_.name != self.passname:
+                return False
+        if self.kind is not None and record.kind != self.kind:
+            return False
+        if self._file_re is not None:
+            if (not record.location
+                or not self._file_re.match(record.location.file)):
+                return False
+        if self._function_re is not None:
+            if (record.function is None
+                or not self._function_re.search(record.function)):
+                return False
+        if self.min_count is not None:
+            if not record.count or record.count.value < self.min_count:
+                return False
+        return True
+
+def load_selected_records(filename, record_filter, k, cache_dir):
+    """
+    Load filename, returning the TranslationUnit and the list of its
+    records (at any depth) matching record_filter, or just the k hottest
+    of them if k is set.
+    """
+    tu = load_cached_tu(filename, RecordCache(cache_dir) if cache_dir else None)
+    records = [record for record in tu.iter_all_records()
+               if record_filter.matches(record)]
+    if k is not None:
+        records = top_k(records, k, record_sort_key)
+    return tu, records
+
+def select_records(filename, record_filter, k, cache_dir):
+    """
+    Get the result of load_selected_records in marshalled form, as the
+    compact TranslationUnit with the selected records as its top-level
+    records, and the original depth of each.
+
+    This is run in the worker processes of iter_selected, so that only the
+    selected records are sent back to the parent process.
+    """
+    with gc_disabled():
+        tu, records = load_selected_records(filename, record_filter, k,
+                                            cache_dir)
+        return marshal.dumps((tu.to_compact(records),
+                              tuple(record.depth for record in records)))
+
+def iter_selected(filenames, record_filter, k=None, jobs=None,
+                  cache_dir=None):
+    """
+    Generate the selected records of each of filenames (see
+    select_records), one list per file, in order.
+
+    With jobs greater than 1, the files are loaded in a pool of that many
+    worker processes, with only a few more files than that in flight at
+    once, so that at most that many TUs are held in memory, however many
+    files there are.
+    """
+    if jobs is None or jobs <= 1:
+        for filename in filenames:
+            with gc_disabled():
+                tu, records = load_selected_records(filename, record_filter,
+                                                    k, cache_dir)
+            yield records
+        return
+
+    for data in iter_pool_map(select_records,
+                              [(filename, record_filter, k, cache_dir)
+                               for filename in filenames],
+                              jobs):
+        compact, depths = marshal.loads(data)
+        records = TranslationUnit.from_compact(compact).records
+        for record, depth in zip(records, depths):
+            record.depth = depth
+        yield records
+
+def query_records(filenames, record_filter, k=None, jobs=None,
+                  cache_dir=None):
+    """
+    Generate the records within filenames matching record_filter.
+
+    If k is set, these are the k hottest, hottest first, found by keeping
+    a running top-k as each file is loaded; otherwise they're all of them,
+    in the order of the files, generated as each file is loaded.  Either
+    way, no more than k records (plus those of the files being loaded)
+    are held at once.
+    """
+    selected = iter_selected(filenames, record_filter, k, jobs, cache_dir)
+    if k is None:
+        for records in selected:
+            yield from records
+        return
+    hottest = []
+    for records in selected:
+        # (hottest comes first, so that ties stay in the order of the
+        # files)
+        hottest = merge_top_k([hottest, records], k, record_sort_key)
+    yield from hottest
+
+############################################################################
+# Output formats
+
+def write_jsonl(f, records, fields):
+    for record in records:
+        f.write(json.dumps(record_to_json(record, fields),
+                           separators=(',', ':')))
+        f.write('\n')
+
+# How the fields of RECORD_FIELDS with structured values are written to
+# CSV; the others are written as they are, or as JSON if not a string or
+# number
+CSV_FIELDS = {
+    'location': lambda r: str(r.location) if r.location else None,
+    'count': lambda r: r.count.value if r.count else None,
+    'impl_location': lambda r: ('%s:%i' % (r.impl_location.file,
+                                           r.impl_location.line)
+                                if r.impl_location else None),
+}
+
+def get_csv_value(record, field):
+    if field in CSV_FIELDS:
+        return CSV_FIELDS[field](record)
+    value = RECORD_FIELDS[field](record)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+def write_csv(f, records, fields):
+    writer = csv.writer(f)
+    writer.writerow(fields)
+    for record in records:
+        writer.writerow([get_csv_value(record, field) for field in fields])
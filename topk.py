@@ -0,0 +1,30 @@
+# TODO: license
+import heapq
+import itertools
+
+def top_k(items, k, key):
+    """
+    Get a list of the k items with the lowest key (e.g. record_sort_key,
+    for the hottest records), in order, as would sorted(items, key=key)[:k]
+    (keeping items with equal keys in their original order).
+
+    This uses a heap of size k, rather than sorting all of the items.
+    """
+    if k is None:
+        return sorted(items, key=key)
+    return heapq.nsmallest(k, items, key=key)
+
+def merge_top_k(lists, k, key):
+    """
+    Combine lists of items, each in order of key (as from top_k or a
+    sort), into a list of the k items with the lowest key overall.  Items
+    with equal keys are kept in the order of the lists.
+
+    This only consumes as much of each list as is needed, so the lists can
+    be (lazy) iterables, or top_k lists built separately (e.g. per TU, in
+    worker processes), of at least k items each where available.
+    """
+    merged = heapq.merge(*lists, key=key)
+    if k is None:
+        return list(merged)
+    return list(itertools.islice(merged, k))
@@ -1,31 +1,254 @@
+import collections
+import concurrent.futures
+import contextlib
+import gc
+import marshal
 import os
 
+from cache import RecordCache
 from optrecord import TranslationUnit, Record, Expr, Stmt, SymtabNode
 
 def log(*args):
     print(*args)
 
-def find_records(build_dir):
+@contextlib.contextmanager
+def gc_disabled():
     """
-    Scan build_dir and below, looking for "*.opt-record.json".
-    Return a list of TranslationUnit instances.
+    Disable the cyclic garbage collector for the duration of a with block.
+
+    Loading records creates millions of objects without creating any
+    reference cycles, and would otherwise trigger many pointless
+    collections, each traversing everything loaded so far.
     """
-    log('find_records: %r' % build_dir)
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
 
-    tus = []
+def find_record_files(build_dir):
+    """
+    Scan build_dir and below, looking for "*.opt-record.json.gz".
+    Return a sorted list of filenames.
+    """
+    filenames = []
 
     # (os.scandir is Python 3.5 onwards)
     for root, dirs, files in os.walk(build_dir):
         for file_ in files:
             if file_.endswith('.opt-record.json.gz'):
-                filename = os.path.join(root, file_)
-                log(' reading: %r' % filename)
-                tus.append(TranslationUnit.from_filename(filename))
+                filenames.append(os.path.join(root, file_))
+
+    # Sort, so that the order of TranslationUnits doesn't depend on the
+    # order in which the filesystem happens to list directory entries.
+    return sorted(filenames)
+
+def load_tu(filename, cache):
+    """
+    Parse filename into a TranslationUnit, storing it into cache (if any).
+    """
+    if cache:
+        key = cache.get_key(filename)
+    tu = TranslationUnit.from_filename(filename)
+    if cache:
+        cache.store(filename, key, tu.to_compact())
+    return tu
+
+def get_cached_tu(filename, cache):
+    """
+    Get the TranslationUnit for filename from cache (if any), or None if
+    there isn't a valid entry for it.
+    """
+    compact = cache.load(filename) if cache else None
+    if compact is None:
+        return None
+    tu = TranslationUnit.from_compact(compact)
+    tu.filename = filename
+    return tu
+
+def load_cached_tu(filename, cache):
+    """
+    Get the TranslationUnit for filename from cache (if any), or else
+    parse it, storing it into cache.
+    """
+    tu = get_cached_tu(filename, cache)
+    if tu is None:
+        tu = load_tu(filename, cache)
+    return tu
 
+def load_compact_tu(filename, cache_dir):
+    """
+    Load filename (see load_cached_tu), returning the TranslationUnit in
+    marshalled compact form.
+
+    This is run in the worker processes of find_records: sending the
+    compact form back to the parent process and rebuilding the objects there
+    is much cheaper than pickling the TranslationUnit itself.
+    """
+    cache = RecordCache(cache_dir) if cache_dir else None
+    with gc_disabled():
+        return marshal.dumps(load_cached_tu(filename, cache).to_compact())
+
+def find_records(build_dir, jobs=None, cache_dir=None):
+    """
+    Scan build_dir and below, looking for "*.opt-record.json.gz".
+    Return a list of TranslationUnit instances, in the order of the
+    sorted filenames.
+
+    If jobs is greater than 1, decompress and parse the files in a pool
+    of that many worker processes.
+
+    If cache_dir is set, use it as a RecordCache, only parsing the files
+    that don't have a valid entry there.
+    """
+    log('find_records: %r' % build_dir)
+
+    return load_record_files(find_record_files(build_dir), jobs, cache_dir)
+
+def load_record_files(filenames, jobs=None, cache_dir=None):
+    """
+    Load each of the given .opt-record.json.gz files into a
+    TranslationUnit, returning a list in the same order; see find_records.
+    """
+    cache = RecordCache(cache_dir) if cache_dir else None
+    with gc_disabled():
+        return load_records(filenames, jobs, cache)
+
+def load_records(filenames, jobs, cache):
+    """
+    Load each of filenames into a TranslationUnit, returning a list in the
+    same order; see find_records.
+    """
+    tus = [None] * len(filenames)
+    stale = []
+    for i, filename in enumerate(filenames):
+        tus[i] = get_cached_tu(filename, cache)
+        if tus[i] is None:
+            stale.append(i)
+    if cache:
+        log(' loaded %i files from cache' % (len(filenames) - len(stale)))
+
+    if jobs is None or jobs <= 1 or len(stale) <= 1:
+        for i in stale:
+            log(' reading: %r' % filenames[i])
+            tus[i] = load_tu(filenames[i], cache)
+        return tus
+
+    log(' reading %i files using %i jobs' % (len(stale), jobs))
+    # Hand out several files at a time to each worker, to amortize the
+    # per-task overhead when there are many small files.
+    chunksize = max(1, len(stale) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # executor.map yields the results in the order of its inputs.
+        results = executor.map(load_compact_tu,
+                               [filenames[i] for i in stale],
+                               [cache.cache_dir if cache else None] * len(stale),
+                               chunksize=chunksize)
+        for i, data in zip(stale, results):
+            tus[i] = TranslationUnit.from_compact(marshal.loads(data))
     return tus
 
+def iter_tus(filenames, jobs=None, cache_dir=None):
+    """
+    Load each of filenames into a TranslationUnit in turn, only holding
+    one at a time in this process (and parsing them in a pool of jobs
+    worker processes, if that's greater than 1, with only a few more files
+    than that in flight at once).
+    """
+    if jobs is None or jobs <= 1:
+        cache = RecordCache(cache_dir) if cache_dir else None
+        for filename in filenames:
+            yield load_cached_tu(filename, cache)
+        return
+
+    log(' reading %i files using %i jobs' % (len(filenames), jobs))
+    cache = RecordCache(cache_dir) if cache_dir else None
+    # (files in the cache are loaded here, rather than by the workers, as
+    # that's no slower than unmarshalling their results)
+    def get_local(filename, cache_dir):
+        return get_cached_tu(filename, cache)
+    for item in iter_pool_map(load_compact_tu,
+                              [(filename, cache_dir) for filename in filenames],
+                              jobs, get_local):
+        if isinstance(item, bytes):
+            item = TranslationUnit.from_compact(marshal.loads(item))
+        yield item
+
+def iter_pool_map(fn, args_list, jobs, get_local=None):
+    """
+    Generate fn(*args) for each of args_list, in order, calling it in a
+    pool of jobs worker processes, with at most twice that many calls in
+    flight at once (see map_bounded).
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from map_bounded(executor, fn, args_list, 2 * jobs, get_local)
+
+def map_bounded(executor, fn, args_list, max_pending, get_local=None):
+    """
+    Submit fn(*args) to executor for each of args_list, returning an
+    iterator over the results, in order.
+
+    Only max_pending calls are in flight at once, with the rest being
+    submitted as the results are consumed, so that only a few results
+    (and arguments) are held however many there are, unlike executor.map,
+    which submits every call up front, holding on to all of their results
+    until consumed.  The first calls are submitted immediately.
+
+    If get_local is set, it's first called with each args in this
+    process, and whatever it returns other than None is generated instead
+    of calling fn.
+    """
+    # Queue of the results from get_local, and of futures for those from
+    # fn, in order
+    pending = collections.deque()
+    args_list = iter(args_list)
+
+    def submit():
+        for args in args_list:
+            result = get_local(*args) if get_local else None
+            if result is not None:
+                pending.append((result, None))
+            else:
+                pending.append((None, executor.submit(fn, *args)))
+            if len(pending) >= max_pending:
+                break
+
+    def iter_results():
+        while True:
+            submit()
+            if not pending:
+                return
+            result, future = pending.popleft()
+            yield future.result() if future else result
+
+    submit()
+    return iter_results()
+
+def get_message_text(record):
+    """
+    Get the message of record as plain text.
+    """
+    return ''.join(map(str, record.message))
+
 def get_effective_result(record):
     if record.kind == 'scope':
         if record.children:
             return get_effective_result(record.children[-1])
     return record.kind
+
+def is_record_shown(record):
+    """
+    Should record be shown in the report (and in diffs)?
+    """
+    # Hack to filter things a bit:
+    if record.location:
+        src_file = record.location.file
+        if 'pgen.c' in src_file:
+            return False
+    if record.pass_:
+        if record.pass_.name in ('slp', 'fre', 'pre', 'profile',
+                                 'cunroll', 'cunrolli', 'ivcanon'):
+            return False
+    return True
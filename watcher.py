@@ -0,0 +1,94 @@
+# TODO: license
+import threading
+
+from incremental import get_record_file_key
+from utils import find_record_files, load_record_files, log
+
+# Seconds between scans of the build directory
+POLL_INTERVAL = 2.0
+
+class RecordWatcher:
+    """
+    Background thread keeping app.index up to date with the
+    .opt-record.json.gz files within build_dir, by polling their
+    modification times and sizes.
+
+    Only new and changed files are reloaded, and the new RecordIndex reuses
+    everything computed for the unchanged TUs (see RecordIndex.updated).
+    It is built entirely within this thread and then swapped in with a
+    single assignment, so each request (reading app.index once) sees
+    either the old or the new state, never a mixture of the two.
+    """
+    def __init__(self, app, build_dir, jobs=None, cache_dir=None,
+                 interval=POLL_INTERVAL):
+        self.app = app
+        self.build_dir = build_dir
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.interval = interval
+        # Take the initial snapshot before the records are first loaded, so
+        # that changes made while loading them are picked up by the first
+        # poll
+        self.keys = self.scan()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def scan(self):
+        """
+        Get a dict mapping each of the record files within build_dir to a
+        key for its current state.
+        """
+        keys = {}
+        for filename in find_record_files(self.build_dir):
+            try:
+                keys[filename] = get_record_file_key(filename)
+            except OSError:
+                # Removed since the directory was listed
+                pass
+        return keys
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='RecordWatcher',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                # e.g. a file that is still being written; as self.keys
+                # hasn't been updated, it is retried at the next poll
+                log('watcher: failed to reload records: %s' % e)
+
+    def poll(self):
+        """
+        Reload any new or changed record files and drop any removed ones,
+        swapping in a new app.index if there were any.  Return True if
+        there were.
+        """
+        keys = self.scan()
+        changed = [filename for filename, key in keys.items()
+                   if self.keys.get(filename) != key]
+        removed = [filename for filename in self.keys
+                   if filename not in keys]
+        if not changed and not removed:
+            return False
+        log('watcher: reloading %i files, dropping %i'
+            % (len(changed), len(removed)))
+
+        index = self.app.index
+        tus_by_filename = {tu.filename: tu for tu in index.tus}
+        tus_by_filename.update(zip(changed,
+                                   load_record_files(changed, self.jobs,
+                                                     self.cache_dir)))
+        tus = [tus_by_filename[filename] for filename in sorted(keys)
+               if filename in tus_by_filename]
+        self.app.index = index.updated(tus)
+        self.keys = keys
+        return True